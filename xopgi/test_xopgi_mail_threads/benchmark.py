@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+'''Benchmarks of the mail pipeline with synthetic corpora.
+
+The benchmark generates corpora of messages (see `CORPORA`:data:) and
+measures each stage of the pipeline: ``message_parse``, ``message_route``,
+``_customize_routes``, ``message_route_process`` and ``send_email``, plus the
+whole ``message_process``.  For each corpus and stage it reports the messages
+per second, the p50 and p99 latencies (in milliseconds) and the queries (and
+INSERTs) per message.  For ``message_process`` it also reports the peak of
+memory allocated (with `tracemalloc`, not available in Python 2).
+
+It needs a DB where this addon is installed.  Nothing is committed.  From an
+Odoo shell::
+
+    >>> from odoo.addons.test_xopgi_mail_threads.benchmark import run
+    >>> results = run(env, count=200, routers=10, transports=5)
+
+or from the command line (the arguments after ``--`` are passed to Odoo)::
+
+    $ python -m odoo.addons.test_xopgi_mail_threads.benchmark \\
+         -o results.json --compare baseline.json -- -d testdb
+
+The results are JSON; `compare`:func: finds the regressions between two
+runs, and the command exits with status 1 if there are any.
+
+While the benchmark runs, `routers` dummy mail routers and `transports`
+dummy transports are installed.  The routers decline every message; the last
+transport accepts every message and delivers nothing.
+
+To measure what's saved by routing automatic responses with their headers
+only, run the 'dsn' and 'auto_reply' corpora with ``--automatic-responses
+route`` and ``--automatic-responses ignore`` and compare the 'process'
+stage.
+
+'''
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import json
+import time
+import random
+import platform
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from xoeuf import MAJOR_ODOO_VERSION
+from xoeuf.odoo.addons.xopgi_mail_threads import (
+    MailRouter,
+    MailTransportRouter,
+    parse_message,
+)
+from xoeuf.odoo.addons.xopgi_mail_threads.utils import (
+    invalidate_installed_objects,
+)
+
+timer = getattr(time, 'perf_counter', time.time)
+
+#: The address of the alias of the `bouncer` model (see data/alias.xml).
+ALIAS = 'default-xopgi-mailthread-model@localhost'
+
+#: The stages measured.
+STAGES = ('parse', 'route', 'customize_routes', 'route_process', 'send',
+          'process')
+
+
+# Corpora
+#
+# Each generator takes a `random.Random` and the position of the message, and
+# returns the raw message (bytes).
+
+def _headers(message, rnd, pos, kind):
+    message['From'] = 'sender%d@example.com' % rnd.randint(1, 1000)
+    if 'To' not in message:
+        message['To'] = ALIAS
+    message['Subject'] = '%s message %d' % (kind, pos)
+    message['Message-Id'] = '<%s-%d-%d@benchmark>' % (
+        kind, pos, rnd.randint(0, 10 ** 9)
+    )
+    return message
+
+
+def _as_bytes(message):
+    return getattr(message, 'as_bytes', message.as_string)()
+
+
+def generate_reply(rnd, pos):
+    message = MIMEText('Thanks!\n\n> ' + 'Quoted text. ' * 20)
+    references = [
+        '<thread-%d@benchmark>' % i
+        for i in range(rnd.randint(1, 8))
+    ]
+    message['In-Reply-To'] = references[-1]
+    message['References'] = ' '.join(references)
+    return _as_bytes(_headers(message, rnd, pos, 'reply'))
+
+
+def generate_multipart(rnd, pos, attachments=3, size=256 * 1024):
+    message = MIMEMultipart(boundary='==%020d==' % rnd.getrandbits(64))
+    message.attach(MIMEText('See the attached files.'))
+    for i in range(attachments):
+        # Random blocks, so that the attachments don't compress too well.
+        block = bytes(bytearray(rnd.getrandbits(8) for _ in range(4096)))
+        part = MIMEApplication((block * (size // len(block) + 1))[:size])
+        part.add_header('Content-Disposition', 'attachment',
+                        filename='file%d.bin' % i)
+        message.attach(part)
+    return _as_bytes(_headers(message, rnd, pos, 'multipart'))
+
+
+def generate_dsn(rnd, pos):
+    recipient = 'nobody%d@example.com' % rnd.randint(1, 100)
+    message_id = '<dsn-%d@benchmark>' % pos
+    return ('''From: MAILER-DAEMON@example.com
+To: %(alias)s
+Subject: Undelivered Mail Returned to Sender
+Message-Id: %(message_id)s
+Content-Type: multipart/report; report-type=delivery-status;
+\tboundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain
+
+This is the mail system.
+
+--BOUNDARY
+Content-Type: message/delivery-status
+
+Reporting-MTA: dns; mx.example.com
+
+Final-Recipient: rfc822; %(recipient)s
+Action: failed
+Status: 5.1.1
+
+--BOUNDARY
+Content-Type: message/rfc822
+
+Message-Id: <original-%(pos)d@benchmark>
+From: %(alias)s
+To: %(recipient)s
+
+The original message.
+
+--BOUNDARY--
+''' % dict(alias=ALIAS, message_id=message_id, recipient=recipient,
+           pos=pos)).encode('ascii')
+
+
+def generate_auto_reply(rnd, pos):
+    message = MIMEText('I am out of the office.')
+    message['Auto-Submitted'] = 'auto-replied'
+    message['In-Reply-To'] = '<thread-%d@benchmark>' % rnd.randint(1, 100)
+    return _as_bytes(_headers(message, rnd, pos, 'auto_reply'))
+
+
+def generate_many_recipients(rnd, pos, recipients=300):
+    message = MIMEText('Hello everyone.')
+    message['To'] = ', '.join(
+        [ALIAS] + ['user%d@example.com' % i for i in range(recipients)]
+    )
+    return _as_bytes(_headers(message, rnd, pos, 'many_recipients'))
+
+
+#: The generators of each corpus.
+CORPORA = {
+    'reply': generate_reply,
+    'multipart': generate_multipart,
+    'dsn': generate_dsn,
+    'auto_reply': generate_auto_reply,
+    'many_recipients': generate_many_recipients,
+}
+
+
+def generate_corpus(kind, count, seed=0):
+    '''Return a list of `count` raw messages of the corpus `kind`.'''
+    rnd = random.Random('%s-%s' % (kind, seed))
+    generate = CORPORA[kind]
+    return [generate(rnd, pos) for pos in range(count)]
+
+
+# Dummy routers and transports
+#
+# They are created once per process and only act while a benchmark runs.
+
+_ACTIVE = []
+_ROUTERS = []
+_TRANSPORTS = []
+
+
+def _dummy_query(cls, obj, message):
+    return False, None
+
+
+def _accept_query(cls, obj, message):
+    return bool(_ACTIVE), None
+
+
+def _dummy_deliver(self, obj, message, data, **kwargs):
+    return message['Message-Id']
+
+
+def _dummy_apply(cls, obj, routes, message, data=None):
+    pass
+
+
+def get_dummy_routers(count):
+    '''Return `count` dummy routers.'''
+    while len(_ROUTERS) < count:
+        _ROUTERS.append(type(
+            str('BenchmarkRouter%d' % len(_ROUTERS)),
+            (MailRouter, ),
+            dict(query=classmethod(_dummy_query),
+                 apply=classmethod(_dummy_apply),
+                 __module__=__name__)
+        ))
+    return _ROUTERS[:count]
+
+
+def get_dummy_transports(count):
+    '''Return `count` dummy transports; the last one accepts messages.'''
+    while len(_TRANSPORTS) < count:
+        _TRANSPORTS.append(type(
+            str('BenchmarkTransport%d' % len(_TRANSPORTS)),
+            (MailTransportRouter, ),
+            dict(query=classmethod(_dummy_query),
+                 deliver=_dummy_deliver,
+                 priority=1000 + len(_TRANSPORTS),
+                 __module__=__name__)
+        ))
+    result = _TRANSPORTS[:count]
+    for transport in _TRANSPORTS:
+        transport.query = classmethod(_dummy_query)
+    if result:
+        result[-1].query = classmethod(_accept_query)
+    return result
+
+
+# Measurement
+
+class QueryCounter(object):
+    '''Count the queries (and INSERTs) executed by a cursor.'''
+    def __init__(self, cr):
+        self.cr = cr
+        self.queries = self.inserts = 0
+
+    def __enter__(self):
+        execute = self._execute = self.cr.execute
+
+        def counted(query, *args, **kwargs):
+            self.queries += 1
+            if str(query).lstrip()[:6].lower() == 'insert':
+                self.inserts += 1
+            return execute(query, *args, **kwargs)
+
+        self.cr.execute = counted
+        return self
+
+    def __exit__(self, *args):
+        del self.cr.execute
+
+
+class Stage(object):
+    '''The measures of a stage.'''
+    def __init__(self):
+        self.latencies = []
+        self.peaks = []
+        self.queries = self.inserts = 0
+
+    def measure(self, cr, func, *args, **kwargs):
+        with QueryCounter(cr) as counter:
+            start = timer()
+            result = func(*args, **kwargs)
+            self.latencies.append(timer() - start)
+        self.queries += counter.queries
+        self.inserts += counter.inserts
+        return result
+
+    def measure_memory(self, cr, func, *args, **kwargs):
+        '''Same as `measure` but also record the peak of memory allocated.'''
+        try:
+            import tracemalloc
+        except ImportError:
+            return self.measure(cr, func, *args, **kwargs)
+        tracemalloc.start()
+        try:
+            result = self.measure(cr, func, *args, **kwargs)
+            self.peaks.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+        return result
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        if not count:
+            return dict(count=0)
+        total = sum(latencies)
+        return dict(
+            count=count,
+            msgs_per_sec=count / total if total else None,
+            p50_ms=percentile(latencies, 50) * 1000,
+            p99_ms=percentile(latencies, 99) * 1000,
+            mean_ms=total / count * 1000,
+            queries_per_msg=self.queries / count,
+            inserts_per_msg=self.inserts / count,
+            peak_kb_mean=(sum(self.peaks) / len(self.peaks) / 1024
+                          if self.peaks else None),
+            peak_kb_max=max(self.peaks) / 1024 if self.peaks else None,
+        )
+
+
+def percentile(values, p):
+    '''Return the `p` percentile (nearest rank) of the sorted `values`.'''
+    rank = max(0, min(len(values) - 1, int(round(p / 100 * len(values))) - 1))
+    return values[rank]
+
+
+def run_corpus(env, messages, model='bouncer'):
+    '''Run the `messages` through the pipeline and return the stages.'''
+    cr = env.cr
+    Threads = env['mail.thread']
+    MailServer = env['ir.mail_server']
+    stages = {name: Stage() for name in STAGES}
+    for raw in messages:
+        message = parse_message(raw).message
+        msg = stages['parse'].measure(cr, Threads.message_parse, message)
+        # `message_route` runs `_customize_routes`; measure the later alone
+        # with a fresh message so that nothing is cached.
+        routes = stages['route'].measure(cr, Threads.message_route,
+                                         message, msg, model=model)
+        stages['customize_routes'].measure(
+            cr, Threads._customize_routes,
+            parse_message(raw).message, []
+        )
+        with cr.savepoint():
+            stages['route_process'].measure(
+                cr, Threads.message_route_process, message, msg, routes
+            )
+        outgoing = parse_message(raw).message
+        stages['send'].measure(cr, MailServer.send_email, outgoing)
+        # The message was already processed; change its Message-Id so that
+        # it's not a duplicate.
+        raw = raw.replace(b'Message-Id: <', b'Message-Id: <process-', 1)
+        with cr.savepoint():
+            stages['process'].measure_memory(
+                cr, Threads.message_process, model, raw
+            )
+    return stages
+
+
+def run(env, count=100, routers=10, transports=5, corpora=None, seed=0,
+        output=None, automatic_responses=None):
+    '''Run the benchmark and return the results (a JSON-compatible dict).
+
+    :param count: The number of messages of each corpus.
+
+    :param routers: The number of dummy routers.
+
+    :param transports: The number of dummy transports.
+
+    :param corpora: The names of the corpora to run (default all).
+
+    :param output: If given, the path where to write the results.
+
+    :param automatic_responses: If given, the action for all the classes of
+           automatic responses (e.g 'ignore').
+
+    The transaction of `env` is rolled back at the end.
+
+    '''
+    get_dummy_routers(routers)
+    get_dummy_transports(transports)
+    invalidate_installed_objects(env.cr.dbname)
+    if automatic_responses:
+        from xoeuf.odoo.addons.xopgi_mail_threads.mail_threads import (
+            AUTOMATIC_RESPONSE_CLASSES,
+            AUTOMATIC_RESPONSE_PARAM,
+        )
+        set_param = env['ir.config_parameter'].sudo().set_param
+        for kind in AUTOMATIC_RESPONSE_CLASSES.values():
+            set_param(AUTOMATIC_RESPONSE_PARAM % kind, automatic_responses)
+    _ACTIVE.append(True)
+    results = {}
+    try:
+        for kind in corpora or sorted(CORPORA):
+            messages = generate_corpus(kind, count, seed=seed)
+            stages = run_corpus(env, messages)
+            results[kind] = {
+                name: stage.summary() for name, stage in stages.items()
+            }
+    finally:
+        _ACTIVE.pop()
+        env.cr.rollback()
+    result = dict(
+        meta=dict(
+            count=count,
+            routers=routers,
+            transports=transports,
+            seed=seed,
+            automatic_responses=automatic_responses,
+            odoo=MAJOR_ODOO_VERSION,
+            python=platform.python_version(),
+            time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        ),
+        results=results,
+    )
+    if output:
+        with open(output, 'w') as fh:
+            json.dump(result, fh, indent=2, sort_keys=True)
+    return result
+
+
+def compare(baseline, current, tolerance=0.2):
+    '''Return the regressions of `current` with respect to `baseline`.
+
+    A regression is a stage whose p50 or p99 latency, its queries per message
+    or its mean peak of memory grew more than `tolerance` (a fraction), or
+    whose messages per second fell more than `tolerance`.  Return a list of
+    tuples ``(corpus, stage, metric, baseline value, current value)``.
+
+    '''
+    result = []
+    for kind, stages in current['results'].items():
+        for name, summary in stages.items():
+            base = baseline['results'].get(kind, {}).get(name)
+            if not base or not summary.get('count'):
+                continue
+            for metric in ('p50_ms', 'p99_ms', 'queries_per_msg',
+                           'peak_kb_mean'):
+                old, new = base.get(metric), summary.get(metric)
+                if old is None or new is None:
+                    continue
+                if new > old * (1 + tolerance) and \
+                   new - old > 1e-6:
+                    result.append((kind, name, metric, old, new))
+            old, new = base.get('msgs_per_sec'), summary.get('msgs_per_sec')
+            if old and new and new < old * (1 - tolerance):
+                result.append((kind, name, 'msgs_per_sec', old, new))
+    return sorted(result)
+
+
+def main(argv=None):
+    import sys
+    import argparse
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if '--' in argv:
+        pos = argv.index('--')
+        argv, odoo_args = argv[:pos], argv[pos + 1:]
+    else:
+        odoo_args = []
+    parser = argparse.ArgumentParser(description='Benchmark the mail '
+                                                 'pipeline.')
+    parser.add_argument('-n', '--count', type=int, default=100)
+    parser.add_argument('-r', '--routers', type=int, default=10)
+    parser.add_argument('-t', '--transports', type=int, default=5)
+    parser.add_argument('--corpus', action='append', choices=sorted(CORPORA))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--automatic-responses',
+                        choices=('route', 'ignore', 'bounce', 'routers'))
+    parser.add_argument('-o', '--output')
+    parser.add_argument('--compare', metavar='BASELINE')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    from xoeuf import odoo, api, SUPERUSER_ID
+    odoo.tools.config.parse_config(odoo_args)
+    dbname = odoo.tools.config['db_name']
+    with api.Environment.manage():
+        with odoo.registry(dbname).cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            result = run(env, count=args.count, routers=args.routers,
+                         transports=args.transports, corpora=args.corpus,
+                         seed=args.seed, output=args.output,
+                         automatic_responses=args.automatic_responses)
+    if not args.output:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        regressions = compare(baseline, result, tolerance=args.tolerance)
+        for regression in regressions:
+            print('Regression in %s/%s %s: %.3f -> %.3f' % regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
@@ -10,5 +10,18 @@ from __future__ import (division as _py3_division,
                         print_function as _py3_print,
                         absolute_import as _py3_abs_import)
 
+import sys
+
 from . import test_all  # noqa
+from . import test_benchmark  # noqa
+from . import test_diagnostics  # noqa
+from . import test_dsn  # noqa
+from . import test_instrumentation  # noqa
+if sys.version_info >= (3, 5):
+    from . import test_lmtp  # noqa
+from . import test_mail_queue  # noqa
 from . import test_raw_email  # noqa
+from . import test_route_set  # noqa
+from . import test_router_index  # noqa
+from . import test_smtp_pool  # noqa
+from . import test_spooling  # noqa
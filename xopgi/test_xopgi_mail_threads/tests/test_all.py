@@ -18,7 +18,11 @@ except ImportError:
 
 from xoeuf import MAJOR_ODOO_VERSION
 from xoeuf.odoo.tests.common import TransactionCase, at_install, post_install
-from xoeuf.odoo.addons.xopgi_mail_threads import TransportRouteData
+from xoeuf.odoo.addons.xopgi_mail_threads import (
+    MailRouter,
+    MailTransportRouter,
+    TransportRouteData,
+)
 
 from ..router import TestRouter
 from ..transport import TestTransport
@@ -32,6 +36,8 @@ This is a message.
 
 '''
 
+MAIL_THREADS = 'xoeuf.odoo.addons.xopgi_mail_threads.mail_threads'
+
 YES = (True, None)
 NO = (False, None)
 
@@ -104,6 +110,119 @@ class TestReceivingMailsTruishQuery(RouterCase):
         self.assertTrue(query.called)
         self.assertTrue(apply.called)
 
+    def test_router_metrics(self, apply, query):
+        from xoeuf.odoo.addons.xopgi_mail_threads.instrumentation import (
+            get_name,
+        )
+        Mailer = self.env['mail.thread']
+        name = get_name(TestRouter)
+        before = Mailer.get_router_metrics().get(name, {})
+        Mailer.message_process('bouncer', MESSAGE)
+        after = Mailer.get_router_metrics()[name]
+        for method in ('query', 'apply'):
+            calls = before.get(method, {}).get('calls', 0)
+            self.assertEqual(after[method]['calls'], calls + 1)
+
+
+@at_install(False)
+@post_install(True)
+class TestBatchProcessing(RouterCase):
+    def test_batch_skips_duplicates(self):
+        Mailer = self.env['mail.thread']
+        other = MESSAGE.replace('Subject:', 'Message-Id: <other@localhost>\n'
+                                'Subject:')
+        results = Mailer.message_process_batch(
+            'bouncer',
+            [MESSAGE, other, other],
+        )
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(not r.error for r in results))
+        self.assertTrue(results[0].thread_id)
+        self.assertTrue(results[1].thread_id)
+        # The third is the duplicate of the second, it's not routed.
+        self.assertFalse(results[2].thread_id)
+        self.assertTrue(
+            self.env['mail.message'].search(
+                [('message_id', '=', '<other@localhost>')]
+            ).raw_email
+        )
+
+    def test_batch_failed_message_does_not_stop_others(self):
+        Mailer = self.env['mail.thread']
+        results = Mailer.message_process_batch('bouncer', [None, MESSAGE])
+        self.assertIsNotNone(results[0].error)
+        self.assertIsNone(results[1].error)
+        self.assertTrue(results[1].thread_id)
+
+
+@at_install(False)
+@post_install(True)
+class TestSpooledAttachments(RouterCase):
+    def test_big_attachments_are_stored_from_spool(self):
+        import os
+        from base64 import b64decode
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+        from email.mime.application import MIMEApplication
+        from xoeuf.odoo.addons.xopgi_mail_threads import spooling
+        content = os.urandom(30000)
+        message = MIMEMultipart()
+        message['To'] = 'default-xopgi-mailthread-model@localhost'
+        message['From'] = 'someone@localhost'
+        message['Subject'] = 'Big attachment'
+        message['Message-Id'] = '<spooled@localhost>'
+        message.attach(MIMEText('See the attachment'))
+        attachment = MIMEApplication(content)
+        attachment.add_header('Content-Disposition', 'attachment',
+                              filename='big.bin')
+        message.attach(attachment)
+        Mailer = self.env['mail.thread']
+        with patch.object(spooling, 'get_spool_threshold',
+                          return_value=10000):
+            thread_id = Mailer.message_process('bouncer',
+                                               message.as_string())
+        self.assertTrue(thread_id)
+        stored = self.env['ir.attachment'].search([
+            ('res_model', '=', 'bouncer'),
+            ('res_id', '=', thread_id),
+            ('name', '=', 'big.bin'),
+        ])
+        self.assertEqual(len(stored), 1)
+        self.assertEqual(b64decode(stored.datas), content)
+        self.assertTrue(
+            self.env['mail.message'].search(
+                [('message_id', '=', '<spooled@localhost>')]
+            ).raw_email
+        )
+
+
+@at_install(False)
+@post_install(True)
+class TestInstalledRoutersCache(RouterCase):
+    def test_installed_routers_are_cached(self):
+        Mailer = self.env['mail.thread']
+        cache = MailRouter.installed_cache
+        cache.invalidate()
+        first = MailRouter.get_installed_objects(Mailer)
+        self.assertIn(TestRouter, first)
+        stats = cache.stats()
+        second = MailRouter.get_installed_objects(Mailer)
+        self.assertEqual(first, second)
+        self.assertEqual(cache.stats()['hits'], stats['hits'] + 1)
+        self.assertEqual(cache.stats()['misses'], stats['misses'])
+
+    def test_installed_routers_cache_invalidated_by_module_state(self):
+        Mailer = self.env['mail.thread']
+        cache = MailRouter.installed_cache
+        MailRouter.get_installed_objects(Mailer)
+        misses = cache.stats()['misses']
+        module = self.env['ir.module.module'].search(
+            [('name', '=', 'test_xopgi_mail_threads')]
+        )
+        module.write({'state': 'installed'})
+        MailRouter.get_installed_objects(Mailer)
+        self.assertEqual(cache.stats()['misses'], misses + 1)
+
 
 @patch.object(TestTransport, 'query', return_value=NO)
 @patch.multiple(TestTransport, prepare_message=DEFAULT, deliver=DEFAULT)
@@ -134,3 +253,391 @@ class TestSendingMessagesTruishTransport(TransportCase):
         self.assertTrue(query.called)
         self.assertTrue(prepare_message.called)
         self.assertTrue(deliver.called)
+
+    def test_transport_metrics(self, query, prepare_message, deliver):
+        from xoeuf.odoo.addons.xopgi_mail_threads.instrumentation import (
+            get_name,
+        )
+        MailServer = self.env['ir.mail_server']
+        name = get_name(TestTransport)
+        before = MailServer.get_transport_metrics().get(name, {})
+        deliver.side_effect = [ValueError(), '<sent@localhost>']
+        for _ in range(2):
+            MailServer.send_email(email.message_from_string(MESSAGE))
+        after = MailServer.get_transport_metrics()[name]
+        for method, calls, failures in [('query', 2, 0),
+                                        ('prepare_message', 2, 0),
+                                        ('deliver', 2, 1)]:
+            old = before.get(method, dict(calls=0, failures=0))
+            self.assertEqual(after[method]['calls'] - old['calls'], calls)
+            self.assertEqual(after[method]['failures'] - old['failures'],
+                             failures)
+
+
+@patch.object(TestTransport, 'parallel_query', True)
+@patch.object(TestTransport, 'deliver')
+@patch.object(TestTransport, 'prepare_message', return_value=PREPARED_MESSAGE)
+@at_install(False)
+@post_install(True)
+class TestSendingMessagesParallelTransport(TransportCase):
+    def setUp(self):
+        super(TestSendingMessagesParallelTransport, self).setUp()
+        from xoeuf.odoo.addons.xopgi_mail_threads.transports import (
+            SELECT_MODE_PARAM,
+            PARALLEL_MODE,
+            QUERY_TIMEOUT_PARAM,
+        )
+        set_param = self.env['ir.config_parameter'].set_param
+        set_param(SELECT_MODE_PARAM, PARALLEL_MODE)
+        set_param(QUERY_TIMEOUT_PARAM, '0.2')
+
+    def test_selects_transport_in_parallel(self, prepare_message, deliver):
+        message = email.message_from_string(MESSAGE)
+        with patch.object(TestTransport, 'query', return_value=YES) as query:
+            self.env['ir.mail_server'].send_email(message)
+        self.assertTrue(query.called)
+        self.assertTrue(prepare_message.called)
+        self.assertTrue(deliver.called)
+
+    def test_slow_transport_is_skipped(self, prepare_message, deliver):
+        import time
+
+        def slow(*args):
+            time.sleep(1)
+            return YES
+
+        message = email.message_from_string(MESSAGE)
+        with patch.object(TestTransport, 'query', side_effect=slow):
+            self.env['ir.mail_server'].send_email(message)
+        self.assertFalse(prepare_message.called)
+        self.assertFalse(deliver.called)
+
+
+@patch.object(TestTransport, 'deliver', return_value='<sent@localhost>')
+@patch.object(TestTransport, 'prepare_message', return_value=PREPARED_MESSAGE)
+@patch.object(TestTransport, 'query', return_value=YES)
+@at_install(False)
+@post_install(True)
+class TestSendingManyMessages(TransportCase):
+    def test_send_emails_groups_by_transport(self, query, prepare_message,
+                                             deliver):
+        messages = [email.message_from_string(MESSAGE) for _ in range(3)]
+        results = self.env['ir.mail_server'].send_emails(messages)
+        self.assertEqual(query.call_count, 3)
+        self.assertEqual(prepare_message.call_count, 3)
+        self.assertEqual(deliver.call_count, 3)
+        self.assertEqual([r.message_id for r in results],
+                         ['<sent@localhost>'] * 3)
+        self.assertFalse(any(r.error for r in results))
+
+
+QUEUED_MESSAGE = TransportRouteData(
+    email.message_from_string(
+        MESSAGE.replace('Subject:', 'Message-Id: <queued@localhost>\nSubject:')
+    ),
+    {}
+)
+
+
+@patch.object(TestTransport, 'deliver', return_value='<sent@localhost>')
+@patch.object(TestTransport, 'prepare_message', return_value=QUEUED_MESSAGE)
+@patch.object(TestTransport, 'query', return_value=YES)
+@at_install(False)
+@post_install(True)
+class TestQueuedSending(TransportCase):
+    def setUp(self):
+        super(TestQueuedSending, self).setUp()
+        import shutil
+        import tempfile
+        from xoeuf.odoo.addons.xopgi_mail_threads import mail_queue
+        from xoeuf.odoo.addons.xopgi_mail_threads.mail_server import (
+            SEND_MODE_PARAM,
+            QUEUED_MODE,
+        )
+        self.env['ir.config_parameter'].sudo().set_param(SEND_MODE_PARAM,
+                                                         QUEUED_MODE)
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.queue = mail_queue.MailQueue(self.env.cr.dbname,
+                                          mail_queue.MailSpool(path),
+                                          deliver=None)
+        self.hooks = []
+        for patcher in (
+                patch.object(mail_queue, 'get_mail_queue',
+                             return_value=self.queue),
+                patch.object(self.queue, 'start'),
+                patch.object(self.env.cr, 'after', create=True,
+                             side_effect=self._after)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _after(self, event, func):
+        self.hooks.append((event, func))
+
+    def _commit(self):
+        for event, func in self.hooks:
+            if event == 'commit':
+                func()
+
+    def test_queued_on_commit(self, query, prepare_message, deliver):
+        message = email.message_from_string(MESSAGE)
+        # Odoo 12's `mail.mail` passes its SMTP connection.
+        result = self.env['ir.mail_server'].send_email(
+            message, smtp_session=object()
+        )
+        self.assertEqual(result, '<queued@localhost>')
+        self.assertTrue(prepare_message.called)
+        self.assertFalse(deliver.called)
+        # Nothing is queued until the transaction is committed.
+        self.assertEqual(self.queue.spool.stats()['depth'], 0)
+        self._commit()
+        self.assertEqual(self.queue.spool.stats()['depth'], 1)
+        _, meta, _ = self.queue.spool.claim()
+        self.assertEqual(meta['message_id'], '<queued@localhost>')
+        self.assertNotIn('smtp_session', meta['kw'])
+
+
+@patch.object(TestTransport, 'memoize_query', True)
+@patch.object(TestTransport, 'deliver', return_value='<sent@localhost>')
+@patch.object(TestTransport, 'prepare_message', return_value=PREPARED_MESSAGE)
+@patch.object(TestTransport, 'query', return_value=YES)
+@at_install(False)
+@post_install(True)
+class TestMemoizedTransportQuery(TransportCase):
+    def setUp(self):
+        super(TestMemoizedTransportQuery, self).setUp()
+        from xoeuf.odoo.addons.xopgi_mail_threads.transports import (
+            get_query_cache,
+        )
+        get_query_cache().invalidate()
+
+    def test_query_is_cached_by_signature(self, query, prepare_message,
+                                          deliver):
+        MailServer = self.env['ir.mail_server']
+        before = MailServer.get_transport_cache_stats()
+        for _ in range(3):
+            MailServer.send_email(email.message_from_string(MESSAGE))
+        self.assertEqual(query.call_count, 1)
+        self.assertEqual(deliver.call_count, 3)
+        other = email.message_from_string(MESSAGE)
+        other.replace_header('To', 'someone@example.com')
+        MailServer.send_email(other)
+        self.assertEqual(query.call_count, 2)
+        after = MailServer.get_transport_cache_stats()
+        self.assertEqual(after['hits'] - before['hits'], 2)
+
+    def test_failures_are_not_cached(self, query, prepare_message, deliver):
+        MailServer = self.env['ir.mail_server']
+        query.side_effect = [ValueError(), YES]
+        MailServer.send_email(email.message_from_string(MESSAGE))
+        self.assertFalse(deliver.called)
+        MailServer.send_email(email.message_from_string(MESSAGE))
+        self.assertEqual(query.call_count, 2)
+        self.assertTrue(deliver.called)
+
+
+@at_install(False)
+@post_install(True)
+class TestGetMessageObjects(RouterCase):
+    def test_message_and_references_found(self):
+        Messages = self.env['mail.message']
+        first = Messages.create({'message_id': '<first@localhost>'})
+        second = Messages.create({'message_id': '<second@localhost>'})
+        current = Messages.create({'message_id': '<current@localhost>'})
+        message = email.message_from_string(MESSAGE)
+        message['Message-Id'] = '<current@localhost>'
+        message['References'] = ('<first@localhost>\n '
+                                 '<missing@localhost> <second@localhost>')
+        msg, refs = MailTransportRouter.get_message_objects(Messages, message)
+        self.assertEqual(msg, current)
+        self.assertEqual(list(refs), [first, second])
+        # The second lookup is served from the cache.
+        with patch.object(type(self.env.cr), 'execute') as execute:
+            MailTransportRouter.get_message_objects(Messages, message)
+        execute.assert_not_called()
+
+    def test_deleted_messages_are_forgotten(self):
+        Messages = self.env['mail.message']
+        message_id = '<deleted@localhost>'
+        message = Messages.create({'message_id': message_id})
+        self.assertEqual(Messages._find_by_message_ids([message_id]),
+                         {message_id: (message.id, )})
+        message.unlink()
+        self.assertEqual(Messages._find_by_message_ids([message_id]),
+                         {message_id: ()})
+
+
+@at_install(False)
+@post_install(True)
+class TestFindThread(RouterCase):
+    def test_find_thread(self):
+        partner = self.env['res.partner'].create({'name': 'Thread'})
+        self.env['mail.message'].create({
+            'message_id': '<thread@localhost>',
+            'model': 'res.partner',
+            'res_id': partner.id,
+        })
+        message = email.message_from_string(MESSAGE)
+        message['References'] = '<thread@localhost> <missing@localhost>'
+        self.assertEqual(MailRouter.find_thread(self.env['mail.thread'],
+                                                message),
+                         ('res.partner', partner.id))
+
+    def test_find_thread_uses_the_cache(self):
+        from xoeuf.odoo.addons.xopgi_mail_threads.utils import \
+            get_thread_cache
+        get_thread_cache().update(self.env.cr.dbname, {
+            '<cached@localhost>': ('res.partner', 1)
+        })
+        message = email.message_from_string(MESSAGE)
+        message['In-Reply-To'] = '<cached@localhost>'
+        with patch.object(type(self.env.cr), 'execute') as execute:
+            thread = MailRouter.find_thread(self.env['mail.thread'], message)
+        execute.assert_not_called()
+        self.assertEqual(thread, ('res.partner', 1))
+        get_thread_cache().invalidate(self.env.cr.dbname)
+
+    def test_thread_cache_entries_expire(self):
+        from xoeuf.odoo.addons.xopgi_mail_threads.utils import ThreadCache
+        dbname = self.env.cr.dbname
+        thread = ('res.partner', 1)
+        cache = ThreadCache(ttl=60)
+        cache.update(dbname, {'<cached@localhost>': thread})
+        self.assertEqual(cache.get(dbname, '<cached@localhost>'), thread)
+        cache = ThreadCache(ttl=-1)
+        cache.update(dbname, {'<cached@localhost>': thread})
+        self.assertIsNone(cache.get(dbname, '<cached@localhost>'))
+
+
+@at_install(False)
+@post_install(True)
+class TestAutomaticResponses(RouterCase):
+    def test_auto_replies_are_ignored_before_routing(self):
+        from xoeuf.odoo.addons.xopgi_mail_threads.stdroutes import \
+            IGNORE_MESSAGE_ROUTE_MODEL
+        self.env['ir.config_parameter'].set_param(
+            'xopgi_mail_threads.automatic_responses.auto_replied', 'ignore'
+        )
+        Threads = self.env['mail.thread']
+        counters = Threads.get_automatic_response_counters()
+        ignored = counters.get('auto_replied', {}).get('ignore', 0)
+        message = email.message_from_string(MESSAGE)
+        message['Auto-Submitted'] = 'auto-replied'
+        with patch.object(TestRouter, 'query') as query:
+            routes = Threads.message_route(message, {})
+        query.assert_not_called()
+        self.assertEqual([route[0] for route in routes],
+                         [IGNORE_MESSAGE_ROUTE_MODEL])
+        counters = Threads.get_automatic_response_counters()
+        self.assertEqual(counters['auto_replied']['ignore'], ignored + 1)
+
+    def test_routers_are_queried_once(self):
+        self.env['ir.config_parameter'].set_param(
+            'xopgi_mail_threads.automatic_responses.auto_replied', 'routers'
+        )
+        message = email.message_from_string(MESSAGE)
+        message['Auto-Submitted'] = 'auto-replied'
+        with patch.object(TestRouter, 'query', return_value=NO) as query, \
+                patch(MAIL_THREADS + '.log_message_failure') as log:
+            routes = self.env['mail.thread'].message_route(message, {})
+        # The routers found nothing; the message gets Odoo's routes.
+        self.assertEqual(query.call_count, 1)
+        self.assertTrue(routes)
+        # Finding no routes with the routers is not a warning.
+        log.assert_not_called()
+
+    def test_pre_routed_messages_are_routed_once(self):
+        self.env['ir.config_parameter'].set_param(
+            'xopgi_mail_threads.automatic_responses.auto_replied', 'routers'
+        )
+        message = email.message_from_string(MESSAGE)
+        message['Auto-Submitted'] = 'auto-replied'
+        message['Message-Id'] = '<pre-routed@localhost>'
+        Threads = self.env['mail.thread']
+        with patch.object(TestRouter, 'headers_only', True), \
+                patch.object(TestRouter, 'query', return_value=NO) as query:
+            Threads.message_process('res.partner', message.as_string())
+        # The routes found with the headers are not looked for again when
+        # the full message is routed.
+        self.assertEqual(query.call_count, 1)
+
+    def test_ignored_bounces_are_not_fully_parsed(self):
+        from .test_dsn import DSN
+        self.env['ir.config_parameter'].set_param(
+            'xopgi_mail_threads.automatic_responses.delivery_status',
+            'ignore'
+        )
+        Threads = self.env['mail.thread']
+        Stats = self.env['xopgi.mail_threads.bounce_stat']
+        raw = DSN.replace(b'\n\n', b'\nMessage-Id: <dsn@localhost>\n\n', 1)
+        with patch.object(type(Threads), 'message_parse') as message_parse:
+            result = Threads.message_process('bouncer', raw)
+        message_parse.assert_not_called()
+        self.assertFalse(result)
+        stat = Stats.search([('address', '=', 'nobody@example.com')])
+        self.assertEqual(stat.hard_bounces, 1)
+
+    def test_delivery_reports_are_written_once_routed(self):
+        from xoeuf.odoo.addons.xopgi_mail_threads.parsing import \
+            parse_message
+        from .test_dsn import DSN
+        self.env['ir.config_parameter'].set_param(
+            'xopgi_mail_threads.automatic_responses.delivery_status',
+            'ignore'
+        )
+        Stats = self.env['xopgi.mail_threads.bounce_stat']
+        message = parse_message(DSN).message
+        with patch.object(type(Stats), '_write_reports') as write_reports:
+            self.env['mail.thread'].message_route(message, {})
+        self.assertEqual(write_reports.call_count, 1)
+
+
+@at_install(False)
+@post_install(True)
+class TestBounceStats(TransportCase):
+    def test_bounces_suppress_addresses(self):
+        from xoeuf.odoo.addons.xopgi_mail_threads import bounce_stats
+        from .test_dsn import DSN_REPORTS
+        Stats = self.env['xopgi.mail_threads.bounce_stat']
+        Stats._write_reports(DSN_REPORTS)
+        Stats._write_reports(DSN_REPORTS)
+        stat = Stats.search([('address', '=', 'nobody@example.com')])
+        self.assertEqual((stat.hard_bounces, stat.soft_bounces), (2, 0))
+        self.assertEqual(Stats.search([('address', '=', 'later@example.com')])
+                         .soft_bounces, 2)
+        self.env['ir.config_parameter'].set_param(
+            bounce_stats.SUPPRESSION_THRESHOLD_PARAM, '2'
+        )
+        bounce_stats._suppressed.clear()
+        message = email.message_from_string(MESSAGE)
+        message.replace_header('To', 'nobody@example.com')
+        with self.assertRaises(Exception) as context:
+            self.env['ir.mail_server'].send_email(message)
+        self.assertIn('nobody@example.com', '%s' % (context.exception, ))
+        bounce_stats._suppressed.clear()
+
+
+@patch.object(TestRouter, 'query', return_value=YES)
+@at_install(False)
+@post_install(True)
+class TestIgnoreRoute(RouterCase):
+    def test_ignore_route_does_not_insert(self, query):
+        from xoeuf.odoo.addons.xopgi_mail_threads.utils import \
+            create_ignore_route
+
+        def apply(obj, routes, message, data=None):
+            routes[:] = [create_ignore_route(message)]
+
+        cr = self.env.cr
+        with patch.object(TestRouter, 'apply', side_effect=apply), \
+                patch.object(cr, 'execute', wraps=cr.execute) as execute:
+            result = self.env['mail.thread'].message_process(
+                'bouncer', MESSAGE.replace('\n\n', '\nMessage-Id: '
+                                           '<ignored@localhost>\n\n', 1)
+            )
+        self.assertFalse(result)
+        inserts = [
+            args[0] for args, _ in execute.call_args_list
+            if 'insert into' in str(args[0]).lower()
+        ]
+        self.assertEqual(inserts, [])
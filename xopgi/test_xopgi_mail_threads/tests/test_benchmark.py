@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import email
+import unittest
+
+from xoeuf.odoo.addons.test_xopgi_mail_threads.benchmark import (
+    CORPORA,
+    compare,
+    generate_corpus,
+    percentile,
+)
+from xoeuf.odoo.addons.xopgi_mail_threads.utils import (
+    get_automatic_response_type,
+)
+
+
+def message_from_bytes(raw):
+    parse = getattr(email, 'message_from_bytes', email.message_from_string)
+    return parse(raw)
+
+
+class TestCorpora(unittest.TestCase):
+    def test_corpora_are_deterministic(self):
+        for kind in CORPORA:
+            self.assertEqual(generate_corpus(kind, 2, seed=1),
+                             generate_corpus(kind, 2, seed=1))
+
+    def test_corpora(self):
+        dsn, = generate_corpus('dsn', 1)
+        self.assertEqual(message_from_bytes(dsn).get_content_type(),
+                         'multipart/report')
+        reply, = generate_corpus('auto_reply', 1)
+        self.assertTrue(get_automatic_response_type(
+            message_from_bytes(reply)
+        ))
+        many, = generate_corpus('many_recipients', 1)
+        self.assertGreater(message_from_bytes(many)['To'].count('@'), 100)
+
+
+class TestCompare(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 99), 7)
+
+    def test_compare(self):
+        def result(p50, rate):
+            return dict(results=dict(reply=dict(route=dict(
+                count=10, p50_ms=p50, p99_ms=p50, msgs_per_sec=rate,
+                queries_per_msg=1,
+            ))))
+
+        self.assertEqual(compare(result(1, 100), result(1.1, 95)), [])
+        self.assertEqual(
+            compare(result(1, 100), result(2, 50)),
+            [('reply', 'route', 'msgs_per_sec', 100, 50),
+             ('reply', 'route', 'p50_ms', 1, 2),
+             ('reply', 'route', 'p99_ms', 1, 2)]
+        )
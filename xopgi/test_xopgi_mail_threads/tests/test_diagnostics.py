@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import json
+import unittest
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from xoeuf.odoo.addons.xopgi_mail_threads.diagnostics import (
+    summarize_message,
+    RateLimiter,
+)
+
+
+def make_message(attachment_size):
+    message = MIMEMultipart()
+    message['From'] = 'sender@example.com'
+    message['To'] = 'receiver@example.com'
+    message['Subject'] = 'X' * 1000
+    message.attach(MIMEText('Hi.'))
+    attachment = MIMEApplication(b'\0' * attachment_size)
+    attachment.add_header('Content-Disposition', 'attachment',
+                          filename='data.bin')
+    message.attach(attachment)
+    return message
+
+
+class TestSummarizeMessage(unittest.TestCase):
+    def test_summary_size_is_bounded(self):
+        small = json.dumps(summarize_message(make_message(1024)))
+        big = json.dumps(summarize_message(make_message(1024 * 1024)))
+        self.assertLess(len(big), 2048)
+        self.assertLess(abs(len(big) - len(small)), 16)
+
+    def test_summary(self):
+        summary = summarize_message(make_message(1024))
+        parts = summary['parts']
+        self.assertEqual(parts['content_type'], 'multipart/mixed')
+        self.assertEqual(
+            [p['content_type'] for p in parts['parts']],
+            ['text/plain', 'application/octet-stream']
+        )
+        self.assertEqual(parts['parts'][1]['filename'], 'data.bin')
+        self.assertGreater(summary['size'], 1024)
+        self.assertNotIn('body', summary)
+        subject = dict(summary['headers'])['Subject']
+        self.assertLess(len(subject), 300)
+
+    def test_hash_depends_on_content(self):
+        self.assertNotEqual(summarize_message(make_message(1))['sha256'],
+                            summarize_message(make_message(2))['sha256'])
+
+    def test_full_body_is_opt_in(self):
+        message = make_message(10)
+        summary = summarize_message(message, include_body=True)
+        self.assertEqual(summary['body'], message.as_string())
+
+
+class TestRateLimiter(unittest.TestCase):
+    def test_rate_limit(self):
+        limiter = RateLimiter(rate=2, period=3600)
+        self.assertEqual(limiter.allow('a'), (True, 0))
+        self.assertEqual(limiter.allow('a'), (True, 0))
+        self.assertEqual(limiter.allow('a'), (False, 0))
+        self.assertEqual(limiter.allow('b'), (True, 0))
+        limiter.period = 0
+        self.assertEqual(limiter.allow('a'), (True, 1))
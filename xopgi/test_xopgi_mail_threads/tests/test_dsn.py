@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import email
+import unittest
+from io import BytesIO
+
+from xoeuf.odoo.addons.xopgi_mail_threads.dsn import (
+    parse_reports,
+    parse_reports_stream,
+    DeliveryReport,
+)
+
+
+DSN = b'''From: MAILER-DAEMON@example.com
+To: sender@localhost
+Subject: Undelivered Mail Returned to Sender
+Content-Type: multipart/report; report-type=delivery-status;
+\tboundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain
+
+This is the mail system.
+
+--BOUNDARY
+Content-Type: message/delivery-status
+
+Reporting-MTA: dns; mx.example.com
+
+Final-Recipient: rfc822; Nobody@Example.com
+Action: failed
+Status: 5.1.1
+Diagnostic-Code: smtp; 550 5.1.1 <nobody@example.com>:
+    Recipient address rejected
+
+Final-Recipient: rfc822; later@example.com
+Action: delayed
+Status: 4.4.1
+
+--BOUNDARY
+Content-Type: message/rfc822
+
+Message-Id: <original@localhost>
+From: sender@localhost
+To: nobody@example.com
+
+The original message.
+
+--BOUNDARY--
+'''
+
+ARF = b'''From: abuse@example.com
+To: sender@localhost
+Subject: Abuse report
+Content-Type: multipart/report; report-type=feedback-report;
+\tboundary="BOUNDARY"
+
+--BOUNDARY
+Content-Type: text/plain
+
+This is an abuse report.
+
+--BOUNDARY
+Content-Type: message/feedback-report
+
+Feedback-Type: abuse
+User-Agent: SomeGenerator/1.0
+Version: 1
+Original-Rcpt-To: <someone@example.com>
+
+--BOUNDARY
+Content-Type: text/rfc822-headers
+
+Message-Id: <original@localhost>
+From: sender@localhost
+
+--BOUNDARY--
+'''
+
+DSN_REPORTS = [
+    DeliveryReport('nobody@example.com', 'failed', '5.1.1',
+                   '<original@localhost>',
+                   'smtp; 550 5.1.1 <nobody@example.com>: '
+                   'Recipient address rejected'),
+    DeliveryReport('later@example.com', 'delayed', '4.4.1',
+                   '<original@localhost>', None),
+]
+
+ARF_REPORTS = [
+    DeliveryReport('someone@example.com', 'complained', 'abuse',
+                   '<original@localhost>', None),
+]
+
+
+def message_from_bytes(raw):
+    parse = getattr(email, 'message_from_bytes', email.message_from_string)
+    return parse(raw)
+
+
+class TestParseReports(unittest.TestCase):
+    def test_dsn(self):
+        self.assertEqual(parse_reports(message_from_bytes(DSN)), DSN_REPORTS)
+
+    def test_dsn_stream(self):
+        self.assertEqual(parse_reports_stream(BytesIO(DSN)), DSN_REPORTS)
+
+    def test_arf(self):
+        self.assertEqual(parse_reports(message_from_bytes(ARF)), ARF_REPORTS)
+
+    def test_arf_stream(self):
+        self.assertEqual(parse_reports_stream(BytesIO(ARF)), ARF_REPORTS)
+
+    def test_not_a_report(self):
+        message = b'From: a@example.com\nSubject: Hi\n\nHi.\n'
+        self.assertEqual(parse_reports(message_from_bytes(message)), [])
+        self.assertEqual(parse_reports_stream(BytesIO(message)), [])
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import unittest
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from xoeuf.odoo.tools import config
+from xoeuf.odoo.addons.xopgi_mail_threads.controllers import (
+    METRICS_TOKEN_OPTION,
+    _can_read_metrics,
+)
+from xoeuf.odoo.addons.xopgi_mail_threads.instrumentation import (
+    BUCKETS,
+    ROUTER,
+    export_prometheus,
+    get_metrics,
+    get_name,
+    observe,
+    reset_metrics,
+    timed,
+)
+
+DB = 'test-instrumentation'
+
+
+class Router(object):
+    @classmethod
+    def query(cls, obj, message):
+        return message
+
+    @classmethod
+    def apply(cls, obj, routes, message, data=None):
+        raise ValueError(message)
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        reset_metrics(DB)
+
+    def tearDown(self):
+        reset_metrics(DB)
+
+    def test_calls_and_failures(self):
+        self.assertEqual(timed(DB, ROUTER, Router, 'query', None, 1), 1)
+        with self.assertRaises(ValueError):
+            timed(DB, ROUTER, Router, 'apply', None, [], 2)
+        metrics = get_metrics(DB)
+        name = get_name(Router)
+        query = metrics[(DB, ROUTER, name, 'query')]
+        apply = metrics[(DB, ROUTER, name, 'apply')]
+        self.assertEqual((query['calls'], query['failures']), (1, 0))
+        self.assertEqual((apply['calls'], apply['failures']), (1, 1))
+
+    def test_histogram(self):
+        for elapsed in (0.0001, 0.003, 0.003, 100):
+            observe(DB, ROUTER, Router, 'query', elapsed)
+        metric, = get_metrics(DB).values()
+        buckets = dict(metric['buckets'])
+        self.assertEqual(len(buckets), len(BUCKETS) + 1)
+        self.assertEqual(buckets[0.001], 1)
+        self.assertEqual(buckets[0.005], 3)
+        self.assertEqual(buckets[10.0], 3)
+        self.assertEqual(buckets[float('inf')], 4)
+
+    def test_prometheus(self):
+        observe(DB, ROUTER, Router, 'query', 0.002, failed=True)
+        text = export_prometheus(DB)
+        labels = 'db="%s",kind="router",name="%s",method="query"' % (
+            DB, get_name(Router)
+        )
+        lines = text.splitlines()
+        self.assertIn('xopgi_mail_threads_calls_total{%s} 1' % labels, lines)
+        self.assertIn('xopgi_mail_threads_failures_total{%s} 1' % labels,
+                      lines)
+        self.assertIn(
+            'xopgi_mail_threads_duration_seconds_bucket{%s,le="+Inf"} 1'
+            % labels,
+            lines
+        )
+        self.assertIn('# TYPE xopgi_mail_threads_duration_seconds histogram',
+                      lines)
+
+
+class HTTPRequest(object):
+    def __init__(self, remote_addr='127.0.0.1', **headers):
+        self.remote_addr = remote_addr
+        self.headers = headers
+
+
+class TestMetricsAccess(unittest.TestCase):
+    def test_local_clients_without_token(self):
+        with patch.dict(config.options, {METRICS_TOKEN_OPTION: None,
+                                         'proxy_mode': False}):
+            self.assertTrue(_can_read_metrics(HTTPRequest()))
+            self.assertFalse(_can_read_metrics(HTTPRequest('10.0.0.1')))
+            self.assertFalse(_can_read_metrics(
+                HTTPRequest(**{'X-Forwarded-For': '10.0.0.1'})
+            ))
+        with patch.dict(config.options, {METRICS_TOKEN_OPTION: None,
+                                         'proxy_mode': True}):
+            self.assertFalse(_can_read_metrics(HTTPRequest()))
+
+    def test_token(self):
+        with patch.dict(config.options, {METRICS_TOKEN_OPTION: 's3cr3t'}):
+            self.assertFalse(_can_read_metrics(HTTPRequest()))
+            self.assertFalse(_can_read_metrics(
+                HTTPRequest('10.0.0.1', Authorization='Bearer wrong')
+            ))
+            self.assertTrue(_can_read_metrics(
+                HTTPRequest('10.0.0.1', Authorization='Bearer s3cr3t')
+            ))
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+import os
+import shutil
+import asyncio
+import smtplib
+import tempfile
+import threading
+import unittest
+from contextlib import contextmanager
+from io import BytesIO
+from unittest.mock import patch
+
+from xoeuf import odoo
+from xoeuf.odoo.addons.xopgi_mail_threads.lmtp import (
+    LMTPServer,
+    NO_ROUTE,
+    OK,
+    OdooDelivery,
+    TEMPORARY_FAILURE,
+)
+
+from ..router import TestRouter
+from .test_all import NO, RouterCase, at_install, post_install
+
+MESSAGE = b'''From: someone@localhost
+To: alias@localhost
+Subject: Over LMTP
+
+.A line starting with a dot.
+'''.replace(b'\n', b'\r\n')
+
+
+class TestLMTPServer(unittest.TestCase):
+    def setUp(self):
+        self.delivered = []
+        self.transactions = 0
+        self.clients = []
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'lmtp.sock')
+        self.loop = asyncio.new_event_loop()
+        self.server = LMTPServer(self.deliver, workers=2, max_size=10000,
+                                 hostname='lmtp.test')
+        self.loop.run_until_complete(self.server.start(path=self.path))
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        asyncio.run_coroutine_threadsafe(self.server.stop(),
+                                         self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        shutil.rmtree(self.folder)
+
+    def deliver(self, sender, recipients, fileobj):
+        self.transactions += 1
+        content = fileobj.read()
+        replies = []
+        for recipient in recipients:
+            if recipient.startswith('crash'):
+                raise RuntimeError(recipient)
+            elif recipient.startswith('fail'):
+                replies.append(TEMPORARY_FAILURE)
+            elif recipient.startswith('unknown'):
+                replies.append(NO_ROUTE)
+            else:
+                self.delivered.append((sender, recipient, content))
+                replies.append(OK)
+        return replies
+
+    def client(self):
+        client = smtplib.LMTP(self.path)
+        self.clients.append(client)
+        code, _ = client.ehlo('client.test')
+        self.assertEqual(code, 250)
+        return client
+
+    def send(self, client, recipients, message=MESSAGE):
+        # `smtplib.LMTP.sendmail` reads a single reply after DATA; LMTP
+        # sends one for each recipient.
+        client.mail('sender@localhost')
+        for recipient in recipients:
+            self.assertEqual(client.rcpt(recipient)[0], 250)
+        replies = [client.data(message)]
+        replies.extend(client.getreply() for _ in recipients[1:])
+        return [code for code, _ in replies]
+
+    def test_reply_for_each_recipient(self):
+        client = self.client()
+        self.assertIn('enhancedstatuscodes', client.esmtp_features)
+        codes = self.send(client, ['alias@localhost', 'unknown@localhost',
+                                   'fail@localhost', 'other@localhost'])
+        self.assertEqual(codes, [250, 550, 451, 250])
+        self.assertEqual(
+            [(sender, recipient) for sender, recipient, _ in self.delivered],
+            [('sender@localhost', 'alias@localhost'),
+             ('sender@localhost', 'other@localhost')]
+        )
+        self.assertEqual(self.delivered[0][2], MESSAGE)
+        self.assertEqual(self.transactions, 1)
+        self.assertEqual(client.quit()[0], 221)
+
+    def test_errors_fail_all_recipients(self):
+        client = self.client()
+        codes = self.send(client, ['alias@localhost', 'crash@localhost'])
+        self.assertEqual(codes, [451, 451])
+
+    def test_several_transactions_and_clients(self):
+        clients = [self.client() for _ in range(3)]
+        for client in clients:
+            self.assertEqual(self.send(client, ['alias@localhost']), [250])
+            self.assertEqual(self.send(client, ['alias@localhost']), [250])
+        self.assertEqual(len(self.delivered), 6)
+
+    def test_too_big(self):
+        client = self.client()
+        message = MESSAGE + b'x' * 20000 + b'\r\n'
+        codes = self.send(client, ['alias@localhost', 'other@localhost'],
+                          message=message)
+        self.assertEqual(codes, [552, 552])
+        self.assertEqual(self.delivered, [])
+        # The session goes on.
+        self.assertEqual(self.send(client, ['alias@localhost']), [250])
+
+    def test_bad_sequences(self):
+        client = smtplib.LMTP(self.path)
+        self.clients.append(client)
+        self.assertEqual(client.helo('client.test')[0], 500)
+        self.assertEqual(client.mail('sender@localhost')[0], 503)
+        client.ehlo('client.test')
+        self.assertEqual(client.rcpt('alias@localhost')[0], 503)
+        self.assertEqual(client.docmd('DATA')[0], 503)
+        self.assertEqual(client.docmd('FOO')[0], 500)
+        self.assertEqual(client.mail('sender@localhost')[0], 250)
+        self.assertEqual(client.mail('sender@localhost')[0], 503)
+        self.assertEqual(client.rset()[0], 250)
+        self.assertEqual(client.noop()[0], 250)
+        self.assertEqual(self.delivered, [])
+
+
+class Registry(object):
+    # Gives the cursor of the test to `OdooDelivery`.
+    def __init__(self, cr):
+        self.cr = cr
+
+    def check_signaling(self):
+        return self
+
+    @contextmanager
+    def cursor(self):
+        yield self.cr
+
+
+@at_install(False)
+@post_install(True)
+class TestOdooDelivery(RouterCase):
+    def deliver(self, delivery, recipients, message=MESSAGE):
+        with patch.object(odoo, 'registry', return_value=Registry(self.cr)):
+            return delivery('sender@localhost', recipients,
+                            BytesIO(message))
+
+    def get_partners(self):
+        return self.env['res.partner'].search([('name', '=', 'Over LMTP')])
+
+    def test_delivered(self):
+        delivery = OdooDelivery(self.cr.dbname, model='res.partner')
+        with patch.object(TestRouter, 'query', return_value=NO):
+            replies = self.deliver(delivery, ['alias@localhost'])
+        self.assertEqual(replies, [OK])
+        self.assertEqual(len(self.get_partners()), 1)
+
+    def test_recipients_only_in_the_envelope(self):
+        # The second recipient is in neither the To nor the Cc (e.g a Bcc),
+        # and the message has no Message-Id: it's processed once and routed
+        # to the alias of that recipient.
+        model = self.env['ir.model'].search([('model', '=', 'res.partner')])
+        self.env['mail.alias'].create({'alias_name': 'lmtp-bcc',
+                                       'alias_model_id': model.id})
+        delivery = OdooDelivery(self.cr.dbname)
+        with patch.object(TestRouter, 'query', return_value=NO):
+            replies = self.deliver(delivery, ['alias@localhost',
+                                              'lmtp-bcc@localhost'])
+        self.assertEqual(replies, [OK, OK])
+        self.assertEqual(len(self.get_partners()), 1)
+
+    def test_no_route(self):
+        delivery = OdooDelivery(self.cr.dbname)
+        with patch.object(TestRouter, 'query', return_value=NO):
+            replies = self.deliver(delivery, ['nobody@localhost',
+                                              'other@localhost'])
+        self.assertEqual(replies, [NO_ROUTE, NO_ROUTE])
+
+    def test_other_errors_are_raised(self):
+        delivery = OdooDelivery(self.cr.dbname, model='res.partner')
+        Threads = type(self.env['mail.thread'])
+        with patch.object(Threads, 'message_process',
+                          side_effect=ValueError('Invalid value')):
+            with self.assertRaises(ValueError):
+                self.deliver(delivery, ['alias@localhost'])
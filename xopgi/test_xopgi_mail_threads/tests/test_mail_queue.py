@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import shutil
+import tempfile
+import unittest
+
+from xoeuf.odoo.addons.xopgi_mail_threads.mail_queue import (
+    MailSpool,
+    MailQueue,
+)
+
+
+MESSAGE = b'''From: sender@example.com
+To: receiver@example.com
+Message-Id: <queued@localhost>
+Subject: Queued
+
+Hi.
+'''
+
+
+class TestMailQueue(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spool = MailSpool(self.path)
+        self.delivered = []
+        self.failures = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def deliver(self, dbname, meta, raw):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('Temporary failure')
+        self.delivered.append((meta['message_id'], raw))
+
+    def get_queue(self, **kwargs):
+        return MailQueue('db', self.spool, self.deliver, **kwargs)
+
+    def test_spool_is_durable(self):
+        self.spool.put(MESSAGE, dict(message_id='<queued@localhost>'))
+        spool = MailSpool(self.path)
+        self.assertEqual(spool.stats()['depth'], 1)
+        name, meta, raw = spool.claim()
+        self.assertEqual(raw, MESSAGE)
+        self.assertEqual(meta['message_id'], '<queued@localhost>')
+        self.assertIsNone(spool.claim())
+
+    def test_deliver(self):
+        queue = self.get_queue()
+        self.spool.put(MESSAGE, dict(message_id='<queued@localhost>'))
+        queue.process(*self.spool.claim())
+        self.assertEqual(self.delivered, [('<queued@localhost>', MESSAGE)])
+        stats = queue.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['delivered'], 1)
+        self.assertGreater(stats['throughput'], 0)
+
+    def test_retry_with_backoff(self):
+        queue = self.get_queue(backoff=0)
+        self.failures = 1
+        self.spool.put(MESSAGE, dict(message_id='<queued@localhost>'))
+        queue.process(*self.spool.claim())
+        self.assertEqual(self.delivered, [])
+        self.assertEqual(queue.stats()['depth'], 1)
+        name, meta, raw = self.spool.claim()
+        self.assertEqual(meta['attempts'], 1)
+        queue.process(name, meta, raw)
+        self.assertEqual(len(self.delivered), 1)
+
+    def test_retries_are_delayed(self):
+        queue = self.get_queue(backoff=3600)
+        self.failures = 1
+        self.spool.put(MESSAGE, dict(message_id='<queued@localhost>'))
+        queue.process(*self.spool.claim())
+        self.assertIsNone(self.spool.claim())
+        self.assertEqual(queue.stats()['depth'], 1)
+
+    def test_give_up(self):
+        queue = self.get_queue(backoff=0, max_attempts=2)
+        self.failures = 2
+        self.spool.put(MESSAGE, dict(message_id='<queued@localhost>'))
+        queue.process(*self.spool.claim())
+        queue.process(*self.spool.claim())
+        self.assertIsNone(self.spool.claim())
+        stats = queue.stats()
+        self.assertEqual(stats['depth'], 0)
+        self.assertEqual(stats['failed'], 1)
+
+    def test_recover_stale_entries(self):
+        self.spool.put(MESSAGE, dict(message_id='<queued@localhost>'))
+        self.spool.claim()   # and the process dies
+        self.assertIsNone(self.spool.claim())
+        self.spool.recover(stale_timeout=-1)
+        self.assertIsNotNone(self.spool.claim())
@@ -10,11 +10,64 @@ from __future__ import (division as _py3_division,
                         print_function as _py3_print,
                         absolute_import as _py3_abs_import)
 
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
 from xoeuf.modules import get_caller_addon
 from xoeuf.odoo.modules.module import get_resource_path
 from xoeuf.odoo.tests.common import TransactionCase
 
 
+MESSAGE = b'''Message-Id: <raw-email@localhost>
+To: default-xopgi-mailthread-model@localhost
+From: someone@localhost
+Subject: Incomming Message
+
+This is a message.
+
+'''
+
+
+class QueryRecorder(object):
+    '''Record the queries and the size of the rows fetched by a cursor.'''
+    def __init__(self, cr):
+        self.cr = cr
+        self.queries = []
+        self.size = 0
+
+    def _execute(self, query, *args, **kwargs):
+        self.queries.append(str(query))
+        return self._original['execute'](query, *args, **kwargs)
+
+    def _fetch(self, name):
+        def fetch(*args, **kwargs):
+            result = self._original[name](*args, **kwargs)
+            rows = result if isinstance(result, list) else [result]
+            for row in rows:
+                values = row.values() if isinstance(row, dict) else row or ()
+                self.size += sum(len(v) for v in values
+                                 if isinstance(v, (bytes, str, memoryview)))
+            return result
+        return fetch
+
+    def __enter__(self):
+        names = ('fetchall', 'dictfetchall', 'fetchone', 'dictfetchone')
+        self._original = {name: getattr(self.cr, name)
+                          for name in names + ('execute', )}
+        self._patches = [patch.object(self.cr, 'execute', self._execute)]
+        self._patches.extend(patch.object(self.cr, name, self._fetch(name))
+                             for name in names)
+        for p in self._patches:
+            p.start()
+        return self
+
+    def __exit__(self, *args):
+        for p in self._patches:
+            p.stop()
+
+
 class TestRawEmail(TransactionCase):
     def test_attachment_without_a_content_type_with_NUL(self):
         path = get_resource_path(
@@ -27,3 +80,74 @@ class TestRawEmail(TransactionCase):
                 'bouncer',
                 f.read()
             )
+
+    def test_raw_email_in_filestore(self):
+        from xoeuf.odoo.addons.xopgi_mail_threads.mail_messages import \
+            RAW_EMAIL_STORAGE_PARAM
+        self.env['ir.config_parameter'].set_param(RAW_EMAIL_STORAGE_PARAM,
+                                                  'filestore')
+        self.env['mail.thread'].message_process('bouncer', MESSAGE)
+        message = self.env['mail.message'].search(
+            [('message_id', '=', '<raw-email@localhost>')]
+        )
+        self.assertTrue(message.raw_email_ref)
+        self.assertFalse(message.raw_email)
+        self.assertIn(b'This is a message.', message.get_raw_email())
+
+    def test_migrate_raw_emails(self):
+        self.env['mail.thread'].message_process('bouncer', MESSAGE)
+        message = self.env['mail.message'].search(
+            [('message_id', '=', '<raw-email@localhost>')]
+        )
+        self.assertFalse(message.raw_email_ref)
+        raw_email = message.get_raw_email()
+        self.env['mail.message']._migrate_raw_emails(commit=False)
+        self.assertTrue(message.raw_email_ref)
+        self.assertEqual(message.get_raw_email(), raw_email)
+
+    def test_decode_old_raw_text_rows(self):
+        from xoeuf.odoo.addons.xopgi_mail_threads.mail_messages import (
+            _decode_column,
+            encodebytes,
+        )
+        self.assertEqual(_decode_column(encodebytes(MESSAGE)), MESSAGE)
+        # 16 characters of the alphabet of base64: without validation it's
+        # decoded into garbage.
+        raw_text = b'From: a\n\nHi+there/ok\n'
+        self.assertEqual(_decode_column(raw_text), raw_text)
+
+    def test_raw_email_keeps_original_bytes(self):
+        self.env['mail.thread'].message_process('bouncer', MESSAGE)
+        message = self.env['mail.message'].search(
+            [('message_id', '=', '<raw-email@localhost>')]
+        )
+        self.assertEqual(message.get_raw_email(), MESSAGE)
+
+    def test_rendering_thread_does_not_read_raw_emails(self):
+        def render(size):
+            thread = self.env['bouncer'].create({})
+            for i in range(5):
+                # Make the raw email big, but keep the body small.
+                raw = MESSAGE.replace(
+                    b'<raw-email@localhost>',
+                    ('<raw-%d-%d@localhost>\nX-Padding: %s' % (
+                        size, i, 'x' * size
+                    )).encode('ascii')
+                )
+                self.env['mail.thread'].message_process(
+                    'bouncer', raw, thread_id=thread.id
+                )
+            messages = thread.message_ids
+            self.assertTrue(all(m.raw_email_ref or m.raw_email
+                                for m in messages))
+            messages.invalidate_cache()
+            with QueryRecorder(self.env.cr) as recorder:
+                messages.message_format()
+            return recorder
+
+        small, big = render(10), render(200 * 1024)
+        for query in big.queries:
+            self.assertNotIn('raw_email', query)
+        self.assertEqual(len(small.queries), len(big.queries))
+        # The raw emails (1 MB) are not read.
+        self.assertLess(big.size - small.size, 1024)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import unittest
+
+from xoeuf.odoo.addons.xopgi_mail_threads.routers import MailRouter, RouteSet
+
+
+def route(model, thread_id=False):
+    return (model, thread_id, {}, 1, None)
+
+
+ROUTES = [route('res.partner', 1), route('bouncer'), route('res.partner', 2)]
+
+
+class TestRouteSet(unittest.TestCase):
+    def test_rollback_undoes_all_changes(self):
+        routes = RouteSet(ROUTES)
+        routes.begin()
+        routes.append(route('crm.lead'))
+        routes[0] = route('project.task', 3)
+        del routes[1]
+        routes.insert(0, route('project.issue', 4))
+        routes.extend([route('a'), route('b')])
+        routes[1:3] = [route('c')]
+        routes.remove(route('a'))
+        routes.pop()
+        routes.sort()
+        routes.rollback()
+        self.assertEqual(routes, ROUTES)
+
+    def test_commit_keeps_changes(self):
+        routes = RouteSet(ROUTES)
+        routes.begin()
+        del routes[:]
+        routes.commit()
+        self.assertEqual(routes, [])
+
+    def test_find_by_model_and_thread(self):
+        routes = RouteSet(ROUTES)
+        self.assertEqual(routes.find('res.partner'), (0, 2))
+        self.assertEqual(routes.find('res.partner', thread_id=2), (2, ))
+        del routes[0]
+        self.assertEqual(routes.find('res.partner'), (1, ))
+        self.assertEqual(
+            list(MailRouter.find_route(routes, model='bouncer')),
+            [(0, route('bouncer'))]
+        )
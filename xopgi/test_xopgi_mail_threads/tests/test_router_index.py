@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import re
+import email
+import unittest
+
+from xoeuf.odoo.addons.xopgi_mail_threads.routers import RouterIndex
+from xoeuf.odoo.addons.xopgi_mail_threads.utils import (
+    AUTO_REPLIED,
+    NOT_AUTOMATIC_RESPONSE,
+)
+
+
+MESSAGE = '''Delivered-To: support@example.com
+To: Support <help@example.com>, sales@other.example.com
+From: someone@localhost
+Subject: Incomming Message
+
+This is a message.
+
+'''
+
+AUTO_REPLY = '''To: support@example.com
+From: someone@localhost
+Auto-Submitted: auto-replied
+Subject: Out of office
+
+I'm away.
+
+'''
+
+
+def router(name, **criteria):
+    # The index only needs the criteria; no need to register a MailRouter.
+    return type(str(name), (object, ), criteria)
+
+
+Everything = router('Everything')
+ByDomain = router('ByDomain', match_recipient_domains=['Other.Example.com'])
+ByAddress = router('ByAddress',
+                   match_recipient_addresses=['support@example.com'])
+ByLocalPart = router('ByLocalPart', match_recipient_local_parts=['help'])
+ByPattern = router('ByPattern', match_recipient_patterns=[r'^sales@'])
+Unmatched = router('Unmatched', match_recipient_domains=['example.org'])
+AutoReplies = router('AutoReplies', match_automatic_responses=[AUTO_REPLIED])
+NotAuto = router('NotAuto',
+                 match_automatic_responses=[NOT_AUTOMATIC_RESPONSE])
+WithRefs = router('WithRefs', match_headers=['References'])
+
+ROUTERS = (Everything, ByDomain, ByAddress, ByLocalPart, ByPattern,
+           Unmatched, AutoReplies, NotAuto, WithRefs)
+
+
+class TestRouterIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = RouterIndex(ROUTERS)
+
+    def test_select_normal_message(self):
+        message = email.message_from_string(MESSAGE)
+        self.assertEqual(
+            self.index.select(message),
+            (Everything, ByDomain, ByAddress, ByLocalPart, ByPattern, NotAuto)
+        )
+
+    def test_select_auto_reply(self):
+        message = email.message_from_string(AUTO_REPLY)
+        self.assertEqual(
+            self.index.select(message),
+            (Everything, ByAddress, AutoReplies)
+        )
+
+    def test_compiled_patterns(self):
+        ByCompiled = router(
+            'ByCompiled',
+            match_recipient_patterns=[re.compile(r'^help@example\.')]
+        )
+        index = RouterIndex((ByCompiled, Unmatched))
+        message = email.message_from_string(MESSAGE)
+        self.assertEqual(index.select(message), (ByCompiled, ))
+        message = email.message_from_string(AUTO_REPLY)
+        self.assertEqual(index.select(message), ())
+
+
+class TestPriorityOrder(unittest.TestCase):
+    def test_sorted_by_priority_then_name(self):
+        from xoeuf.odoo.addons.xopgi_mail_threads.utils import \
+            sort_by_priority
+        first = router('First', priority=1)
+        second = router('Second', priority=5)
+        third = router('Third', priority=5)
+        self.assertEqual(
+            sort_by_priority([third, second, first]),
+            (first, second, third)
+        )
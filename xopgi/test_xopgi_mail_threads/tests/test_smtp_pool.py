@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import smtplib
+import threading
+import unittest
+
+from six.moves import socketserver
+
+from xoeuf.odoo.addons.xopgi_mail_threads.smtp_pool import SMTPConnectionPool
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    # Just enough SMTP to deliver messages with smtplib.
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip().split(b' ')[0].upper()
+            if command in (b'EHLO', b'HELO'):
+                self.reply('250 localhost')
+            elif command == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline().rstrip(b'\r\n') != b'.':
+                    pass
+                self.server.messages += 1
+                self.reply('250 OK')
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 SMTPHandler)
+        self.connections = self.messages = 0
+
+
+class TestSMTPConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = SMTPServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.key = self.server.server_address
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def connect(self):
+        return smtplib.SMTP(*self.server.server_address)
+
+    def send(self, pool):
+        smtp = pool.acquire(self.key, self.connect)
+        try:
+            smtp.sendmail('a@localhost', ['b@localhost'], 'Subject: Hi\n\n.')
+        finally:
+            smtp.quit()
+
+    def test_reuses_connections(self):
+        pool = SMTPConnectionPool()
+        for _ in range(5):
+            self.send(pool)
+        pool.close_all()
+        self.assertEqual(self.server.messages, 5)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(pool.stats(), dict(opened=1, reused=4, idle=0))
+
+    def test_max_messages_per_connection(self):
+        pool = SMTPConnectionPool(max_messages=2)
+        for _ in range(5):
+            self.send(pool)
+        pool.close_all()
+        self.assertEqual(self.server.connections, 3)
+
+    def test_broken_connections_are_not_reused(self):
+        pool = SMTPConnectionPool(check_after=0)
+        self.send(pool)
+        idle = pool._idle[self.key][0]
+        idle.smtp.close()   # The server hung up.
+        self.send(pool)
+        pool.close_all()
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(self.server.messages, 2)
+
+    def test_threads_do_not_share_connections(self):
+        pool = SMTPConnectionPool(max_idle=10)
+        threads = [threading.Thread(target=self.send, args=(pool, ))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pool.close_all()
+        self.assertEqual(self.server.messages, 10)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import os
+import email
+import unittest
+from io import BytesIO
+
+from email import charset
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.mime.application import MIMEApplication
+
+from xoeuf.odoo.addons.xopgi_mail_threads.spooling import (
+    close_spooled_parts,
+    get_spooled_part,
+    get_spooled_parts,
+    parse_stream,
+)
+
+THRESHOLD = 10000
+
+
+def _as_bytes(message):
+    as_bytes = getattr(message, 'as_bytes', message.as_string)
+    return as_bytes()
+
+
+def _from_bytes(raw):
+    parse = getattr(email, 'message_from_bytes', email.message_from_string)
+    return parse(raw)
+
+
+def _attachment(maintype, payload, filename):
+    if maintype == 'text':
+        result = MIMEText(payload, 'plain', 'utf-8')
+    else:
+        result = MIMEApplication(payload)
+    result.add_header('Content-Disposition', 'attachment',
+                      filename=filename)
+    return result
+
+
+class TestSpooling(unittest.TestCase):
+    def assertSameContent(self, message, raw):
+        parts = get_spooled_parts(message)
+        expected = _from_bytes(raw)
+        self.assertEqual(
+            [part.get_content_type() for part in message.walk()],
+            [part.get_content_type() for part in expected.walk()],
+        )
+        for part, other in zip(message.walk(), expected.walk()):
+            if part.is_multipart():
+                continue
+            content = part.get_payload(decode=True)
+            spooled = get_spooled_part(parts, content)
+            if spooled is not None:
+                self.assertEqual(spooled.filename, part.get_filename())
+                content = spooled.read()
+            self.assertEqual(content, other.get_payload(decode=True))
+
+    def test_big_attachments_are_spooled(self):
+        message = MIMEMultipart()
+        message['Subject'] = 'Spooled'
+        message['Message-Id'] = '<spooled@example.com>'
+        message.attach(MIMEText('The body'))
+        alternative = MIMEMultipart('alternative')
+        alternative.attach(MIMEText('text'))
+        alternative.attach(MIMEText('<b>html</b>', 'html'))
+        message.attach(alternative)
+        message.attach(_attachment('application', os.urandom(3 * THRESHOLD),
+                                   'big.bin'))
+        message.attach(_attachment('text', u'á' * THRESHOLD, 'big.txt'))
+        message.attach(_attachment('application', b'small', 'small.bin'))
+        raw = _as_bytes(message)
+        result, copy = parse_stream(BytesIO(raw), threshold=THRESHOLD)
+        try:
+            self.assertEqual(copy.read(), raw)
+            parts = get_spooled_parts(result)
+            self.assertEqual(
+                sorted(part.filename for part in parts.values()),
+                ['big.bin', 'big.txt']
+            )
+            self.assertEqual(result['Message-Id'], '<spooled@example.com>')
+            self.assertSameContent(result, raw)
+        finally:
+            close_spooled_parts(result)
+            copy.close()
+
+    def test_small_messages_are_not_spooled(self):
+        message = MIMEMultipart()
+        message.attach(MIMEText('The body'))
+        message.attach(_attachment('application', b'small', 'small.bin'))
+        raw = _as_bytes(message)
+        result, copy = parse_stream(BytesIO(raw), threshold=THRESHOLD)
+        copy.close()
+        self.assertFalse(get_spooled_parts(result))
+        self.assertSameContent(result, raw)
+
+    def test_quoted_printable_with_crlf(self):
+        qp = charset.Charset('utf-8')
+        qp.body_encoding = charset.QP
+        text = MIMEText('', 'plain')
+        text.set_payload(u'línea ' * THRESHOLD + u'\n' + u'x' * 300,
+                         charset=qp)
+        text.add_header('Content-Disposition', 'attachment',
+                        filename='qp.txt')
+        message = MIMEMultipart()
+        message.attach(text)
+        raw = _as_bytes(message).replace(b'\n', b'\r\n')
+        result, copy = parse_stream(BytesIO(raw), threshold=THRESHOLD)
+        try:
+            self.assertEqual(len(get_spooled_parts(result)), 1)
+            self.assertSameContent(result, raw)
+        finally:
+            close_spooled_parts(result)
+            copy.close()
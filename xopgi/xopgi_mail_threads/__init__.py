@@ -14,10 +14,15 @@ from . import mail_messages  # noqa
 from . import mail_threads  # noqa
 from . import mail_server  # noqa
 from . import stdroutes  # noqa
+from . import ir_module  # noqa
+from . import ir_attachment  # noqa
+from . import controllers  # noqa
+from . import bounce_stats  # noqa
 
 
-from .routers import MailRouter  # noqa
+from .routers import MailRouter, RouteSet  # noqa
 from .transports import TransportRouteData, MailTransportRouter  # noqa
+from .parsing import ParsedMessage, parse_message, parse_headers  # noqa
 
 
 def post_load_hook():
@@ -9,7 +9,7 @@
 
 {
     "name": "Mail Threads (xopgi)",
-    "version": "6.0",
+    "version": "7.0",
     "post_load": "post_load_hook",
     "author": "Merchise Autrement",
     "website": "http://xopgi.merchise.org/addons/xopgi_mail_threads",
@@ -17,6 +17,7 @@
     "description": "Improves OpenERP's basic mail management.",
     "depends": ['mail'],
     "data": [
+        "security/ir.model.access.csv",
         "views/transitional.xml"
     ],
     "application": False,
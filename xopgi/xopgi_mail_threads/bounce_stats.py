@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+'''Bounce statistics per address.
+
+Delivery status notifications and abuse reports received (see
+`~xopgi.xopgi_mail_threads.dsn`:mod:) are counted per recipient address in
+the table of `BounceStat`:class:.  Reports are written in batches with a
+single ``INSERT ... ON CONFLICT`` statement.
+
+If the system parameter ``xopgi_mail_threads.bounce_suppression_threshold``
+is set, ``ir.mail_server`` refuses to send messages whose recipients all have
+that many hard bounces and complaints.  The suppressed addresses are loaded
+with a single query and kept in memory for `SUPPRESSED_TTL`:data: seconds.
+
+'''
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import time
+import threading
+from collections import defaultdict
+
+from xoutil.context import context as execution_context
+
+from xoeuf import fields, api, models
+
+
+#: The system parameter with the hard bounces (plus complaints) that
+#: suppress an address.  Zero or unset disables the suppression.
+SUPPRESSION_THRESHOLD_PARAM = \
+    'xopgi_mail_threads.bounce_suppression_threshold'
+
+#: The seconds the suppressed addresses are kept in memory.
+SUPPRESSED_TTL = 300
+
+
+class BounceStat(models.Model):
+    _name = 'xopgi.mail_threads.bounce_stat'
+    _description = 'Bounce statistics of an address'
+    _rec_name = 'address'
+    _order = 'last_seen desc'
+
+    address = fields.Char(required=True, index=True, readonly=True)
+    hard_bounces = fields.Integer(readonly=True)
+    soft_bounces = fields.Integer(readonly=True)
+    complaints = fields.Integer(readonly=True)
+    last_status = fields.Char(readonly=True)
+    last_seen = fields.Datetime(readonly=True)
+
+    _sql_constraints = [
+        ('address_unique', 'unique(address)', 'Address must be unique'),
+    ]
+
+    @api.model
+    def record_reports(self, reports):
+        '''Count the `reports`.
+
+        `reports` is an iterable of
+        `~xopgi.xopgi_mail_threads.dsn.DeliveryReport`:class:.
+
+        Inside the `BOUNCE_BATCH_CONTEXT` the reports are only appended to
+        the list 'reports' of the context; whoever opened the context must
+        write them with `_write_reports`:meth:.
+
+        '''
+        context = execution_context[BOUNCE_BATCH_CONTEXT]
+        pending = context.get('reports')
+        if pending is not None:
+            pending.extend(reports)
+        else:
+            self._write_reports(reports)
+
+    @api.model
+    def _write_reports(self, reports):
+        stats = defaultdict(lambda: [0, 0, 0, None])
+        for report in reports:
+            hard, soft, complaint = _classify(report)
+            if not (hard or soft or complaint) or not report.recipient:
+                continue
+            stat = stats[report.recipient[:255]]
+            stat[0] += hard
+            stat[1] += soft
+            stat[2] += complaint
+            stat[3] = report.status or report.action
+        if not stats:
+            return
+        values = [
+            (address, hard, soft, complaints, status, self.env.uid,
+             self.env.uid)
+            for address, (hard, soft, complaints, status) in stats.items()
+        ]
+        row = ("(%s, %s, %s, %s, %s, now() at time zone 'UTC', %s, "
+               "now() at time zone 'UTC', %s, now() at time zone 'UTC')")
+        placeholders = ', '.join([row] * len(values))
+        self.env.cr.execute(
+            'INSERT INTO xopgi_mail_threads_bounce_stat '
+            '(address, hard_bounces, soft_bounces, complaints, last_status, '
+            ' last_seen, create_uid, create_date, write_uid, write_date) '
+            'VALUES ' + placeholders + ' '
+            'ON CONFLICT (address) DO UPDATE SET '
+            ' hard_bounces = xopgi_mail_threads_bounce_stat.hard_bounces '
+            '   + EXCLUDED.hard_bounces, '
+            ' soft_bounces = xopgi_mail_threads_bounce_stat.soft_bounces '
+            '   + EXCLUDED.soft_bounces, '
+            ' complaints = xopgi_mail_threads_bounce_stat.complaints '
+            '   + EXCLUDED.complaints, '
+            ' last_status = EXCLUDED.last_status, '
+            ' last_seen = EXCLUDED.last_seen, '
+            ' write_uid = EXCLUDED.write_uid, '
+            ' write_date = EXCLUDED.write_date',
+            [value for row in values for value in row]
+        )
+        self.invalidate_cache()
+
+    @api.model
+    def get_suppressed_addresses(self):
+        '''Return the set of addresses that must not receive messages.
+
+        Return an empty set if the suppression is disabled.
+
+        '''
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        try:
+            threshold = int(get_param(SUPPRESSION_THRESHOLD_PARAM, 0))
+        except ValueError:
+            threshold = 0
+        if threshold <= 0:
+            return frozenset()
+        key = (self.env.cr.dbname, threshold)
+        entry = _suppressed.get(key)
+        if entry is None or entry[0] < time.time():
+            self.env.cr.execute(
+                'SELECT address FROM xopgi_mail_threads_bounce_stat '
+                'WHERE hard_bounces + complaints >= %s',
+                (threshold, )
+            )
+            entry = (
+                time.time() + SUPPRESSED_TTL,
+                frozenset(address for address, in self.env.cr.fetchall())
+            )
+            with _suppressed_lock:
+                _suppressed[key] = entry
+        return entry[1]
+
+
+def _classify(report):
+    # Return the increments of hard bounces, soft bounces and complaints.
+    if report.action == 'complained':
+        return 0, 0, 1
+    elif report.action == 'failed':
+        if report.status.startswith('4'):
+            return 0, 1, 0
+        else:
+            return 1, 0, 0
+    elif report.action == 'delayed':
+        return 0, 1, 0
+    else:
+        return 0, 0, 0
+
+
+BOUNCE_BATCH_CONTEXT = object()
+
+_suppressed = {}
+_suppressed_lock = threading.Lock()
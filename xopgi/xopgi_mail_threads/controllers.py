@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+'''Download the raw email of messages, and export the metrics.
+
+The raw email is never read with the message; this controller streams it on
+request.
+
+The metrics of routers and transports (see
+`~xopgi.xopgi_mail_threads.instrumentation`:mod:) of the request's DB are
+exported in the text format of Prometheus at ``/xopgi_mail_threads/metrics``.
+Each worker exports its own metrics.
+
+If the option ``xopgi_mail_threads_metrics_token`` is set in the
+configuration file of Odoo, clients must send it in the header
+``Authorization: Bearer <token>``.  Otherwise, the metrics are only exported
+to local clients that are not behind a proxy: requests are rejected if Odoo
+runs with ``proxy_mode`` or if they have an ``X-Forwarded-For`` header (a
+local reverse proxy would make every client look local).
+
+'''
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import hmac
+
+from xoeuf.odoo import http
+from xoeuf.odoo.http import request, content_disposition
+
+from .raw_emails import CHUNK_SIZE
+from .instrumentation import export_prometheus
+
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+METRICS_TOKEN_OPTION = 'xopgi_mail_threads_metrics_token'
+
+
+class RawEmailController(http.Controller):
+    @http.route('/xopgi_mail_threads/raw_email/<int:message_id>',
+                type='http', auth='user')
+    def download_raw_email(self, message_id, **kwargs):
+        message = request.env['mail.message'].browse(message_id).exists()
+        if not message:
+            return request.not_found()
+        message.check_access_rights('read')
+        message.check_access_rule('read')
+        stream = message.open_raw_email()
+        if stream is None:
+            return request.not_found()
+        return request.make_response(
+            _iter_stream(stream),
+            headers=[
+                ('Content-Type', 'message/rfc822'),
+                ('Content-Disposition',
+                 content_disposition('message-%d.eml' % message_id)),
+            ]
+        )
+
+
+class MetricsController(http.Controller):
+    @http.route('/xopgi_mail_threads/metrics', type='http', auth='none')
+    def metrics(self, **kwargs):
+        if not request.db or not _can_read_metrics(request.httprequest):
+            return request.not_found()
+        return request.make_response(
+            export_prometheus(request.db),
+            headers=[('Content-Type', 'text/plain; version=0.0.4')]
+        )
+
+
+def _can_read_metrics(httprequest):
+    from xoeuf.odoo.tools import config
+    token = config.get(METRICS_TOKEN_OPTION)
+    if token:
+        authorization = httprequest.headers.get('Authorization') or ''
+        scheme, _, given = authorization.partition(' ')
+        return scheme.lower() == 'bearer' and hmac.compare_digest(
+            _as_bytes(given.strip()), _as_bytes(token)
+        )
+    elif config.get('proxy_mode'):
+        return False
+    elif 'X-Forwarded-For' in httprequest.headers:
+        return False
+    else:
+        return httprequest.remote_addr in LOCAL_ADDRESSES
+
+
+def _as_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    else:
+        return value.encode('utf-8')
+
+
+def _iter_stream(stream):
+    try:
+        chunk = stream.read(CHUNK_SIZE)
+        while chunk:
+            yield chunk
+            chunk = stream.read(CHUNK_SIZE)
+    finally:
+        stream.close()
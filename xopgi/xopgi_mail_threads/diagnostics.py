@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+'''Log failures related to an email without serializing the email.
+
+Logging ``message.as_string()`` copies the whole email (attachments
+included) into the log record.  Instead, `log_message_failure`:func: logs a
+summary made by `summarize_message`:func:: the headers, the tree of parts
+with their sizes and a hash of the content.  The size of the summary is
+bounded.
+
+The full email is included only if the option
+``xopgi_mail_threads_log_full_messages`` of Odoo's configuration is set.
+
+Records are rate-limited: at most `RATE`:data: records for the same logger
+and log message every `PERIOD`:data: seconds.  The number of records
+dropped is reported with the next record logged.
+
+'''
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import time
+import hashlib
+import logging
+import threading
+
+
+#: The maximum number of headers in the summary.
+MAX_HEADERS = 50
+
+#: The maximum length of each header value in the summary.
+MAX_HEADER_LENGTH = 200
+
+#: The maximum number of parts in the summary.
+MAX_PARTS = 50
+
+#: The option of Odoo's configuration to log the full email.
+FULL_MESSAGE_OPTION = 'xopgi_mail_threads_log_full_messages'
+
+#: Log at most `RATE` records with the same log message every `PERIOD`
+#: seconds.
+RATE = 10
+PERIOD = 60
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def summarize_message(message, include_body=False):
+    '''Return a dict that describes the `message`.
+
+    The keys are:
+
+    - 'headers', a list of pairs ``(name, value)`` (values are truncated);
+
+    - 'parts', the tree of parts: a dict with the 'content_type', the
+      'size' of the payload, the 'filename' (if any) and the sub-'parts' (if
+      multipart);
+
+    - 'size', the sum of the sizes of the payloads;
+
+    - 'sha256', the hash of the headers and payloads.
+
+    If `include_body` is True, the key 'body' has the whole email.
+
+    The size of the summary does not depend on the size of the payloads.
+
+    '''
+    digest = hashlib.sha256()
+    headers = []
+    for name, value in message.items()[:MAX_HEADERS]:
+        value = _to_text(value)
+        if len(value) > MAX_HEADER_LENGTH:
+            value = value[:MAX_HEADER_LENGTH] + '...'
+        headers.append((name, value))
+    counter = [0]
+    parts, size = _summarize_part(message, digest, counter)
+    result = dict(
+        headers=headers,
+        parts=parts,
+        size=size,
+        sha256=digest.hexdigest(),
+    )
+    if counter[0] > MAX_PARTS:
+        result['omitted_parts'] = counter[0] - MAX_PARTS
+    if include_body:
+        result['body'] = message.as_string()
+    return result
+
+
+def _summarize_part(part, digest, counter):
+    # Return a pair of the summary of `part` and the sum of the sizes of
+    # its payloads.  Parts beyond MAX_PARTS are hashed and counted, but
+    # their summary is None.
+    counter[0] += 1
+    described = counter[0] <= MAX_PARTS
+    for name, value in part.items():
+        _update(digest, '%s: %s\n' % (name, _to_text(value)))
+    payload = part.get_payload()
+    if part.is_multipart():
+        children = [_summarize_part(p, digest, counter) for p in payload]
+        size = 0
+        total = sum(t for _, t in children)
+    else:
+        children = None
+        size = total = len(payload) if payload else 0
+        if payload:
+            _update(digest, payload)
+    if not described:
+        return None, total
+    summary = dict(content_type=part.get_content_type(), size=size)
+    filename = part.get_filename()
+    if filename:
+        summary['filename'] = _to_text(filename)[:MAX_HEADER_LENGTH]
+    if children is not None:
+        summary['parts'] = [s for s, _ in children if s is not None]
+    return summary, total
+
+
+def _update(digest, data):
+    # Hash in chunks to avoid copying the whole payload when encoding it.
+    for start in range(0, len(data), _CHUNK_SIZE):
+        chunk = data[start:start + _CHUNK_SIZE]
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8', 'replace')
+        digest.update(chunk)
+
+
+def _to_text(value):
+    try:
+        return '%s' % value
+    except Exception:
+        return repr(value)
+
+
+class RateLimiter(object):
+    '''Allow at most `rate` events with the same key every `period` seconds.
+    '''
+    def __init__(self, rate=RATE, period=PERIOD):
+        self.rate = rate
+        self.period = period
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        '''Return a pair ``(allowed, dropped)``.
+
+        `allowed` is True if the event can happen.  If so, `dropped` is the
+        number of events not allowed since the last one allowed.
+
+        '''
+        now = time.time()
+        with self._lock:
+            start, count, dropped = self._windows.get(key, (now, 0, 0))
+            if now - start >= self.period:
+                start, count = now, 0
+            if count < self.rate:
+                self._windows[key] = (start, count + 1, 0)
+                return True, dropped
+            else:
+                self._windows[key] = (start, count, dropped + 1)
+                return False, 0
+
+
+_limiter = RateLimiter()
+
+
+def log_message_failure(logger, message, msg, *args, **kwargs):
+    '''Log `msg` (formatted with `args`) about a failure with `message`.
+
+    The record has a summary of `message` in the extra attribute
+    'message_summary' (see `summarize_message`:func:) and the traceback of
+    the current exception, unless `exc_info` is False.  Use the keyword
+    argument `level` to change the level (default ERROR).
+
+    Records are rate-limited per logger and `msg`.
+
+    '''
+    level = kwargs.pop('level', logging.ERROR)
+    exc_info = kwargs.pop('exc_info', True)
+    if not logger.isEnabledFor(level):
+        return
+    allowed, dropped = _limiter.allow((logger.name, msg))
+    if not allowed:
+        return
+    if dropped:
+        msg += ' (%d similar records were dropped)'
+        args += (dropped, )
+    extra = dict(
+        message_id=_get_header(message, 'Message-Id'),
+        message_from=_get_header(message, 'From'),
+        message_to=_get_header(message, 'To'),
+        message_subject=_get_header(message, 'Subject'),
+    )
+    try:
+        extra['message_summary'] = summarize_message(
+            message,
+            include_body=_include_full_messages()
+        )
+    except Exception as error:
+        extra['message_summary'] = dict(error=repr(error))
+    logger.log(level, msg, *args, exc_info=exc_info, extra=extra)
+
+
+def _get_header(message, name):
+    value = message.get(name)
+    return _to_text(value)[:MAX_HEADER_LENGTH] if value is not None else None
+
+
+def _include_full_messages():
+    from xoeuf.odoo.tools import config
+    return bool(config.get(FULL_MESSAGE_OPTION))
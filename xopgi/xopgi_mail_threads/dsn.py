@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+'''Parse delivery status notifications (RFC 3464) and abuse reports (RFC
+5965).
+
+Both are ``multipart/report`` messages with a machine-readable part
+('message/delivery-status' or 'message/feedback-report') and, usually, the
+original message or its headers.  `parse_reports`:func: takes an
+`email.message.Message`:class: and `parse_reports_stream`:func: takes the
+raw email line by line; the later keeps in memory only the headers and the
+machine-readable part, not the original message (which may be big).
+
+Both return a list of `DeliveryReport`:class:, one per recipient.
+
+'''
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import re
+
+from xoutil.future.collections import namedtuple
+
+
+#: The report about a recipient.
+#:
+#: `recipient` is the (lower-cased) address; `action` is the Action of the
+#: DSN ('failed', 'delayed', 'delivered', 'relayed' or 'expanded') or
+#: 'complained' for abuse reports; `status` is the Status of the DSN (e.g
+#: '5.1.1') or the Feedback-Type of the abuse report; `original_message_id`
+#: is the Message-Id of the message reported, if known; `diagnostic` is the
+#: Diagnostic-Code of the DSN, if any.
+DeliveryReport = namedtuple(
+    'DeliveryReport',
+    'recipient, action, status, original_message_id, diagnostic'
+)
+
+DELIVERY_STATUS = 'delivery-status'
+FEEDBACK_REPORT = 'feedback-report'
+
+_STATUS_TYPES = {
+    'message/delivery-status': DELIVERY_STATUS,
+    'message/feedback-report': FEEDBACK_REPORT,
+}
+_ORIGINAL_TYPES = ('message/rfc822', 'text/rfc822-headers')
+
+#: The maximum size of the machine-readable part we keep.
+MAX_STATUS_SIZE = 256 * 1024
+
+
+def get_report_type(message):
+    '''Return the report-type of a ``multipart/report`` `message`.
+
+    Return 'delivery-status', 'feedback-report' or None for other messages.
+
+    '''
+    if message.get_content_type() != 'multipart/report':
+        return None
+    kind = (message.get_param('report-type') or '').lower()
+    return kind if kind in (DELIVERY_STATUS, FEEDBACK_REPORT) else None
+
+
+def parse_reports(message):
+    '''Return the `DeliveryReport`:class: list of a report `message`.
+
+    Return an empty list if `message` is not a DSN or an abuse report.
+
+    '''
+    kind = get_report_type(message)
+    if not kind:
+        return []
+    groups = []
+    original_message_id = None
+    for part in message.walk():
+        content_type = part.get_content_type()
+        if content_type in _STATUS_TYPES:
+            payload = part.get_payload()
+            if isinstance(payload, list):
+                # The email package parses message/delivery-status as a
+                # list of messages, one per group of fields.
+                groups.extend(
+                    {k.lower(): v for k, v in group.items()}
+                    for group in payload
+                )
+            else:
+                payload = part.get_payload(decode=True) or b''
+                groups.extend(_parse_groups(payload.splitlines(True)))
+        elif content_type in _ORIGINAL_TYPES and not original_message_id:
+            if content_type == 'message/rfc822':
+                original = part.get_payload(0)
+                original_message_id = original.get('Message-Id')
+            else:
+                payload = part.get_payload(decode=True) or b''
+                fields = _parse_groups(payload.splitlines(True))
+                if fields:
+                    original_message_id = fields[0].get('message-id')
+    return _make_reports(groups, original_message_id)
+
+
+def parse_reports_stream(lines):
+    '''Same as `parse_reports`:func: but reading the raw email.
+
+    `lines` is an iterable of the lines (bytes) of the raw email, e.g a file
+    open in binary mode.
+
+    '''
+    lines = iter(lines)
+    headers = _read_headers(lines)
+    content_type = headers.get('content-type', '')
+    match = re.match(r'\s*multipart/report\s*;', content_type, re.I)
+    kind = _get_param(content_type, 'report-type').lower()
+    boundary = _get_param(content_type, 'boundary')
+    if not match or kind not in (DELIVERY_STATUS, FEEDBACK_REPORT) or \
+       not boundary:
+        return []
+    delimiter = b'--' + boundary.encode('ascii', 'replace')
+    groups = []
+    original_message_id = None
+    line = _skip_to(lines, delimiter)
+    while line is not None and line.rstrip() != delimiter + b"--":
+        part = _read_headers(lines)
+        part_type = _get_type(part.get('content-type', 'text/plain'))
+        if part_type in _STATUS_TYPES:
+            body, size = [], 0
+            line = None
+            for line in lines:
+                if line.startswith(delimiter):
+                    break
+                size += len(line)
+                if size <= MAX_STATUS_SIZE:
+                    body.append(line)
+            else:
+                line = None
+            encoding = part.get('content-transfer-encoding', '')
+            groups.extend(_parse_groups(_decode(body, encoding)))
+        elif part_type in _ORIGINAL_TYPES and not original_message_id:
+            original = _read_headers(lines)
+            original_message_id = original.get('message-id')
+            line = _skip_to(lines, delimiter)
+        else:
+            line = _skip_to(lines, delimiter)
+    return _make_reports(groups, original_message_id)
+
+
+def _make_reports(groups, original_message_id):
+    if original_message_id:
+        original_message_id = original_message_id.strip()
+    result = []
+    for fields in groups:
+        if 'feedback-type' in fields:
+            for recipient in _split(fields.get('original-rcpt-to', '')):
+                result.append(DeliveryReport(
+                    _get_address(recipient),
+                    'complained',
+                    fields['feedback-type'].strip().lower(),
+                    original_message_id,
+                    None,
+                ))
+        else:
+            recipient = fields.get('final-recipient') or \
+                fields.get('original-recipient')
+            action = fields.get('action')
+            if recipient and action:
+                result.append(DeliveryReport(
+                    _get_address(recipient),
+                    action.strip().lower(),
+                    (fields.get('status') or '').strip(),
+                    original_message_id,
+                    _unfold(fields.get('diagnostic-code')) or None,
+                ))
+    return result
+
+
+def _split(value):
+    return [v for v in re.split(r'[\s,]+', _unfold(value)) if v]
+
+
+def _get_address(value):
+    # Remove the address-type ('rfc822;') and the angle brackets.
+    address = _unfold(value).rpartition(';')[-1].strip()
+    return address.strip('<>').lower()
+
+
+def _unfold(value):
+    return ' '.join((value or '').split())
+
+
+def _text(line):
+    return line.decode('utf-8', 'replace') if isinstance(line, bytes) \
+        else line
+
+
+def _read_headers(lines):
+    '''Read header lines until a blank line; return a dict (lower keys).'''
+    result = {}
+    name = None
+    for line in lines:
+        line = _text(line)
+        if not line.strip():
+            break
+        if line[0] in ' \t' and name:
+            result[name] += ' ' + line.strip()
+        else:
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            result.setdefault(name, value.strip())
+    return result
+
+
+def _parse_groups(lines):
+    '''Parse blank-line separated groups of fields.'''
+    lines = iter(lines)
+    result = []
+    while True:
+        fields = _read_headers(lines)
+        if fields:
+            result.append(fields)
+        else:
+            # Either the end or several blank lines; find out which.
+            line = next(lines, None)
+            if line is None:
+                return result
+            lines = _chain([line], lines)
+
+
+def _chain(first, rest):
+    for line in first:
+        yield line
+    for line in rest:
+        yield line
+
+
+def _skip_to(lines, delimiter):
+    for line in lines:
+        if line.startswith(delimiter):
+            return line
+    return None
+
+
+def _get_type(content_type):
+    return content_type.split(';', 1)[0].strip().lower()
+
+
+def _get_param(content_type, name):
+    match = re.search(r';\s*%s\s*=\s*("([^"]*)"|[^;\s]*)' % re.escape(name),
+                      content_type, re.I)
+    if not match:
+        return ''
+    return match.group(2) if match.group(2) is not None else match.group(1)
+
+
+def _decode(lines, encoding):
+    encoding = encoding.strip().lower()
+    if encoding == 'base64':
+        import base64
+        return base64.b64decode(b''.join(lines)).splitlines(True)
+    elif encoding == 'quoted-printable':
+        import quopri
+        return quopri.decodestring(b''.join(lines)).splitlines(True)
+    else:
+        return lines
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+'''Count and time the calls to routers and transports.
+
+Each call to the `query` and `apply` of routers, and to the `query`,
+`prepare_message` (`prepare_messages`) and `deliver` (`deliver_many`) of
+transports is recorded with `timed`:func:.  For each DB, kind ('router' or
+'transport'), class and method we keep the number of calls, the number of
+failures and a histogram of the latencies (see `BUCKETS`:data:).
+
+The metrics are kept in memory by each process (i.e each Odoo worker has its
+own).  They can be read with `get_metrics`:func: or exported in the text
+format of Prometheus with `export_prometheus`:func:.
+
+'''
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import time
+import threading
+from bisect import bisect_left
+
+ROUTER = 'router'
+TRANSPORT = 'transport'
+
+#: The upper bounds (in seconds) of the buckets of the histograms.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+
+
+class Metric(object):
+    '''The calls, failures and latency histogram of a method.'''
+    __slots__ = ('calls', 'failures', 'total', 'counts')
+
+    def __init__(self):
+        self.calls = self.failures = 0
+        self.total = 0.0
+        # The last bucket is +Inf.
+        self.counts = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, elapsed, failed):
+        self.calls += 1
+        if failed:
+            self.failures += 1
+        self.total += elapsed
+        self.counts[bisect_left(BUCKETS, elapsed)] += 1
+
+    def as_dict(self):
+        buckets, count = [], 0
+        for bound, n in zip(BUCKETS + (float('inf'), ), self.counts):
+            count += n
+            buckets.append((bound, count))
+        return dict(calls=self.calls, failures=self.failures,
+                    total_seconds=self.total, buckets=buckets)
+
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def observe(dbname, kind, obj, method, elapsed, failed=False):
+    '''Record a call to `method` of the router or transport `obj`.'''
+    key = (dbname, kind, get_name(obj), method)
+    with _metrics_lock:
+        metric = _metrics.get(key)
+        if metric is None:
+            metric = _metrics[key] = Metric()
+        metric.observe(elapsed, failed)
+
+
+def timed(dbname, kind, obj, method, *args, **kwargs):
+    '''Call the `method` of `obj` with `args` and record it.
+
+    Exceptions are recorded as failures and re-raised.
+
+    '''
+    start = time.time()
+    try:
+        result = getattr(obj, method)(*args, **kwargs)
+    except Exception:
+        observe(dbname, kind, obj, method, time.time() - start, True)
+        raise
+    observe(dbname, kind, obj, method, time.time() - start)
+    return result
+
+
+def get_name(obj):
+    cls = obj if isinstance(obj, type) else type(obj)
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+def get_metrics(dbname=None, kind=None):
+    '''Return the metrics recorded by this process.
+
+    Return a dict from ``(dbname, kind, name, method)`` to a dict with the
+    `calls`, the `failures`, the `total_seconds` and the `buckets` of the
+    histogram (a list of pairs with the upper bound and the cumulative
+    count).  If `dbname` or `kind` are given, return only those metrics.
+
+    '''
+    with _metrics_lock:
+        items = [(key, metric.as_dict()) for key, metric in _metrics.items()
+                 if dbname is None or key[0] == dbname
+                 if kind is None or key[1] == kind]
+    return dict(items)
+
+
+def reset_metrics(dbname=None):
+    '''Forget the metrics of `dbname` (or all if None).'''
+    with _metrics_lock:
+        if dbname is None:
+            _metrics.clear()
+        else:
+            for key in [key for key in _metrics if key[0] == dbname]:
+                del _metrics[key]
+
+
+PREFIX = 'xopgi_mail_threads'
+
+
+def export_prometheus(dbname=None):
+    '''Return the metrics in the text format of Prometheus.'''
+    metrics = sorted(get_metrics(dbname).items())
+    lines = []
+
+    def header(name, kind, help):
+        lines.append('# HELP %s_%s %s' % (PREFIX, name, help))
+        lines.append('# TYPE %s_%s %s' % (PREFIX, name, kind))
+
+    header('calls_total', 'counter', 'Calls to routers and transports.')
+    for key, metric in metrics:
+        lines.append('%s_calls_total{%s} %d' % (PREFIX, _labels(key),
+                                                metric['calls']))
+    header('failures_total', 'counter',
+           'Calls to routers and transports that failed.')
+    for key, metric in metrics:
+        lines.append('%s_failures_total{%s} %d' % (PREFIX, _labels(key),
+                                                   metric['failures']))
+    header('duration_seconds', 'histogram',
+           'Latency of the calls to routers and transports.')
+    for key, metric in metrics:
+        labels = _labels(key)
+        for bound, count in metric['buckets']:
+            lines.append('%s_duration_seconds_bucket{%s,le="%s"} %d' % (
+                PREFIX, labels, '+Inf' if bound == float('inf') else bound,
+                count
+            ))
+        lines.append('%s_duration_seconds_sum{%s} %r' % (
+            PREFIX, labels, metric['total_seconds']
+        ))
+        lines.append('%s_duration_seconds_count{%s} %d' % (
+            PREFIX, labels, metric['calls']
+        ))
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(key):
+    return ','.join(
+        '%s="%s"' % (name, _escape(value))
+        for name, value in zip(('db', 'kind', 'name', 'method'), key)
+    )
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+'''Create attachments from spooled parts.
+
+See `xopgi.xopgi_mail_threads.spooling`.
+
+'''
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import os
+import hashlib
+import tempfile
+from base64 import b64encode
+
+from xoeuf import api, models
+
+
+class IrAttachment(models.Model):
+    _inherit = 'ir.attachment'
+
+    @api.model
+    def _create_from_spooled(self, name, part, res_model=None, res_id=None):
+        '''Create an attachment with the content of the spooled `part`.
+
+        If attachments are stored in the filestore, the file is written in
+        chunks from the spooled part.  Otherwise, the content must be read in
+        memory.
+
+        .. versionadded:: 7.0
+
+        '''
+        vals = dict(
+            name=name,
+            datas_fname=name,
+            res_model=res_model,
+            res_id=res_id,
+            type='binary',
+        )
+        if part.content_type:
+            vals['mimetype'] = part.content_type
+        if self._storage() != 'file':
+            vals['datas'] = b64encode(part.read())
+            return self.create(vals)
+        # Create the attachment without content, and then set the file.
+        # Writing `store_fname` directly avoids `_inverse_datas`, which would
+        # need the content in memory.
+        attachment = self.create(vals)
+        fname, checksum = self._write_spooled_file(part)
+        attachment.sudo().write(dict(
+            store_fname=fname,
+            checksum=checksum,
+            file_size=part.size,
+        ))
+        return attachment
+
+    @api.model
+    def _write_spooled_file(self, part):
+        '''Write the spooled `part` to the filestore.
+
+        Return a tuple with the `store_fname` and the `checksum`.
+
+        '''
+        digest = hashlib.sha1()
+        for chunk in part.iter_chunks():
+            digest.update(chunk)
+        checksum = digest.hexdigest()
+        fname, full_path = self._get_path(b'', checksum)
+        if not os.path.exists(full_path):
+            folder = os.path.dirname(full_path)
+            fd, tmp = tempfile.mkstemp(dir=folder, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as fh:
+                    for chunk in part.iter_chunks():
+                        fh.write(chunk)
+                os.rename(tmp, full_path)
+            except Exception:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise
+        mark_for_gc = getattr(self, '_mark_for_gc', None)   # Odoo 11+
+        if mark_for_gc is not None:
+            mark_for_gc(fname)
+        return fname, checksum
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+'''Keep the caches of installed routers and transports in sync.
+
+Routers and transports are only active if the addon defining them is
+installed.  Since we cache which ones are (see `utils.InstalledObjectsCache`),
+we need to drop the cache whenever the state of an addon changes.  The same
+goes for the answers of the transports (see `transports.QueryCache`).
+
+'''
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+from xoeuf import api, models
+
+from .utils import invalidate_installed_objects
+from .transports import get_query_cache
+
+
+class IrModule(models.Model):
+    _inherit = 'ir.module.module'
+
+    @api.multi
+    def write(self, vals):
+        res = super(IrModule, self).write(vals)
+        if 'state' in vals:
+            invalidate_installed_objects(self.env.cr.dbname)
+            get_query_cache().invalidate(self.env.cr.dbname)
+        return res
@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+'''A LMTP server to feed incoming emails to ``mail.thread``.
+
+The MTA delivers emails to `LMTPServer`:class: (RFC 2033) through a Unix
+socket (or a local TCP port) instead of spawning the mailgate for each
+message.  The server keeps running, so the registry and the connections to
+the DB are warm.
+
+The messages are processed by a pool of threads, with at most `workers`
+messages being processed at once.  After the DATA command, the server answers
+with a reply for each recipient:
+
+- ``250 2.0.0`` if the message was processed (or ignored, e.g. a duplicated
+  Message-Id),
+
+- ``550 5.1.1`` if there's no route for the message,
+
+- ``552 5.3.4`` if the message is too big,
+
+- ``451 4.3.0`` if processing failed; the MTA will retry later.
+
+The message of a transaction is processed once for all its recipients, with
+a ``Delivered-To`` header for each of them: Odoo routes it to every alias
+found in those headers, the ``To`` and the ``Cc``.  All the recipients get the
+same reply.  Processing the message once for each recipient would be wrong
+both ways: a recipient only in the envelope (e.g. a Bcc) would find the
+Message-Id already processed and the message would never reach its alias,
+and a message without Message-Id (Odoo makes up a new one each time) would
+be created once for each recipient.
+
+Run it with::
+
+   python -m xoeuf.odoo.addons.xopgi_mail_threads.lmtp \\
+       --socket /run/odoo/lmtp.sock -- -c /etc/odoo.conf -d <dbname>
+
+and tell the MTA to deliver to it (e.g. Postfix's ``mailbox_transport =
+lmtp:unix:/run/odoo/lmtp.sock``).
+
+This module requires Python 3.5+ (i.e Odoo 11+).
+
+.. versionadded:: 7.0
+
+'''
+import io
+import os
+import re
+import socket
+import asyncio
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+logger = logging.getLogger(__name__)
+del logging
+
+
+#: The maximum size of messages (in bytes).
+DEFAULT_MAX_SIZE = 50 * 1024 * 1024
+
+#: The maximum number of recipients of a transaction.
+MAX_RECIPIENTS = 100
+
+#: The maximum length of lines (in bytes).
+LINE_LIMIT = 1024 * 1024
+
+#: Seconds waiting for a command before closing the connection.
+TIMEOUT = 300
+
+OK = (250, '2.0.0 Ok')
+NO_ROUTE = (550, '5.1.1 No route for the recipient')
+TOO_BIG = (552, '5.3.4 Message too big')
+TEMPORARY_FAILURE = (451, '4.3.0 Error processing the message')
+
+# The start of the message of the ValueError raised by ``message_route`` when
+# there's no route.
+_NO_ROUTE_ERROR = 'No possible route found'
+
+_PATH = re.compile(r'^(FROM|TO):\s*<([^<>]*)>\s*(.*)$', re.I)
+
+
+class LMTPServer(object):
+    '''A LMTP server that passes each message to `deliver`.
+
+    :param deliver: A function that takes the `sender`, the list of
+                    `recipients` and a binary file with the message, and
+                    returns a list with a pair (the code and the text of the
+                    reply) for each recipient.  It's called in a thread.  If
+                    it raises an exception, all the recipients get
+                    `TEMPORARY_FAILURE`:data:.
+
+    :param workers: The maximum number of messages being delivered at once.
+
+    :param max_size: The maximum size of messages.
+
+    :param spool_threshold: Messages bigger than this are kept in temporary
+                            files while being delivered.
+
+    '''
+    def __init__(self, deliver, workers=4, max_size=DEFAULT_MAX_SIZE,
+                 spool_threshold=1024 * 1024, hostname=None,
+                 timeout=TIMEOUT):
+        self.deliver = deliver
+        self.workers = workers
+        self.max_size = max_size
+        self.spool_threshold = spool_threshold
+        self.hostname = hostname or socket.getfqdn()
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.server = None
+        self._semaphore = None
+        self._connections = {}   # writer -> future done when closed
+
+    async def start(self, path=None, host='127.0.0.1', port=8024):
+        '''Listen in the Unix socket `path` or in `host` and `port`.'''
+        self._semaphore = asyncio.Semaphore(self.workers)
+        if path:
+            if os.path.exists(path):
+                os.unlink(path)
+            self.server = await asyncio.start_unix_server(
+                self.handle, path=path, limit=LINE_LIMIT
+            )
+        else:
+            self.server = await asyncio.start_server(
+                self.handle, host=host, port=port, limit=LINE_LIMIT
+            )
+        return self.server
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        for writer in list(self._connections):
+            writer.close()
+        if self._connections:
+            await asyncio.wait(list(self._connections.values()))
+        self.executor.shutdown(wait=True)
+
+    async def handle(self, reader, writer):
+        '''Talk LMTP with a client.'''
+        session = _Session()
+        self._connections[writer] = asyncio.get_event_loop().create_future()
+        try:
+            await self._reply(writer, 220, '%s LMTP ready' % self.hostname)
+            while True:
+                line = await self._readline(reader)
+                command, _, arg = line.strip().partition(b' ')
+                command = command.decode('ascii', 'replace').upper()
+                arg = arg.strip().decode('utf-8', 'replace')
+                if command == 'QUIT':
+                    await self._reply(writer, 221, '2.0.0 Bye')
+                    break
+                elif command == 'DATA':
+                    await self._data(session, reader, writer)
+                else:
+                    handler = getattr(self, '_do_' + command.lower(), None)
+                    if handler is None or not command.isalpha():
+                        reply = (500, '5.5.1 Command unrecognized')
+                    else:
+                        reply = handler(session, arg)
+                    await self._reply(writer, *reply)
+        except _LineTooLong:
+            await self._reply(writer, 500, '5.5.2 Line too long')
+        except asyncio.TimeoutError:
+            await self._reply(writer, 421, '4.4.2 Timeout')
+        except (_Disconnected, ConnectionError):
+            pass
+        except Exception:
+            logger.exception('Error in the LMTP session')
+            try:
+                await self._reply(writer, 421, '4.3.0 Internal error')
+            except Exception:
+                pass
+        finally:
+            writer.close()
+            self._connections.pop(writer).set_result(None)
+
+    def _do_lhlo(self, session, arg):
+        if not arg:
+            return (501, '5.5.4 Syntax: LHLO hostname')
+        session.reset()
+        session.greeted = True
+        return (250, [self.hostname, 'PIPELINING', 'ENHANCEDSTATUSCODES',
+                      '8BITMIME', 'SIZE %d' % self.max_size])
+
+    def _do_helo(self, session, arg):
+        return (500, '5.5.1 This is a LMTP server; use LHLO')
+
+    _do_ehlo = _do_helo
+
+    def _do_mail(self, session, arg):
+        if not session.greeted:
+            return (503, '5.5.1 Send LHLO first')
+        if session.sender is not None:
+            return (503, '5.5.1 Nested MAIL command')
+        path = _parse_path(arg, 'FROM')
+        if path is None:
+            return (501, '5.5.4 Syntax: MAIL FROM:<address>')
+        sender, params = path
+        size = params.get('SIZE')
+        if size and size.isdigit() and int(size) > self.max_size:
+            return TOO_BIG
+        session.sender = sender
+        return (250, '2.1.0 Ok')
+
+    def _do_rcpt(self, session, arg):
+        if session.sender is None:
+            return (503, '5.5.1 Send MAIL first')
+        path = _parse_path(arg, 'TO')
+        if path is None or not path[0]:
+            return (501, '5.5.4 Syntax: RCPT TO:<address>')
+        if len(session.recipients) >= MAX_RECIPIENTS:
+            return (452, '4.5.3 Too many recipients')
+        session.recipients.append(path[0])
+        return (250, '2.1.5 Ok')
+
+    def _do_rset(self, session, arg):
+        session.reset()
+        return OK
+
+    def _do_noop(self, session, arg):
+        return OK
+
+    def _do_vrfy(self, session, arg):
+        return (252, '2.5.0 Cannot verify the user')
+
+    async def _data(self, session, reader, writer):
+        if not session.recipients:
+            await self._reply(writer, 503, '5.5.1 No valid recipients')
+            return
+        await self._reply(writer, 354,
+                          'Start mail input; end with <CRLF>.<CRLF>')
+        data, too_big = await self._read_data(reader)
+        sender, recipients = session.sender, session.recipients
+        session.reset()
+        try:
+            if too_big:
+                for _ in recipients:
+                    await self._reply(writer, *TOO_BIG)
+                return
+            loop = asyncio.get_event_loop()
+            async with self._semaphore:
+                # The message is processed once for all the recipients (see
+                # the module's docstring).
+                replies = await loop.run_in_executor(
+                    self.executor, self._deliver, sender, recipients, data
+                )
+            for reply in replies:
+                await self._reply(writer, *reply)
+        finally:
+            data.close()
+
+    def _deliver(self, sender, recipients, data):
+        data.seek(0)
+        try:
+            replies = list(self.deliver(sender, list(recipients), data))
+            if len(replies) != len(recipients):
+                raise ValueError('Expected %d replies, got %d' %
+                                 (len(recipients), len(replies)))
+            return replies
+        except Exception:
+            logger.exception('Error delivering message from %s to %s',
+                             sender, ', '.join(recipients))
+            return [TEMPORARY_FAILURE] * len(recipients)
+
+    async def _read_data(self, reader):
+        data = tempfile.SpooledTemporaryFile(max_size=self.spool_threshold)
+        size, too_big = 0, False
+        while True:
+            line = await self._readline(reader)
+            if line in (b'.\r\n', b'.\n'):
+                break
+            if line.startswith(b'.'):
+                line = line[1:]
+            size += len(line)
+            if size > self.max_size:
+                too_big = True
+            elif not too_big:
+                data.write(line)
+        data.seek(0)
+        return data, too_big
+
+    async def _readline(self, reader):
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.timeout)
+        except ValueError:   # The line is over the limit of the reader
+            raise _LineTooLong()
+        if not line:
+            raise _Disconnected()
+        return line
+
+    async def _reply(self, writer, code, text):
+        if isinstance(text, (list, tuple)):
+            lines = ['%d-%s' % (code, item) for item in text[:-1]]
+            lines.append('%d %s' % (code, text[-1]))
+        else:
+            lines = ['%d %s' % (code, text)]
+        writer.write(''.join(line + '\r\n' for line in lines).encode('utf-8'))
+        await writer.drain()
+
+
+class _Session(object):
+    def __init__(self):
+        self.greeted = False
+        self.reset()
+
+    def reset(self):
+        self.sender = None
+        self.recipients = []
+
+
+class _LineTooLong(Exception):
+    pass
+
+
+class _Disconnected(Exception):
+    pass
+
+
+def _parse_path(arg, keyword):
+    # Return the address and the ESMTP params of 'FROM:<address> params'.
+    match = _PATH.match(arg)
+    if not match or match.group(1).upper() != keyword:
+        return None
+    params = {}
+    for param in match.group(3).split():
+        name, _, value = param.partition('=')
+        params[name.upper()] = value
+    return match.group(2).strip(), params
+
+
+class OdooDelivery(object):
+    '''Deliver the messages to ``mail.thread`` in the DB `dbname`.
+
+    The arguments `model`, `save_original` and `strip_attachments` are passed
+    to ``message_process`` (see the options of the mailgate).  The message is
+    processed once, with a ``Delivered-To`` header for each recipient, so
+    that aliases are found for recipients not in the ``To`` or ``Cc``.
+
+    All the recipients get `OK`:data: if the message was processed, or
+    `NO_ROUTE`:data: if Odoo finds no route for it; other errors are raised,
+    and the server answers with a temporary failure.
+
+    '''
+    def __init__(self, dbname, model=None, save_original=False,
+                 strip_attachments=False):
+        self.dbname = dbname
+        self.model = model
+        self.save_original = save_original
+        self.strip_attachments = strip_attachments
+
+    def warm_up(self):
+        '''Load the registry of the DB.'''
+        from xoeuf import odoo
+        odoo.registry(self.dbname)
+
+    def __call__(self, sender, recipients, fileobj):
+        from xoeuf import odoo, api, SUPERUSER_ID
+        from .spooling import get_spool_threshold
+        headers = [('Delivered-To: %s\r\n' % recipient).encode('utf-8')
+                   for recipient in recipients]
+        fileobj.seek(0, io.SEEK_END)
+        size = fileobj.tell()
+        fileobj.seek(0)
+        # Other processes may have changed the registry (e.g installing an
+        # addon); the HTTP workers and the cron do this too.
+        registry = odoo.registry(self.dbname).check_signaling()
+        with api.Environment.manage():
+            with registry.cursor() as cr:
+                env = api.Environment(cr, SUPERUSER_ID, {})
+                Threads = env['mail.thread']
+                options = dict(save_original=self.save_original,
+                               strip_attachments=self.strip_attachments)
+                try:
+                    with cr.savepoint():
+                        if size > get_spool_threshold():
+                            Threads.message_process_stream(
+                                self.model, _Prepended(headers, fileobj),
+                                **options
+                            )
+                        else:
+                            Threads.message_process(
+                                self.model,
+                                b''.join(headers) + fileobj.read(),
+                                **options
+                            )
+                except ValueError as error:
+                    # Other errors are temporary failures (see `LMTPServer`).
+                    if not str(error).startswith(_NO_ROUTE_ERROR):
+                        raise
+                    logger.info('No route for message from %s to %s',
+                                sender, ', '.join(recipients), exc_info=True)
+                    return [NO_ROUTE] * len(recipients)
+        return [OK] * len(recipients)
+
+
+class _Prepended(object):
+    # A binary file with the lines `headers` before the content of
+    # `fileobj`; only what `spooling.parse_stream` needs.
+    def __init__(self, headers, fileobj):
+        self.headers = list(headers)
+        self.fileobj = fileobj
+
+    def readline(self, size=-1):
+        if self.headers:
+            return self.headers.pop(0)
+        return self.fileobj.readline(size)
+
+    def read(self, size=-1):
+        result, self.headers = b''.join(self.headers), []
+        if size is None or size < 0:
+            return result + self.fileobj.read()
+        elif len(result) < size:
+            result += self.fileobj.read(size - len(result))
+        return result
+
+
+def serve(deliver, path=None, host='127.0.0.1', port=8024, socket_mode=None,
+          **options):
+    '''Run a `LMTPServer`:class: until interrupted.'''
+    loop = asyncio.get_event_loop()
+    server = LMTPServer(deliver, **options)
+    loop.run_until_complete(server.start(path=path, host=host, port=port))
+    if path and socket_mode is not None:
+        os.chmod(path, socket_mode)
+    logger.info('LMTP server listening in %s',
+                path or '%s:%d' % (host, port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.stop())
+        if path and os.path.exists(path):
+            os.unlink(path)
+
+
+def main(argv=None):
+    import sys
+    import argparse
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if '--' in argv:
+        pos = argv.index('--')
+        argv, odoo_args = argv[:pos], argv[pos + 1:]
+    else:
+        odoo_args = []
+    parser = argparse.ArgumentParser(description='Deliver incoming emails '
+                                                 'to Odoo over LMTP.')
+    parser.add_argument('--socket', help='The path of the Unix socket.')
+    parser.add_argument('--socket-mode', type=lambda mode: int(mode, 8),
+                        default=0o660)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8024)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--max-size', type=int, default=DEFAULT_MAX_SIZE)
+    parser.add_argument('--model')
+    parser.add_argument('--save-original', action='store_true')
+    parser.add_argument('--strip-attachments', action='store_true')
+    args = parser.parse_args(argv)
+
+    from xoeuf import odoo
+    from .spooling import get_spool_threshold
+    odoo.tools.config.parse_config(odoo_args)
+    dbname = odoo.tools.config['db_name']
+    if not dbname:
+        parser.error('Missing the DB (pass -d <dbname> after --)')
+    deliver = OdooDelivery(dbname, model=args.model,
+                           save_original=args.save_original,
+                           strip_attachments=args.strip_attachments)
+    deliver.warm_up()
+    serve(deliver, path=args.socket, host=args.host, port=args.port,
+          socket_mode=args.socket_mode, workers=args.workers,
+          max_size=args.max_size, spool_threshold=get_spool_threshold())
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
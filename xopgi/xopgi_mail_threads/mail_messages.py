@@ -21,16 +21,22 @@ from __future__ import (division as _py3_division,
                         print_function as _py3_print,
                         absolute_import as _py3_abs_import)
 
+import re
+import sys
 import logging
 
-from xoutil.eight.string import force as force_str
+from xoutil.context import context as execution_context
 
-from xoeuf import fields, api, models
+from xoeuf import fields, api, models, SUPERUSER_ID
+
+from .parsing import parse_message, get_raw_bytes
+from .raw_emails import RawEmailStore, DEFAULT_CODEC
+from .utils import get_transaction_cache, get_thread_cache
 
-from email import message_from_string
 from email.generator import DecodedGenerator
 from email.message import Message
 
+from base64 import b64decode
 try:
     from base64 import encodebytes
 except ImportError:
@@ -40,6 +46,25 @@ except ImportError:
 #: The name of the field to store the raw email.
 RAW_EMAIL_ATTR = 'raw_email'
 
+#: The name of the field with the reference to the raw email in the
+#: `~xopgi.xopgi_mail_threads.raw_emails.RawEmailStore`:class:.
+RAW_EMAIL_REF_ATTR = 'raw_email_ref'
+
+#: The URL to download the raw email of a message.
+RAW_EMAIL_URL = '/xopgi_mail_threads/raw_email/%d'
+
+#: The system parameter to select where new raw emails are stored: 'db'
+#: (the default) stores them base64-encoded in the `raw_email` column,
+#: 'filestore' stores them compressed in the `RawEmailStore`.
+RAW_EMAIL_STORAGE_PARAM = 'xopgi_mail_threads.raw_email_storage'
+
+#: The system parameter to select the codec of the `RawEmailStore` ('gzip'
+#: or 'zstd').
+RAW_EMAIL_CODEC_PARAM = 'xopgi_mail_threads.raw_email_codec'
+
+#: The name of the transaction cache from Message-Id to mail.message ids.
+MESSAGE_ID_CACHE = 'mail.message/message_id'
+
 
 logger = logging.getLogger(__name__)
 
@@ -47,10 +72,339 @@ logger = logging.getLogger(__name__)
 class MailMessage(models.Model):
     _inherit = 'mail.message'
 
+    # The raw email is big and only needed on explicit request (see
+    # `get_raw_email`), so it must never be prefetched with the other fields.
     raw_email = fields.Binary('Raw Email',
                               default=b'',
+                              prefetch=False,
                               help='The raw email message unprocessed.')
 
+    raw_email_ref = fields.Char(
+        'Raw Email Reference',
+        readonly=True,
+        copy=False,
+        help='The reference to the raw email when stored in the filestore.'
+    )
+
+    @api.model
+    def _get_raw_email_store(self, force=False):
+        '''Return the store for new raw emails.
+
+        Return None if raw emails are stored in the DB, unless `force` is
+        True.
+
+        '''
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        if force or get_param(RAW_EMAIL_STORAGE_PARAM, 'db') == 'filestore':
+            codec = get_param(RAW_EMAIL_CODEC_PARAM, DEFAULT_CODEC)
+            return RawEmailStore(self.env.cr.dbname, codec=codec)
+        else:
+            return None
+
+    @api.model
+    def _prepare_raw_email_vals(self, vals):
+        if RAW_EMAIL_ATTR in vals:
+            vals = dict(vals)
+            raw_email = vals[RAW_EMAIL_ATTR]
+            store = self._get_raw_email_store()
+            if store and raw_email:
+                vals[RAW_EMAIL_REF_ATTR] = store.put(b64decode(raw_email))
+                vals[RAW_EMAIL_ATTR] = False
+            else:
+                vals[RAW_EMAIL_REF_ATTR] = False
+        return vals
+
+    @api.model
+    def create(self, vals):
+        vals = self._prepare_raw_email_vals(vals)
+        if vals.get('message_id'):
+            cache = get_transaction_cache(self.env.cr, MESSAGE_ID_CACHE)
+            cache.pop(vals['message_id'].strip())
+        result = super(MailMessage, self).create(vals)
+        if vals.get('model') and vals.get('res_id'):
+            self._remember_threads({
+                result.message_id: (vals['model'], vals['res_id'])
+            })
+        return result
+
+    @api.multi
+    def write(self, vals):
+        vals = self._prepare_raw_email_vals(vals)
+        if 'message_id' in vals:
+            get_transaction_cache(self.env.cr, MESSAGE_ID_CACHE).clear()
+        if {'message_id', 'model', 'res_id'} & set(vals):
+            self._forget_threads()
+        return super(MailMessage, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self._forget_threads()
+        get_transaction_cache(self.env.cr, MESSAGE_ID_CACHE).clear()
+        return super(MailMessage, self).unlink()
+
+    @api.model
+    def _find_threads(self, message_ids):
+        '''Find the threads of the messages with the given Message-Ids.
+
+        Return a dict from the Message-Ids found to their thread, a pair
+        ``(model, res_id)``.  Message-Ids not found or without a thread are
+        not included.  Access rules are not applied, and the record of the
+        thread may have been deleted.
+
+        Threads are looked up in the cache of the process (see
+        `~xopgi.xopgi_mail_threads.utils.ThreadCache`:class:) and the
+        missing ones are found with a single query.
+
+        .. versionadded:: 7.0
+
+        '''
+        dbname = self.env.cr.dbname
+        cache = get_thread_cache()
+        result = {}
+        missing = []
+        for message_id in message_ids:
+            thread = cache.get(dbname, message_id)
+            if thread is None:
+                missing.append(message_id)
+            else:
+                result[message_id] = thread
+        if missing:
+            found = {}
+            self.env.cr.execute(
+                'SELECT message_id, model, res_id FROM mail_message '
+                'WHERE message_id IN %s AND model IS NOT NULL '
+                'AND res_id IS NOT NULL ORDER BY id DESC',
+                (tuple(missing), )
+            )
+            for message_id, model, res_id in self.env.cr.fetchall():
+                found[message_id] = (model, res_id)   # keep the oldest
+            result.update(found)
+            self._remember_threads(found)
+        return result
+
+    @api.model
+    def _remember_threads(self, threads):
+        # Put `threads` in the cache when the transaction is committed, so
+        # that the cache never has threads of rolled back messages.
+        threads = {
+            message_id.strip(): thread
+            for message_id, thread in threads.items()
+            if message_id
+        }
+        if threads:
+            dbname = self.env.cr.dbname
+            update = lambda: get_thread_cache().update(dbname, threads)
+            after = getattr(self.env.cr, 'after', None)
+            if after is not None:
+                after('commit', update)
+            else:
+                update()
+
+    @api.multi
+    def _forget_threads(self):
+        message_ids = [m for m in self.sudo().mapped('message_id') if m]
+        if message_ids:
+            get_thread_cache().discard(
+                self.env.cr.dbname,
+                [m.strip() for m in message_ids]
+            )
+
+    @api.model
+    def _find_by_message_ids(self, message_ids):
+        '''Find the messages with the given Message-Ids.
+
+        Return a dict from each of the `message_ids` to the tuple of ids of
+        the mail.message records with that Message-Id (there may be none or
+        several).
+
+        The Message-Ids not cached in the current transaction are found with
+        a single query.  That query bypasses the access rules, so unless the
+        environment is the superuser's (e.g ``sudo()``) the messages found
+        are filtered by a ``search`` like an ORM lookup would.
+
+        .. versionadded:: 7.0
+
+        '''
+        cache = get_transaction_cache(self.env.cr, MESSAGE_ID_CACHE)
+        result = {}
+        missing = []
+        for message_id in message_ids:
+            ids = cache.get(message_id)
+            if ids is None:
+                missing.append(message_id)
+            else:
+                result[message_id] = ids
+        if missing:
+            found = {message_id: [] for message_id in missing}
+            self.env.cr.execute(
+                'SELECT message_id, id FROM mail_message '
+                'WHERE message_id IN %s ORDER BY id',
+                (tuple(missing), )
+            )
+            for message_id, id in self.env.cr.fetchall():
+                found[message_id].append(id)
+            for message_id, ids in found.items():
+                result[message_id] = cache[message_id] = tuple(ids)
+        if self.env.uid != SUPERUSER_ID:
+            ids = [id for ids in result.values() for id in ids]
+            if ids:
+                allowed = set(self.search([('id', 'in', ids)]).ids)
+            else:
+                allowed = set()
+            result = {
+                message_id: tuple(id for id in ids if id in allowed)
+                for message_id, ids in result.items()
+            }
+        return result
+
+    @api.multi
+    def read(self, fields=None, load='_classic_read'):
+        # Reading all fields must not include the raw email.
+        if not fields:
+            fields = [
+                name
+                for name in self.check_field_access_rights('read', None)
+                if name != RAW_EMAIL_ATTR
+            ]
+        return super(MailMessage, self).read(fields=fields, load=load)
+
+    @api.multi
+    def action_download_raw_email(self):
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_url',
+            'url': RAW_EMAIL_URL % self.id,
+            'target': 'self',
+        }
+
+    @api.multi
+    def open_raw_email(self):
+        '''Return a file-like object to read the raw email of the message.
+
+        The caller must close it.  Return None if there's no raw email.
+
+        '''
+        self.ensure_one()
+        if self.raw_email_ref:
+            return RawEmailStore(self.env.cr.dbname).open(self.raw_email_ref)
+        elif self.raw_email:
+            from io import BytesIO
+            return BytesIO(b64decode(self.raw_email))
+        else:
+            return None
+
+    @api.multi
+    def get_raw_email(self):
+        '''Return the raw email of the message (bytes) or None.'''
+        stream = self.open_raw_email()
+        if stream is not None:
+            try:
+                return stream.read()
+            finally:
+                stream.close()
+        else:
+            return None
+
+    @api.model
+    def _write_raw_emails(self, raw_emails):
+        '''Store the raw emails of several messages at once.
+
+        `raw_emails` maps the Message-Id of the messages to the value of the
+        `raw_email` field.
+
+        '''
+        messages = self.search([('message_id', 'in', list(raw_emails))])
+        store = self._get_raw_email_store()
+        if store:
+            query = ('UPDATE mail_message '
+                     'SET raw_email=NULL, raw_email_ref=%s WHERE id=%s')
+            values = {
+                message_id: store.put(b64decode(raw_email))
+                for message_id, raw_email in raw_emails.items()
+            }
+        else:
+            query = ('UPDATE mail_message '
+                     'SET raw_email=%s, raw_email_ref=NULL WHERE id=%s')
+            field = self._fields[RAW_EMAIL_ATTR]
+            values = {
+                message_id: field.convert_to_column(raw_email, self)
+                for message_id, raw_email in raw_emails.items()
+            }
+        self.env.cr.executemany(
+            query,
+            [(values[msg.message_id], msg.id) for msg in messages]
+        )
+        messages.invalidate_cache([RAW_EMAIL_ATTR, RAW_EMAIL_REF_ATTR])
+
+    @api.model
+    def _migrate_raw_emails(self, batch_size=500, limit=None, commit=True):
+        '''Move the raw emails stored in the DB to the filestore.
+
+        Process messages in batches of `batch_size`, committing after each
+        one if `commit` is True.  Stop after `limit` messages if given.
+        Return the number of messages migrated.
+
+        Run it from an Odoo shell::
+
+            env['mail.message']._migrate_raw_emails()
+
+        '''
+        cr = self.env.cr
+        store = self._get_raw_email_store(force=True)
+        total = 0
+        while limit is None or total < limit:
+            size = batch_size if limit is None else min(batch_size,
+                                                        limit - total)
+            cr.execute(
+                '''SELECT id, raw_email FROM mail_message
+                   WHERE raw_email_ref IS NULL AND raw_email IS NOT NULL
+                         AND length(raw_email) > 0
+                   ORDER BY id LIMIT %s''',
+                (size, )
+            )
+            rows = cr.fetchall()
+            if not rows:
+                break
+            params = [(store.put(_decode_column(raw_email)), id)
+                      for id, raw_email in rows]
+            cr.executemany(
+                '''UPDATE mail_message SET raw_email=NULL, raw_email_ref=%s
+                   WHERE id=%s''',
+                params
+            )
+            self.invalidate_cache([RAW_EMAIL_ATTR, RAW_EMAIL_REF_ATTR],
+                                  [id for _, id in params])
+            total += len(rows)
+            if commit:
+                cr.commit()
+            logger.info('Migrated %d raw emails to the filestore', total)
+        return total
+
+
+def _decode_column(value):
+    value = bytes(value)
+    # Some very old rows have the raw text; keep it as is.  Only the line
+    # breaks added by `encodebytes` are allowed outside of the alphabet of
+    # base64, otherwise raw text could be decoded into garbage.
+    data = b''.join(value.splitlines())
+    try:
+        return _strict_b64decode(data)
+    except (TypeError, ValueError):
+        return value
+
+
+if sys.version_info >= (3, ):
+    def _strict_b64decode(data):
+        return b64decode(data, validate=True)
+else:
+    _BASE64 = re.compile(br'^[A-Za-z0-9+/]*={0,2}$')
+
+    def _strict_b64decode(data):
+        # Python 2's `b64decode` has no `validate`.
+        if not _BASE64.match(data):
+            raise ValueError('Non-base64 digit found')
+        return b64decode(data)
+
 
 # Since the mailgate program actually call mail_thread's `message_process`,
 # that, in turn, call `message_parse` this is the place to make the raw_email
@@ -58,20 +412,113 @@ class MailMessage(models.Model):
 class MailThread(models.AbstractModel):
     _inherit = 'mail.thread'
 
+    @api.model
+    def message_process(self, model, message, custom_values=None,
+                        save_original=False, strip_attachments=False,
+                        thread_id=None):
+        from .spooling import get_spool_threshold
+        raw = get_raw_bytes(message)
+        if len(raw) > get_spool_threshold():
+            from io import BytesIO
+            return self.message_process_stream(
+                model, BytesIO(raw),
+                custom_values=custom_values,
+                save_original=save_original,
+                strip_attachments=strip_attachments,
+                thread_id=thread_id,
+            )
+        # Odoo parses the message before calling `message_parse` and we get
+        # only the parsed message.  Keep the original bytes so that
+        # `message_parse` stores them instead of re-generating the email.
+        with execution_context(RAW_MESSAGE_CONTEXT, raw=[raw]):
+            return super(MailThread, self).message_process(
+                model, message,
+                custom_values=custom_values,
+                save_original=save_original,
+                strip_attachments=strip_attachments,
+                thread_id=thread_id,
+            )
+
+    @api.model
+    def message_process_stream(self, model, fileobj, custom_values=None,
+                               save_original=False, strip_attachments=False,
+                               thread_id=None):
+        '''Same as ``message_process`` but read the raw email from `fileobj`.
+
+        `fileobj` must be open in binary mode.  The email is parsed with
+        `~xopgi.xopgi_mail_threads.spooling.parse_stream`:func:, so that
+        big attachments are spooled to temporary files and stored from them
+        (see `_message_post_process_attachments`:meth:).
+
+        ``message_process`` uses this method for raw emails bigger than the
+        spool threshold.
+
+        .. versionadded:: 7.0
+
+        '''
+        from .spooling import parse_stream, close_spooled_parts
+        message, raw = parse_stream(fileobj)
+        try:
+            with execution_context(RAW_MESSAGE_CONTEXT, raw=[raw]):
+                msg = self.message_parse(message, save_original=save_original)
+            if strip_attachments:
+                msg.pop('attachments', None)
+            message_id = msg.get('message_id')
+            if message_id and self.env['mail.message']._find_by_message_ids(
+                    [message_id])[message_id]:
+                logger.info(
+                    'Ignored mail from %s to %s with Message-Id %s: found '
+                    'duplicated Message-Id during processing',
+                    msg.get('from'), msg.get('to'), message_id
+                )
+                return False
+            routes = self.message_route(message, msg, model, thread_id,
+                                        custom_values)
+            return self.message_route_process(message, msg, routes)
+        finally:
+            close_spooled_parts(message)
+            raw.close()
+
     @api.model
     def message_parse(self, message, save_original=False):
         if not isinstance(message, Message):
-            message = force_str(message)
-            message = message_from_string(message)
+            message = get_raw_bytes(message)
+        # The parsed message is attached to the `Message` object, so that
+        # `message_route` and routers reuse it.
+        parsed = parse_message(message)
+        raw_file = None
+        if parsed.raw is None:
+            # Only the first call to `message_parse` inside
+            # `message_process` is about the original message.  Inside
+            # `message_process_stream` we get a file.
+            pending = execution_context[RAW_MESSAGE_CONTEXT].get('raw')
+            if pending:
+                raw = pending.pop()
+                if isinstance(raw, bytes):
+                    parsed.raw = raw
+                else:
+                    raw_file = raw
+        message = parsed.message
         result = super(MailThread, self).message_parse(
             message, save_original=save_original
         )
+        _replace_spooled_attachments(result, message, raw_file)
         try:
-            from io import BytesIO
-            buf = BytesIO()
-            gen = DecodedGenerator(buf, mangle_from_=False)
-            gen.flatten(message)
-            result[RAW_EMAIL_ATTR] = encodebytes(buf.getvalue())
+            store = self.env['mail.message']._get_raw_email_store()
+            if raw_file is not None:
+                raw_file.seek(0)
+                if store:
+                    result[RAW_EMAIL_REF_ATTR] = store.put(raw_file)
+                else:
+                    result[RAW_EMAIL_ATTR] = encodebytes(raw_file.read())
+            else:
+                raw_email = parsed.raw_bytes
+                if raw_email is None:
+                    raw_email = _generate_raw_email(message)
+                if store:
+                    result[RAW_EMAIL_REF_ATTR] = store.put(raw_email)
+                else:
+                    result[RAW_EMAIL_ATTR] = encodebytes(raw_email)
         except Exception:  # noqa
             # Should any error happen while reencoding; it's not worthy to
             # stop the message from being created.  Just log.
@@ -79,3 +526,74 @@ class MailThread(models.AbstractModel):
                 'Error while re-encoding raw email.  Continuing normally'
             )
         return result
+
+    @api.multi
+    def _message_post_process_attachments(self, attachments, attachment_ids,
+                                          message_data):
+        # The spooled parts (see `message_process_stream`) are stored from
+        # their files; Odoo would need their content in memory.
+        from .spooling import SpooledPart
+        spooled = [attachment for attachment in attachments or ()
+                   if isinstance(attachment[1], SpooledPart)]
+        if spooled:
+            attachments = [attachment for attachment in attachments
+                           if not isinstance(attachment[1], SpooledPart)]
+        _super = super(MailThread, self)._message_post_process_attachments
+        result = _super(attachments, attachment_ids, message_data)
+        if spooled:
+            Attachments = self.env['ir.attachment']
+            commands = [
+                (4, Attachments._create_from_spooled(
+                    attachment[0], attachment[1],
+                    res_model=message_data.get('model'),
+                    res_id=message_data.get('res_id'),
+                ).id)
+                for attachment in spooled
+            ]
+            if isinstance(result, dict):
+                # Odoo 12 returns the values to write in the message.
+                result.setdefault('attachment_ids', []).extend(commands)
+            else:
+                result.extend(commands)
+        return result
+
+
+def _replace_spooled_attachments(msg_dict, message, raw_file=None):
+    '''Put the spooled parts of `message` in the attachments of `msg_dict`.
+
+    ``message_parse`` gives the tokens of the spooled parts as the content of
+    the attachments.  The original email (see `save_original`) is taken from
+    `raw_file`, if given.
+
+    '''
+    from .spooling import get_spooled_parts, get_spooled_part, SpooledPart
+    parts = get_spooled_parts(message)
+    attachments = msg_dict.get('attachments')
+    if not attachments or not (parts or raw_file):
+        return
+    for pos, attachment in enumerate(attachments):
+        part = get_spooled_part(parts, attachment[1])
+        if part is None and raw_file is not None and \
+           attachment[0] == 'original_email.eml':
+            part = SpooledPart(attachment[0], 'message/rfc822', file=raw_file)
+            raw_file.seek(0, 2)
+            part.size = raw_file.tell()
+        if part is not None:
+            values = (attachment[0], part) + tuple(attachment[2:])
+            if hasattr(attachment, '_make'):
+                values = attachment._make(values)   # a namedtuple
+            attachments[pos] = values
+
+
+def _generate_raw_email(message):
+    '''Return the bytes of `message`; used if we don't have the original.'''
+    from io import BytesIO
+    buf = BytesIO()
+    gen = DecodedGenerator(buf, mangle_from_=False)
+    gen.flatten(message)
+    return buf.getvalue()
+
+
+# The context to pass the raw email from `message_process` to
+# `message_parse`.
+RAW_MESSAGE_CONTEXT = object()
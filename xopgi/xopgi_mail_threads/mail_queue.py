@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+'''A queue of outgoing emails.
+
+In the queued mode (see `MailServer.send_email`), outgoing messages are
+prepared by their transport and then written to a `MailSpool`:class: instead
+of being delivered in the current request.  A `MailQueue`:class: runs a
+number of threads that deliver the spooled messages, retrying failures with
+an exponential backoff.
+
+The spool is a directory with the layout of a maildir::
+
+   <data_dir>/xopgi_mail_spool/<dbname>/
+       tmp/     -- entries being written
+       new/     -- entries waiting to be delivered
+       cur/     -- entries being delivered
+       failed/  -- entries that failed too many times
+
+Entries are claimed by renaming them from 'new' to 'cur', so several
+processes may share the same spool.  The name of each entry is
+``<due time>-<queued time>-<random>`` so that entries are sorted by the time
+they are due.  Each file has a line of JSON with the metadata followed by
+the raw message.
+
+'''
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import os
+import json
+import time
+import uuid
+import threading
+from collections import deque
+
+import logging
+logger = logging.getLogger(__name__)
+del logging
+
+
+#: The folder inside Odoo's data dir.
+FOLDER = 'xopgi_mail_spool'
+
+#: Entries in 'cur' older than this (seconds) are assumed to be left by a
+#: process that died while delivering them.
+STALE_TIMEOUT = 3600
+
+#: How often (seconds) idle workers look for new entries.
+POLL_INTERVAL = 5
+
+#: The window (seconds) to compute the throughput.
+THROUGHPUT_WINDOW = 300
+
+
+class MailSpool(object):
+    '''A durable spool of outgoing messages in the directory `path`.'''
+    def __init__(self, path):
+        self.path = path
+        for folder in ('tmp', 'new', 'cur', 'failed'):
+            folder = os.path.join(path, folder)
+            if not os.path.isdir(folder):
+                try:
+                    os.makedirs(folder)
+                except OSError:
+                    if not os.path.isdir(folder):
+                        raise
+
+    def _get_path(self, folder, name):
+        return os.path.join(self.path, folder, name)
+
+    def _write(self, meta, raw, due):
+        name = '%017.6f-%017.6f-%s' % (due, meta['queued_at'],
+                                       uuid.uuid4().hex)
+        tmp = self._get_path('tmp', name)
+        with open(tmp, 'wb') as fh:
+            fh.write(json.dumps(meta).encode('utf-8'))
+            fh.write(b'\n')
+            fh.write(raw)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.rename(tmp, self._get_path('new', name))
+        return name
+
+    def put(self, raw, meta):
+        '''Add the `raw` message (bytes) to the spool.
+
+        `meta` must be a JSON-serializable dict.  Return the name of the
+        entry.
+
+        '''
+        now = time.time()
+        meta = dict(meta, attempts=0, queued_at=now)
+        return self._write(meta, raw, now)
+
+    def claim(self):
+        '''Take the first entry which is due.
+
+        Return a tuple ``(name, meta, raw)`` or None if there's no entry due.
+
+        '''
+        now = time.time()
+        for name in sorted(os.listdir(self._get_path('new', ''))):
+            if _get_due(name) > now:
+                break
+            try:
+                os.rename(self._get_path('new', name),
+                          self._get_path('cur', name))
+            except OSError:
+                continue   # Another worker took it.
+            with open(self._get_path('cur', name), 'rb') as fh:
+                meta = json.loads(fh.readline().decode('utf-8'))
+                raw = fh.read()
+            return name, meta, raw
+        return None
+
+    def done(self, name):
+        '''Remove a delivered entry.'''
+        os.unlink(self._get_path('cur', name))
+
+    def retry(self, name, meta, raw, delay):
+        '''Put back the entry to be delivered after `delay` seconds.'''
+        meta = dict(meta, attempts=meta.get('attempts', 0) + 1)
+        self._write(meta, raw, time.time() + delay)
+        os.unlink(self._get_path('cur', name))
+
+    def fail(self, name):
+        '''Move the entry to the failed ones.'''
+        os.rename(self._get_path('cur', name),
+                  self._get_path('failed', name))
+
+    def recover(self, stale_timeout=STALE_TIMEOUT):
+        '''Put back the entries left in 'cur' by dead processes.'''
+        limit = time.time() - stale_timeout
+        for name in os.listdir(self._get_path('cur', '')):
+            path = self._get_path('cur', name)
+            try:
+                if os.stat(path).st_ctime < limit:
+                    os.rename(path, self._get_path('new', name))
+            except OSError:
+                pass
+
+    def stats(self):
+        '''Return a dict with the `depth` of the spool, the `oldest_age` (in
+        seconds) of its entries, and the number of `failed` entries.'''
+        names = os.listdir(self._get_path('new', ''))
+        names.extend(os.listdir(self._get_path('cur', '')))
+        now = time.time()
+        oldest = min(_get_queued_at(name) for name in names) if names else now
+        return dict(
+            depth=len(names),
+            oldest_age=now - oldest,
+            failed=len(os.listdir(self._get_path('failed', ''))),
+        )
+
+
+def _get_due(name):
+    return float(name.split('-')[0])
+
+
+def _get_queued_at(name):
+    return float(name.split('-')[1])
+
+
+class MailQueue(object):
+    '''Deliver the messages in the spool of a DB with a pool of threads.
+
+    :param deliver: A function that takes the `dbname`, the `meta` and the
+                    `raw` message of an entry and delivers it.  It must raise
+                    an exception if the message was not delivered.
+
+    '''
+    def __init__(self, dbname, spool, deliver, workers=2, max_attempts=5,
+                 backoff=60):
+        self.dbname = dbname
+        self.spool = spool
+        self.deliver = deliver
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._threads = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._delivered = deque()
+        self.delivered = self.retried = self.failed = 0
+
+    def start(self):
+        '''Start the threads if not already running.'''
+        with self._lock:
+            if self._threads:
+                return
+            self.spool.recover()
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run,
+                    name='xopgi.mail_queue.%s.%d' % (self.dbname, i)
+                )
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def notify(self):
+        '''Tell idle threads there are new entries.'''
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            try:
+                entry = self.spool.claim()
+            except Exception:
+                logger.exception('Error reading the mail spool')
+                entry = None
+            if entry is None:
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+            else:
+                self.process(*entry)
+
+    def process(self, name, meta, raw):
+        '''Deliver a claimed entry, or schedule it for retry.'''
+        try:
+            self.deliver(self.dbname, meta, raw)
+        except Exception:
+            attempts = meta.get('attempts', 0) + 1
+            if attempts >= self.max_attempts:
+                logger.exception('Giving up delivering queued message %s',
+                                 meta.get('message_id'))
+                self.failed += 1
+                self.spool.fail(name)
+            else:
+                delay = self.backoff * 2 ** (attempts - 1)
+                logger.warning(
+                    'Failed to deliver queued message %s (attempt %d). '
+                    'Retrying in %ds', meta.get('message_id'), attempts,
+                    delay, exc_info=True
+                )
+                self.retried += 1
+                self.spool.retry(name, meta, raw, delay)
+        else:
+            self.delivered += 1
+            self._delivered.append(time.time())
+            self.spool.done(name)
+
+    def stats(self):
+        '''Return the status of the queue.
+
+        The keys are those of `MailSpool.stats`:meth: plus the number of
+        messages `delivered`, `retried` and given up (`failed_here`) by this
+        process, and the `throughput` (messages per minute in the last
+        minutes).
+
+        '''
+        limit = time.time() - THROUGHPUT_WINDOW
+        delivered = self._delivered
+        while delivered and delivered[0] < limit:
+            delivered.popleft()
+        result = self.spool.stats()
+        result.update(
+            delivered=self.delivered,
+            retried=self.retried,
+            failed_here=self.failed,
+            throughput=len(delivered) * 60 / THROUGHPUT_WINDOW,
+            workers=len(self._threads),
+        )
+        return result
+
+
+_queues = {}
+_queues_lock = threading.Lock()
+
+
+def get_mail_queue(dbname, deliver):
+    '''Return the `MailQueue`:class: of the DB (create it if needed).'''
+    queue = _queues.get(dbname)
+    if queue is None:
+        with _queues_lock:
+            queue = _queues.get(dbname)
+            if queue is None:
+                from xoeuf.odoo.tools import config
+                spool = MailSpool(os.path.join(config['data_dir'], FOLDER,
+                                               dbname))
+                options = {
+                    arg: int(config[option])
+                    for arg, option in QUEUE_OPTIONS.items()
+                    if config.get(option)
+                }
+                queue = _queues[dbname] = MailQueue(dbname, spool, deliver,
+                                                    **options)
+    return queue
+
+
+#: The options in Odoo's configuration file for the queue.
+QUEUE_OPTIONS = {
+    'workers': 'xopgi_mail_threads_queue_workers',
+    'max_attempts': 'xopgi_mail_threads_queue_max_attempts',
+    'backoff': 'xopgi_mail_threads_queue_backoff',
+}
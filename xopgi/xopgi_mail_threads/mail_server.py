@@ -20,11 +20,18 @@ from __future__ import (division as _py3_division,
                         absolute_import as _py3_abs_import)
 
 # TODO: Review with gevent-based model.
+import json
+from collections import OrderedDict
+
 from xoutil.context import context as execution_context
+from xoutil.future.collections import namedtuple
 
 from xoeuf.models import Model
 from xoeuf import api
 
+from .diagnostics import log_message_failure
+from .instrumentation import timed, get_metrics, TRANSPORT
+
 import logging
 logger = logging.getLogger(__name__)
 del logging
@@ -51,11 +58,28 @@ class MailServer(Model):
         It is strongly suggested that transport only change headers and
         connection data.
 
+        If the system parameter ``xopgi_mail_threads.send_mode`` is 'queued',
+        the message is prepared by the selected transport and put in the
+        outgoing queue (see `~xopgi.xopgi_mail_threads.mail_queue`:mod:) and
+        its Message-Id is returned right away.  The queue delivers it later
+        and retries if it fails.
+
+        If the system parameter
+        ``xopgi_mail_threads.bounce_suppression_threshold`` is set, messages
+        whose recipients have all bounced too often are not sent (see
+        `~xopgi.xopgi_mail_threads.bounce_stats`:mod:).
+
+        .. versionchanged:: 7.0 Added the queued mode and the suppression of
+           addresses that bounce.
+
         '''
         _super = super(MailServer, self).send_email
         if DIRECT_SEND_CONTEXT not in execution_context:
+            if QUEUE_WORKER_CONTEXT not in execution_context:
+                self._check_suppressed_recipients(message)
             logger.debug('Sending email with available transports.')
             transport = None
+            dbname = self.env.cr.dbname
             try:
                 from .transports import MailTransportRouter as transports
                 mail_server_id = kw.get('mail_server_id', None)
@@ -67,35 +91,388 @@ class MailServer(Model):
                     if transport:
                         logger.debug('Selected transport: %r.', transport)
                         with transport:
-                            message, conndata = transport.prepare_message(
-                                self, message,
+                            message, conndata = timed(
+                                dbname, TRANSPORT, transport,
+                                'prepare_message', self, message,
                                 data=querydata,
                             )
-                            return transport.deliver(
+                            if self._is_queued_send():
+                                result = self._queue_email(
+                                    message, transport, conndata, **kw
+                                )
+                                if result is not _NOT_QUEUED:
+                                    return result
+                            return timed(
+                                dbname, TRANSPORT, transport, 'deliver',
                                 self, message, conndata, **kw
                             )
             except Exception as e:
                 from openerp.addons.base.ir.ir_mail_server import \
                     MailDeliveryException
                 if not isinstance(e, MailDeliveryException):
-                    logger.exception(
-                        'Transport %s failed. Falling back',
-                        transport,
-                        extra=dict(message_from=message.get('From'),
-                                   message_to=message.get('To'),
-                                   message_cc=message.get('Cc'),
-                                   message_subject=message.get('Subject'))
+                    log_message_failure(
+                        logger, message,
+                        'Transport %s failed. Falling back', transport
                     )
                 else:
                     raise
+            if self._is_queued_send():
+                result = self._queue_email(message, **kw)
+                if result is not _NOT_QUEUED:
+                    return result
         return _super(message, **kw)
 
+    @api.model
+    def send_emails(self, messages, **kw):
+        '''Send several emails.
+
+        This is the batch version of `send_email`:meth:.  A transport is
+        selected for each message, then messages are grouped by transport and
+        connection data.  Each group is prepared and delivered at once (see
+        `MailTransportRouter.prepare_messages` and
+        `MailTransportRouter.deliver_many`) over a single SMTP connection.
+
+        Return a list with a `SendResult`:class: for each message, in the
+        same order.
+
+        .. versionadded:: 7.0
+
+        '''
+        from .transports import MailTransportRouter as transports
+        messages = list(messages)
+        results = [None] * len(messages)
+        direct = DIRECT_SEND_CONTEXT in execution_context or not neither(
+            kw.get('mail_server_id', None),
+            kw.get('smtp_server', None),
+        )
+        groups = OrderedDict()
+        for pos, message in enumerate(messages):
+            transport = querydata = None
+            if not direct:
+                try:
+                    self._check_suppressed_recipients(message)
+                except Exception as error:
+                    results[pos] = SendResult(None, error)
+                    continue
+                try:
+                    transport, querydata = transports.select(self, message)
+                except Exception:
+                    logger.exception('Failed to select a transport')
+            groups.setdefault(transport, []).append((pos, message, querydata))
+        fallback = groups.pop(None, [])
+        dbname = self.env.cr.dbname
+        for transport, items in groups.items():
+            logger.debug('Sending %d emails with transport %r',
+                         len(items), transport)
+            delivered = {}
+            try:
+                with transport:
+                    prepared = timed(
+                        dbname, TRANSPORT, transport, 'prepare_messages',
+                        self,
+                        [(message, querydata)
+                         for _, message, querydata in items]
+                    )
+                    batches = OrderedDict()
+                    for (pos, _, _), (message, conndata) in zip(items,
+                                                                prepared):
+                        key = _get_conndata_key(conndata)
+                        batch = batches.setdefault(key, (conndata, []))
+                        batch[1].append((pos, message))
+                    for conndata, batch in batches.values():
+                        delivered.update(zip(
+                            [pos for pos, _ in batch],
+                            timed(
+                                dbname, TRANSPORT, transport, 'deliver_many',
+                                self,
+                                [message for _, message in batch],
+                                conndata,
+                                **kw
+                            )
+                        ))
+            except Exception:
+                logger.exception('Transport %s failed. Falling back',
+                                 transport)
+            for pos, message, _ in items:
+                # Messages the transport couldn't deliver are sent as in
+                # `send_email`.
+                result = delivered.get(pos, _NOT_DELIVERED)
+                if result is _NOT_DELIVERED:
+                    fallback.append((pos, message, None))
+                elif not isinstance(result, Exception):
+                    results[pos] = SendResult(result, None)
+                elif isinstance(result, _get_delivery_exception()):
+                    results[pos] = SendResult(None, result)
+                else:
+                    logger.error('Transport %s failed: %r. Falling back',
+                                 transport, result)
+                    fallback.append((pos, message, None))
+        if fallback:
+            _super = super(MailServer, self).send_email
+            with execution_context(POOLED_SMTP_CONTEXT):
+                for pos, message, _ in sorted(fallback, key=lambda i: i[0]):
+                    try:
+                        results[pos] = SendResult(_super(message, **kw), None)
+                    except Exception as error:
+                        logger.exception('Failed to send email')
+                        results[pos] = SendResult(None, error)
+        return results
+
+    @api.model
+    def _check_suppressed_recipients(self, message):
+        '''Raise a MailDeliveryException if all the recipients of `message`
+        are suppressed because of their bounces.'''
+        Stats = self.env['xopgi.mail_threads.bounce_stat'].sudo()
+        suppressed = Stats.get_suppressed_addresses()
+        if suppressed:
+            from .utils import get_recipients
+            recipients = {
+                address.strip().lower()
+                for _, address in get_recipients(message)
+                if address
+            }
+            if recipients and recipients <= suppressed:
+                raise _get_delivery_exception()(
+                    'Mail Delivery Failed',
+                    'All recipients bounce too often: %s' % ', '.join(
+                        sorted(recipients)
+                    )
+                )
+
+    @api.model
+    def _is_queued_send(self):
+        if QUEUE_WORKER_CONTEXT in execution_context:
+            return False
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        return get_param(SEND_MODE_PARAM, DIRECT_MODE) == QUEUED_MODE
+
+    @api.model
+    def _queue_email(self, message, transport=None, conndata=None, **kw):
+        '''Put the `message` in the outgoing queue.
+
+        `transport` and `conndata` are the transport that prepared the
+        message and its connection data, if any.  Return the Message-Id of
+        the message, or `_NOT_QUEUED` if it can't be queued because the
+        connection data or `kw` cannot be stored.
+
+        Connections passed in `kw` (e.g the `smtp_session` of Odoo 12) are
+        dropped; the queue opens its own.
+
+        The message is put in the queue when the transaction is committed, so
+        nothing is sent if it's rolled back.
+
+        '''
+        from .mail_queue import get_mail_queue
+        kw = {key: value for key, value in kw.items()
+              if key not in _CONNECTION_KWARGS}
+        meta = dict(
+            transport=_get_transport_name(transport) if transport else None,
+            conndata=conndata,
+            kw=kw,
+            message_id=message['Message-Id'],
+        )
+        try:
+            json.dumps(meta)
+        except (TypeError, ValueError):
+            logger.warning('Cannot queue message %s. Sending it now.',
+                           meta['message_id'])
+            return _NOT_QUEUED
+        as_bytes = getattr(message, 'as_bytes', message.as_string)
+        raw = as_bytes()
+        dbname = self.env.cr.dbname
+
+        def spool():
+            queue = get_mail_queue(dbname, _deliver_queued_email)
+            queue.spool.put(raw, meta)
+            queue.start()
+            queue.notify()
+
+        after = getattr(self.env.cr, 'after', None)
+        if after is not None:
+            after('commit', spool)
+        else:
+            spool()
+        return meta['message_id']
+
+    @api.model
+    def _deliver_queued_email(self, message, meta):
+        '''Deliver a `message` taken from the outgoing queue.'''
+        kw = meta.get('kw') or {}
+        with execution_context(QUEUE_WORKER_CONTEXT):
+            name = meta.get('transport')
+            if name:
+                from .transports import MailTransportRouter as transports
+                installed = transports.get_installed_objects(self)
+                transport = next(
+                    (t for t in installed if _get_transport_name(t) == name),
+                    None
+                )
+                if transport is None:
+                    logger.warning('Transport %s is not installed; sending '
+                                   'queued message %s directly',
+                                   name, meta.get('message_id'))
+                else:
+                    transport = transport()
+                    with transport:
+                        return timed(
+                            self.env.cr.dbname, TRANSPORT, transport,
+                            'deliver', self, message, meta.get('conndata'),
+                            **kw
+                        )
+            return super(MailServer, self).send_email(message, **kw)
+
+    @api.model
+    def get_mail_queue_status(self):
+        '''Return the status of the outgoing queue.
+
+        See `~xopgi.xopgi_mail_threads.mail_queue.MailQueue.stats`:meth:.
+
+        .. versionadded:: 7.0
+
+        '''
+        from .mail_queue import get_mail_queue
+        queue = get_mail_queue(self.env.cr.dbname, _deliver_queued_email)
+        return queue.stats()
+
+    @api.model
+    def get_transport_metrics(self):
+        '''Return the calls, failures and latencies of the transports.
+
+        The result is a dict from the name of each transport to a dict from
+        the method ('query', 'prepare_message', 'deliver', etc) to the metric
+        (see `~xopgi.xopgi_mail_threads.instrumentation.get_metrics`:func:).
+        Only the calls made in this process are counted.
+
+        .. versionadded:: 7.0
+
+        '''
+        result = {}
+        metrics = get_metrics(self.env.cr.dbname, TRANSPORT)
+        for (_, _, name, method), metric in metrics.items():
+            result.setdefault(name, {})[method] = metric
+        return result
+
+    @api.model
+    def get_transport_cache_stats(self):
+        '''Return the hits, misses and hit rate of the cache of transports.
+
+        See `~xopgi.xopgi_mail_threads.transports.QueryCache`:class:.
+
+        .. versionadded:: 7.0
+
+        '''
+        from .transports import get_query_cache
+        return get_query_cache().stats()
+
+    def _register_hook(self):
+        # Deliver the messages left in the queue by previous runs.
+        result = super(MailServer, self)._register_hook()
+        if self._is_queued_send():
+            from .mail_queue import get_mail_queue
+            get_mail_queue(self.env.cr.dbname, _deliver_queued_email).start()
+        return result
+
     @api.model
     def send_without_transports(self, message, **kw):
         '''Send a message without using third-party transports.'''
         with execution_context(DIRECT_SEND_CONTEXT):
             self.send_email(message, **kw)
 
+    @api.model
+    def connect(self, *args, **kwargs):
+        '''Connect to the SMTP server.
+
+        Inside the `POOLED_SMTP_CONTEXT` take the connection from the pool
+        (see `~xopgi.xopgi_mail_threads.smtp_pool`:mod:).
+
+        '''
+        _super = super(MailServer, self).connect
+        if POOLED_SMTP_CONTEXT not in execution_context:
+            return _super(*args, **kwargs)
+        from .smtp_pool import get_smtp_pool
+        key = self._get_smtp_pool_key(*args, **kwargs)
+        return get_smtp_pool().acquire(key, lambda: _super(*args, **kwargs))
+
+    @api.model
+    def _get_smtp_pool_key(self, host=None, port=None, user=None,
+                           password=None, encryption=False, smtp_debug=False,
+                           mail_server_id=None):
+        # Since Odoo 11, `connect` finds the server if no host is given.
+        if not host:
+            if mail_server_id:
+                server = self.sudo().browse(mail_server_id)
+            else:
+                server = self.sudo().search([], order='sequence', limit=1)
+            if server:
+                host, port = server.smtp_host, server.smtp_port
+                user, encryption = server.smtp_user, server.smtp_encryption
+            else:
+                from xoeuf.odoo.tools import config
+                host = config.get('smtp_server')
+                port = config.get('smtp_port', 25)
+                user = config.get('smtp_user')
+                encryption = 'ssl' if config.get('smtp_ssl') else 'none'
+        return (host, int(port or 25), user or None, encryption or 'none')
+
+
+#: The result of sending each message in `MailServer.send_emails`.
+#: `message_id` is the result of ``send_email``; `error` the exception raised.
+SendResult = namedtuple('SendResult', 'message_id, error')
+
+
+def _get_conndata_key(conndata):
+    try:
+        key = tuple(sorted(dict(conndata or {}).items()))
+        hash(key)
+        return key
+    except TypeError:
+        return id(conndata)
+
+
+def _get_transport_name(transport):
+    cls = transport if isinstance(transport, type) else type(transport)
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+def _deliver_queued_email(dbname, meta, raw):
+    # Called by the threads of the queue.
+    import email
+    from xoeuf import odoo
+    from xoeuf import SUPERUSER_ID
+    parse = getattr(email, 'message_from_bytes', email.message_from_string)
+    message = parse(raw)
+    with api.Environment.manage():
+        with odoo.registry(dbname).cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            env['ir.mail_server']._deliver_queued_email(message, meta)
+
+
+def _get_delivery_exception():
+    try:
+        from odoo.addons.base.ir.ir_mail_server import MailDeliveryException
+    except ImportError:
+        # Odoo 12
+        from odoo.addons.base.models.ir_mail_server import \
+            MailDeliveryException
+    return MailDeliveryException
+
+
+_NOT_DELIVERED = object()
+_NOT_QUEUED = object()
+
+#: The arguments of `send_email` with connections, which cannot be queued.
+_CONNECTION_KWARGS = ('smtp_session', )
+
+#: The system parameter to choose how `MailServer.send_email` sends emails.
+SEND_MODE_PARAM = 'xopgi_mail_threads.send_mode'
+DIRECT_MODE = 'direct'
+QUEUED_MODE = 'queued'
+
+#: Inside this context, `MailServer.send_email` doesn't queue messages.
+QUEUE_WORKER_CONTEXT = object()
 
 DIRECT_SEND_CONTEXT = object()
+
+#: Inside this context, `MailServer.connect` reuses connections.
+POOLED_SMTP_CONTEXT = object()
 neither = lambda *args: all(not a for a in args)
@@ -29,13 +29,33 @@ from __future__ import (division as _py3_division,
                         print_function as _py3_print,
                         absolute_import as _py3_abs_import)
 
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from email.message import Message
+
+from xoutil.context import context as execution_context
 from xoutil.eight.meta import metaclass
-from xoutil.future.codecs import safe_encode
+from xoutil.future.collections import namedtuple
 
 from xoeuf import api
 from xoeuf.models import AbstractModel
 
+from .parsing import parse_message, parse_headers, get_raw_bytes
+from .utils import (
+    create_bounce_route,
+    create_ignore_route,
+    AUTO_REPLIED,
+    AUTO_GENERATED,
+    DELIVERY_STATUS_NOTIFICATION,
+    DISPOSITION_NOTIFICATION,
+)
+from .diagnostics import log_message_failure
+from .instrumentation import timed, get_metrics, ROUTER
+from .bounce_stats import BOUNCE_BATCH_CONTEXT
+
 import logging
+from logging import WARNING
 logger = logging.getLogger(__name__)
 del logging
 
@@ -44,55 +64,128 @@ class MailThread(AbstractModel):
     _inherit = 'mail.thread'
 
     @api.model
-    def _customize_routes(self, message, routes):
-        from .routers import MailRouter
+    def _customize_routes(self, message, routes, quiet=False):
+        # If `quiet` is True, finding no routes is not logged (e.g routing
+        # automatic responses, where Odoo's routing follows).
+        from .routers import MailRouter, RouteSet
         logger.debug('Processing incomming message with custom routers')
-        for router in MailRouter.get_installed_objects(self):
+        # Routers get the `Message`; the parsed message is attached to it.
+        parsed = parse_message(message)
+        message = parsed.message
+        routes = RouteSet(routes)
+        dbname = self.env.cr.dbname
+        for router in MailRouter.get_candidates(self, message):
             # Since a router may fail after modifying `routes` somehow, let's
-            # keep it safe here to restore if needed.
-            routes_copy = routes[:]
+            # record the changes to undo them if needed.
+            routes.begin()
             try:
-                result = router.query(self, message)
+                result = timed(dbname, ROUTER, router, 'query',
+                               self, message)
                 if isinstance(result, tuple):
                     valid, data = result
                 else:
                     valid, data = result, None
                 if valid:
                     logger.debug('Processing message using router %r', router)
-                    router.apply(self, routes, message, data=data)
+                    timed(dbname, ROUTER, router, 'apply',
+                          self, routes, message, data=data)
             except Exception:
-                logger.exception('Router %s failed.  Ignoring it.', router)
-                routes = routes_copy
-        if not routes:
-            import email
-            from email.message import Message
-            if not isinstance(message, Message):
-                message = email.message_from_string(safe_encode(message))
-            logger.warn(
+                log_message_failure(logger, message,
+                                    'Router %s failed.  Ignoring it.', router)
+                routes.rollback()
+            else:
+                routes.commit()
+                if valid and router.final:
+                    logger.debug('Final router %r applied', router)
+                    break
+        if not routes and not quiet:
+            log_message_failure(
+                logger, message,
                 "No routes found for message coming from %r.",
-                message.get('Sender', message.get('From', '<>')),
-                extra=dict(
-                    message_id=message.get('Message-Id', '<>'),
-                    sender=message.get('Sender', message.get('From', '<>')),
-                    recipients=[
-                        message.get('To'),
-                        message.get('Delivered-To'),
-                        message.get('Cc'),
-                    ]
-                )
+                parsed.sender,
+                level=WARNING,
+                exc_info=False
             )
         else:
-            logger.debug(
-                "Message accepted, coming from %r",
-                message.get('Sender', message.get('From', '<>')),
-            )
+            logger.debug("Message accepted, coming from %r", parsed.sender)
         return routes
 
+    @api.model
+    def message_process(self, model, message, custom_values=None,
+                        save_original=False, strip_attachments=False,
+                        thread_id=None):
+        # Automatic responses that are ignored or bounced are routed with
+        # the headers only (see `_pre_route`).
+        pre_routed = []
+        if not isinstance(message, Message):
+            parsed = parse_headers(get_raw_bytes(message))
+            routes = self._pre_route(parsed)
+            if routes is not None and not _is_headers_only(routes):
+                # The message must be fully parsed, but the routers are not
+                # queried again: `message_route` takes these routes.
+                pre_routed.append(routes)
+            elif routes is not None:
+                msg = self._message_parse_headers(parsed)
+                message_id = msg.get('message_id')
+                Messages = self.env['mail.message']
+                if message_id and \
+                   Messages._find_by_message_ids([message_id])[message_id]:
+                    logger.info(
+                        'Ignored mail from %s to %s with Message-Id %s: '
+                        'found duplicated Message-Id during processing',
+                        msg.get('from'), msg.get('to'), message_id
+                    )
+                    return False
+                with _collecting_delivery_reports(self):
+                    self._accept_pre_routed(parsed)
+                return self.message_route_process(parsed.message, msg,
+                                                  routes)
+        with execution_context(PRE_ROUTED_CONTEXT, routes=pre_routed):
+            return super(MailThread, self).message_process(
+                model, message,
+                custom_values=custom_values,
+                save_original=save_original,
+                strip_attachments=strip_attachments,
+                thread_id=thread_id,
+            )
+
     @api.model
     def message_route(self, message, message_dict, model=None, thread_id=None,
                       custom_values=None):
+        options = dict(model=model, thread_id=thread_id,
+                       custom_values=custom_values)
+        if execution_context[BOUNCE_BATCH_CONTEXT].get('reports') is None:
+            # The delivery reports of a single message are written at once
+            # after routing it, as those of a chunk in
+            # `message_process_batch`.
+            with _collecting_delivery_reports(self):
+                return self._xopgi_message_route(message, message_dict,
+                                                 **options)
+        else:
+            return self._xopgi_message_route(message, message_dict,
+                                             **options)
+
+    @api.model
+    def _xopgi_message_route(self, message, message_dict, model=None,
+                             thread_id=None, custom_values=None):
+        # The body of `message_route`; it must not call `message_route`
+        # again, or overrides of other addons would run twice.
         result = []
         error_before_custom_routes = None
+        parsed = parse_message(message)
+        message = parsed.message
+        # Only the first call inside `message_process` is about the message
+        # pre-routed there.
+        pending = execution_context[PRE_ROUTED_CONTEXT].get('routes')
+        pre_routed = pending.pop() if pending else None
+        self._record_delivery_reports(parsed)
+        routes = self._route_automatic_response(parsed, routes=pre_routed)
+        if routes:
+            return routes
+        # With the action 'routers', the routers have already been queried
+        # and found nothing; don't query them again.
+        kind, action = self._get_automatic_response_action(parsed)
+        query_routers = not kind or action != ROUTERS_ACTION
         try:
             _super = super(MailThread, self).message_route
             result = _super(message, message_dict, model=model,
@@ -106,7 +199,8 @@ class MailThread(AbstractModel):
             # In Odoo 9 super's message_route may raise an AssertionError if
             # the fallback model (i.e crm.lead) is not installed.
             error_before_custom_routes = error
-        result = self._customize_routes(message, result or [])
+        if query_routers:
+            result = self._customize_routes(message, result or [])
         if result:
             return result
         elif error_before_custom_routes:
@@ -114,5 +208,460 @@ class MailThread(AbstractModel):
         else:
             return []
 
+    @api.model
+    def message_route_process(self, message, message_dict, routes):
+        '''Process the ignore and bounce routes without creating records.
+
+        The other routes are processed by Odoo.  If there are only ignore and
+        bounce routes, return False.
+
+        .. versionadded:: 7.0
+
+        '''
+        from .stdroutes import is_std_route, process_std_route
+        others = []
+        for route in routes or ():
+            if is_std_route(route):
+                process_std_route(self, route, message_dict)
+            else:
+                others.append(route)
+        if others:
+            _super = super(MailThread, self).message_route_process
+            return _super(message, message_dict, others)
+        else:
+            return False
+
+    @api.model
+    def _record_delivery_reports(self, parsed):
+        '''Count the bounces and complaints reported by the message.
+
+        The reports are collected in the `BOUNCE_BATCH_CONTEXT` opened by
+        `message_route`:meth:, `message_process`:meth: or
+        `message_process_batch`:meth: and written with
+        `_write_delivery_reports`:meth:.  See
+        `~xopgi.xopgi_mail_threads.bounce_stats`:mod:.
+
+        .. versionadded:: 7.0
+
+        '''
+        from .dsn import get_report_type, parse_reports, parse_reports_stream
+        message = parsed.message
+        if not get_report_type(message):
+            return
+        try:
+            if parsed.headers_only:
+                from io import BytesIO
+                reports = parse_reports_stream(BytesIO(parsed.raw_bytes))
+            else:
+                reports = parse_reports(message)
+            if reports:
+                with self.env.cr.savepoint():
+                    Stats = self.env['xopgi.mail_threads.bounce_stat'].sudo()
+                    Stats.record_reports(reports)
+        except Exception:
+            log_message_failure(logger, message,
+                                'Failed to record the delivery reports')
+
+    @api.model
+    def _write_delivery_reports(self, reports):
+        '''Write the delivery `reports` collected while routing.
+
+        See `_record_delivery_reports`:meth:.
+
+        .. versionadded:: 7.0
+
+        '''
+        if reports:
+            try:
+                with self.env.cr.savepoint():
+                    self.env['xopgi.mail_threads.bounce_stat'].sudo()\
+                        ._write_reports(reports)
+            except Exception:
+                logger.exception('Failed to record the delivery reports')
+
+    @api.model
+    def _route_automatic_response(self, parsed, routes=None):
+        '''Route an automatic response without the standard routing.
+
+        The action for each class of automatic response is the system
+        parameter ``xopgi_mail_threads.automatic_responses.<class>`` (see
+        `AUTOMATIC_RESPONSE_CLASSES`:data:):
+
+        - 'route' (the default) routes it as any other message;
+
+        - 'ignore' and 'bounce' return the ignore and bounce routes (see
+          `~xopgi.xopgi_mail_threads.utils.create_ignore_route`:func:);
+
+        - 'routers' returns the routes of the mail routers only (e.g those
+          with `match_automatic_responses`).  If they find no route, the
+          message gets the standard routes of Odoo as they are: the routers
+          are not queried again, so they never see (nor change) those
+          routes.
+
+        Return the routes or None if the message must be routed as usual.
+        If `routes` is not None, they are the routes already found by
+        `_pre_route`:meth: and they're used instead of routing again.
+
+        .. versionadded:: 7.0
+
+        '''
+        kind, action = self._get_automatic_response_action(parsed)
+        if not kind:
+            return None
+        if routes is None:
+            routes = self._get_automatic_response_routes(parsed, action)
+        if not routes:
+            action = ROUTE_ACTION
+        _count_automatic_response(self.env.cr.dbname, kind, action)
+        logger.debug('Automatic response %s (%s): %s',
+                     parsed.message_id, kind, action)
+        return routes
+
+    @api.model
+    def _get_automatic_response_action(self, parsed):
+        # Return the class of automatic response and the action; the class
+        # is None if the message is not an automatic response.
+        kind = AUTOMATIC_RESPONSE_CLASSES.get(parsed.automatic_response_type)
+        if not kind:
+            return None, ROUTE_ACTION
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        return kind, get_param(AUTOMATIC_RESPONSE_PARAM % kind, ROUTE_ACTION)
+
+    @api.model
+    def _get_automatic_response_routes(self, parsed, action):
+        message = parsed.message
+        if action == IGNORE_ACTION:
+            return [create_ignore_route(message)]
+        elif action == BOUNCE_ACTION:
+            return [create_bounce_route(message)]
+        elif action == ROUTERS_ACTION:
+            return self._customize_routes(message, [], quiet=True)
+        else:
+            return None
+
+    @api.model
+    def _pre_route(self, parsed):
+        '''Route a message of which we have only the headers.
+
+        `parsed` is the result of
+        `~xopgi.xopgi_mail_threads.parsing.parse_headers`:func:.  Return the
+        routes if the message is an automatic response that is ignored or
+        bounced (see `_route_automatic_response`:meth:); otherwise return
+        None and the message must be fully parsed and routed.
+
+        With the action 'routers', the routers are queried only if all the
+        candidates are `headers_only`.  Their routes are returned even if
+        they are empty or need the full message (i.e they are not just
+        ignore or bounce routes).  In that case, the message must be fully
+        parsed, and `message_route` must be called inside
+        ``execution_context(PRE_ROUTED_CONTEXT, routes=[routes])`` so that
+        the routers are not queried again.
+
+        Nothing is recorded; if the routes are used without calling
+        `message_route`, call `_accept_pre_routed`:meth:.
+
+        .. versionadded:: 7.0
+
+        '''
+        from .routers import MailRouter
+        kind, action = self._get_automatic_response_action(parsed)
+        if not kind or action == ROUTE_ACTION:
+            return None
+        if action == ROUTERS_ACTION:
+            candidates = MailRouter.get_candidates(self, parsed.message)
+            if not all(router.headers_only for router in candidates):
+                return None
+        return self._get_automatic_response_routes(parsed, action) or []
+
+    @api.model
+    def _accept_pre_routed(self, parsed):
+        '''Record the message routed by `_pre_route`:meth:.
+
+        Count the delivery reports and the automatic response, as
+        `message_route` would.
+
+        .. versionadded:: 7.0
+
+        '''
+        self._record_delivery_reports(parsed)
+        kind, action = self._get_automatic_response_action(parsed)
+        _count_automatic_response(self.env.cr.dbname, kind, action)
+        logger.debug('Automatic response %s (%s): %s (headers only)',
+                     parsed.message_id, kind, action)
+
+    @api.model
+    def _message_parse_headers(self, parsed):
+        '''Return the message dict of a message without body.
+
+        Like ``message_parse`` but only with the values taken from the
+        headers.  The body is empty and there are no attachments.
+
+        .. versionadded:: 7.0
+
+        '''
+        get = parsed.get_header
+        return {
+            'message_type': 'email',
+            'message_id': parsed.message_id,
+            'subject': get('Subject'),
+            'email_from': get('From'),
+            'from': get('From'),
+            'to': get('To'),
+            'cc': get('Cc'),
+            'references': get('References'),
+            'in_reply_to': get('In-Reply-To'),
+            'body': '',
+            'attachments': [],
+        }
+
+    @api.model
+    def get_automatic_response_counters(self):
+        '''Return the number of automatic responses received by this process.
+
+        The result is a dict from each class of automatic responses to a
+        dict from the action taken (see `_route_automatic_response`:meth:)
+        to the number of messages.
+
+        .. versionadded:: 7.0
+
+        '''
+        result = {}
+        dbname = self.env.cr.dbname
+        for (db, kind, action), count in list(_automatic_responses.items()):
+            if db == dbname:
+                result.setdefault(kind, {})[action] = count
+        return result
+
+    @api.model
+    def get_router_metrics(self):
+        '''Return the calls, failures and latencies of the routers.
+
+        The result is a dict from the name of each router to a dict from the
+        method ('query' or 'apply') to the metric (see
+        `~xopgi.xopgi_mail_threads.instrumentation.get_metrics`:func:).  Only
+        the calls made in this process are counted.
+
+        .. versionadded:: 7.0
+
+        '''
+        result = {}
+        metrics = get_metrics(self.env.cr.dbname, ROUTER)
+        for (_, _, name, method), metric in metrics.items():
+            result.setdefault(name, {})[method] = metric
+        return result
+
+    @api.model
+    def message_process_batch(self, model, messages, custom_values=None,
+                              save_original=False, strip_attachments=False,
+                              thread_id=None, commit_size=None):
+        '''Process several incoming messages.
+
+        This is the batch version of ``message_process``, and it takes the
+        same arguments, except that `messages` is an iterable of raw
+        messages.
+
+        Messages are processed in chunks.  In each chunk, all messages are
+        parsed and routed first; then they are delivered to their threads
+        grouped by ``(model, thread_id)``; finally their raw emails are
+        stored at once.  If `commit_size` is set, chunks have that many
+        messages and the transaction is committed after each chunk.
+
+        Each message is still delivered with ``message_route_process`` (i.e
+        ``message_post`` or ``message_new``), so its ``mail.message`` is
+        created on its own.  Creating them in bulk would skip what those
+        methods do (followers, notifications, the hooks of other addons).
+        Only the search for duplicates and the writes of the raw emails are
+        done in bulk.
+
+        A message that fails doesn't stop the others; its changes are rolled
+        back and the error is logged.
+
+        Return a list with a `BatchResult`:class: per message in the same
+        order as `messages`.
+
+        .. versionadded:: 7.0
+
+        '''
+        results = []
+        for chunk in _chunks(messages, commit_size or BATCH_SIZE):
+            results.extend(self._message_process_chunk(
+                model, chunk,
+                custom_values=custom_values,
+                save_original=save_original,
+                strip_attachments=strip_attachments,
+                thread_id=thread_id,
+            ))
+            if commit_size:
+                self.env.cr.commit()
+        return results
+
+    @api.model
+    def _message_process_chunk(self, model, chunk, custom_values=None,
+                               save_original=False, strip_attachments=False,
+                               thread_id=None):
+        from .mail_messages import RAW_EMAIL_ATTR
+        cr = self.env.cr
+        results = [None] * len(chunk)
+
+        def failed(pos, message_id, error):
+            logger.exception('Failed to process message %s', message_id)
+            results[pos] = BatchResult(message_id, None, error)
+
+        # Automatic responses that are ignored or bounced get their routes
+        # here, with the headers only (see `_pre_route`).
+        parsed = []
+        for pos, raw in enumerate(chunk):
+            try:
+                with cr.savepoint():
+                    raw = get_raw_bytes(raw)
+                    headers = parse_headers(raw)
+                    routes = self._pre_route(headers)
+                    if routes is not None and _is_headers_only(routes):
+                        message = headers.message
+                        msg = self._message_parse_headers(headers)
+                    else:
+                        message = parse_message(raw).message
+                        msg = self.message_parse(message,
+                                                 save_original=save_original)
+                        if strip_attachments:
+                            msg.pop('attachments', None)
+            except Exception as error:
+                failed(pos, None, error)
+            else:
+                parsed.append((pos, message, msg, routes))
+
+        # Look for the messages already processed with a single query.
+        message_ids = [msg['message_id'] for _, _, msg, _ in parsed
+                       if msg.get('message_id')]
+        if message_ids:
+            seen = set(self.env['mail.message'].search(
+                [('message_id', 'in', message_ids)]
+            ).mapped('message_id'))
+        else:
+            seen = set()
+
+        routed = []
+        reports = []
+        for pos, message, msg, routes in parsed:
+            message_id = msg.get('message_id')
+            if message_id in seen:
+                logger.info(
+                    'Ignored mail from %s to %s with Message-Id %s: found '
+                    'duplicated Message-Id during processing',
+                    msg.get('from'), msg.get('to'), message_id
+                )
+                results[pos] = BatchResult(message_id, False, None)
+                continue
+            if message_id:
+                seen.add(message_id)
+            mark = len(reports)
+            try:
+                # Count the bounces of the whole chunk at once.
+                with execution_context(BOUNCE_BATCH_CONTEXT,
+                                       reports=reports), cr.savepoint():
+                    if routes is not None and _is_headers_only(routes):
+                        self._accept_pre_routed(parse_message(message))
+                    else:
+                        pre_routed = [routes] if routes is not None else []
+                        with execution_context(PRE_ROUTED_CONTEXT,
+                                               routes=pre_routed):
+                            routes = self.message_route(
+                                message, msg, model, thread_id,
+                                custom_values
+                            )
+            except Exception as error:
+                del reports[mark:]
+                failed(pos, message_id, error)
+            else:
+                routed.append((pos, message, msg, routes))
+        self._write_delivery_reports(reports)
+
+        # Deliver the messages of each thread together.  `sort` is stable so
+        # messages of the same thread keep their order.
+        routed.sort(key=lambda item: _get_routes_key(item[3]))
+        raw_emails = {}
+        for pos, message, msg, routes in routed:
+            message_id = msg.get('message_id')
+            raw_email = msg.pop(RAW_EMAIL_ATTR, None)
+            try:
+                with cr.savepoint():
+                    res = self.message_route_process(message, msg, routes)
+            except Exception as error:
+                failed(pos, message_id, error)
+            else:
+                if raw_email and message_id:
+                    raw_emails[message_id] = raw_email
+                results[pos] = BatchResult(message_id, res, None)
+        if raw_emails:
+            self.env['mail.message']._write_raw_emails(raw_emails)
+        return results
+
+
+def _is_headers_only(routes):
+    # Whether the message can be processed with the headers only: all the
+    # routes are ignore or bounce routes.
+    from .stdroutes import is_std_route
+    return bool(routes) and all(is_std_route(route) for route in routes)
+
+
+@contextmanager
+def _collecting_delivery_reports(obj):
+    # Collect the delivery reports in the BOUNCE_BATCH_CONTEXT, and write
+    # them when (and if) the block finishes.
+    reports = []
+    with execution_context(BOUNCE_BATCH_CONTEXT, reports=reports):
+        yield
+    obj._write_delivery_reports(reports)
+
+
+# The context to pass the routes found by `_pre_route` to `message_route`.
+PRE_ROUTED_CONTEXT = object()
+
+
+#: The result of processing each message in `message_process_batch`.
+#: `thread_id` is the result of ``message_process`` (False for duplicated
+#: or ignored messages), `error` is the exception if the message failed.
+BatchResult = namedtuple('BatchResult', 'message_id, thread_id, error')
+
+#: The default size of the chunks in `message_process_batch`.
+BATCH_SIZE = 100
+
+
+#: The names of the classes of automatic responses.
+AUTOMATIC_RESPONSE_CLASSES = {
+    AUTO_REPLIED: 'auto_replied',
+    AUTO_GENERATED: 'auto_generated',
+    DELIVERY_STATUS_NOTIFICATION: 'delivery_status',
+    DISPOSITION_NOTIFICATION: 'disposition',
+}
+
+#: The system parameter with the action for each class.
+AUTOMATIC_RESPONSE_PARAM = 'xopgi_mail_threads.automatic_responses.%s'
+ROUTE_ACTION = 'route'
+IGNORE_ACTION = 'ignore'
+BOUNCE_ACTION = 'bounce'
+ROUTERS_ACTION = 'routers'
+
+_automatic_responses = Counter()
+_automatic_responses_lock = threading.Lock()
+
+
+def _count_automatic_response(dbname, kind, action):
+    with _automatic_responses_lock:
+        _automatic_responses[dbname, kind, action] += 1
+
+
+def _chunks(iterable, size):
+    from itertools import islice
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
+
+
+def _get_routes_key(routes):
+    return tuple((route[0], route[1] or 0) for route in routes)
+
 
 del metaclass, AbstractModel
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+'''Parse incoming messages once for the whole routing pipeline.
+
+An incoming email goes through `message_parse`, `message_route` and every
+installed `mail router <MailRouter>`:class:.  All of them look at the same
+headers, so we parse the email once and attach a `ParsedMessage`:class: to
+the `email.message.Message`:class: object that travels along the pipeline.
+The attached object caches the decoded headers, the recipients and the
+automatic-response classification.
+
+Use `parse_message`:func: to get it::
+
+   >>> parsed = parse_message(message)
+   >>> parsed.recipient_addresses
+   ('someone@example.com',)
+
+`parse_headers`:func: parses only the headers of a raw email; the body is
+never parsed, so the parts (and attachments) are never built.  It's used to
+route automatic responses that are ignored or bounced (see
+``mail.thread._pre_route``).
+
+'''
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import re
+import email
+from email.message import Message
+
+from xoutil.eight import string_types
+from xoeuf import MAJOR_ODOO_VERSION
+
+
+#: The attribute of `email.message.Message` holding the parsed message.
+PARSED_MESSAGE_ATTR = '_xopgi_parsed_message'
+
+
+def parse_message(message):
+    '''Return the `ParsedMessage`:class: for `message`.
+
+    `message` may be the raw email (bytes or text), an
+    `email.message.Message`:class: or a `ParsedMessage`:class:.  The email is
+    parsed only if it is raw; a message that was already parsed returns the
+    same object every time.
+
+    '''
+    if isinstance(message, ParsedMessage):
+        return message
+    if not isinstance(message, Message):
+        raw = message
+        message = _message_from_raw(raw)
+    else:
+        raw = None
+    result = getattr(message, PARSED_MESSAGE_ATTR, None)
+    if result is None:
+        result = ParsedMessage(message, raw=raw)
+        setattr(message, PARSED_MESSAGE_ATTR, result)
+    return result
+
+
+def parse_headers(raw):
+    '''Return a `ParsedMessage`:class: with only the headers of `raw`.
+
+    `raw` is the raw email (bytes or text).  The `message` of the result has
+    the headers and an empty body, and its `headers_only` is True.  The
+    `raw` email is kept.
+
+    '''
+    message = _headers_from_raw(raw)
+    result = ParsedMessage(message, raw=raw, headers_only=True)
+    setattr(message, PARSED_MESSAGE_ATTR, result)
+    return result
+
+
+def get_raw_bytes(message):
+    '''Convert the raw `message` to bytes as ``message_process`` does.
+
+    `message` may be bytes, text (encoded in UTF-8) or a
+    `xmlrpclib.Binary`:class:.
+
+    '''
+    from six.moves.xmlrpc_client import Binary
+    if isinstance(message, Binary):
+        message = bytes(message.data)
+    if not isinstance(message, bytes):
+        message = message.encode('utf-8')
+    return message
+
+
+def _message_from_raw(raw):
+    # Parse exactly as `mail.thread.message_process` does in each version of
+    # Odoo, because `message_parse` will check the type of the result.
+    if isinstance(raw, bytes):
+        extract = getattr(email, 'message_from_bytes',
+                          email.message_from_string)
+    else:
+        assert isinstance(raw, string_types)
+        extract = email.message_from_string
+    if MAJOR_ODOO_VERSION < 12:
+        return extract(raw)
+    else:
+        from email import policy
+        return extract(raw, policy=policy.SMTP)
+
+
+def _headers_from_raw(raw):
+    # Parse only the header block; the body is not even copied.
+    match = _END_OF_HEADERS[isinstance(raw, bytes)].search(raw)
+    if match:
+        raw = raw[:match.end()]
+    kwargs = {}
+    if MAJOR_ODOO_VERSION >= 12:
+        from email import policy
+        kwargs['policy'] = policy.SMTP
+    if isinstance(raw, bytes):
+        try:
+            from email.parser import BytesHeaderParser
+        except ImportError:
+            # Python 2: str is bytes.
+            from email.parser import HeaderParser
+            return HeaderParser(**kwargs).parsestr(raw)
+        return BytesHeaderParser(**kwargs).parsebytes(raw)
+    else:
+        from email.parser import HeaderParser
+        return HeaderParser(**kwargs).parsestr(raw)
+
+
+_END_OF_HEADERS = {
+    True: re.compile(br'\r?\n\r?\n'),
+    False: re.compile(r'\r?\n\r?\n'),
+}
+
+
+def _cached(func):
+    '''Make a property that computes `func` only once per parsed message.'''
+    name = func.__name__
+
+    def getter(self):
+        try:
+            return self._cache[name]
+        except KeyError:
+            result = self._cache[name] = func(self)
+            return result
+
+    getter.__name__ = name
+    getter.__doc__ = func.__doc__
+    return property(getter)
+
+
+class ParsedMessage(object):
+    '''An incoming email parsed once.
+
+    Attributes:
+
+    .. attribute:: message
+
+       The `email.message.Message`:class: object.
+
+    .. attribute:: raw
+
+       The raw email, if the message was parsed from it; otherwise None.
+
+    .. attribute:: headers_only
+
+       True if only the headers were parsed (see `parse_headers`:func:).
+
+    All other attributes are computed on first access and cached.  If you
+    change the headers of `message`, call `invalidate`:meth:.
+
+    '''
+    def __init__(self, message, raw=None, headers_only=False):
+        self.message = message
+        self.raw = raw
+        self.headers_only = headers_only
+        self._cache = {}
+
+    @property
+    def raw_bytes(self):
+        '''The `raw`:attr: email as bytes (text is encoded in UTF-8).'''
+        raw = self.raw
+        if raw is None or isinstance(raw, bytes):
+            return raw
+        else:
+            return raw.encode('utf-8')
+
+    def invalidate(self):
+        '''Forget all the values computed from the message's headers.'''
+        self._cache.clear()
+
+    def get_header(self, header, default=''):
+        '''Return the decoded value of `header`.
+
+        If the header is not present return `default`.
+
+        '''
+        key = ('header', header.lower())
+        try:
+            result = self._cache[key]
+        except KeyError:
+            from .utils import decode_header
+            if header in self.message:
+                result = decode_header(self.message, header)
+            else:
+                result = None
+            self._cache[key] = result
+        return result if result is not None else default
+
+    def get_recipients(self, also=None):
+        '''Same as `utils.get_recipients`:func:, but cached.'''
+        key = ('recipients', tuple(also or ()))
+        try:
+            return self._cache[key]
+        except KeyError:
+            from .utils import get_recipients
+            result = self._cache[key] = get_recipients(self.message, also=also)
+            return result
+
+    @_cached
+    def sender(self):
+        '''The raw value of the 'Sender' header or the 'From' if missing.'''
+        message = self.message
+        return message.get('Sender', message.get('From', '<>'))
+
+    @_cached
+    def message_id(self):
+        '''The value of the 'Message-Id' header (stripped) or None.'''
+        result = self.message.get('Message-Id')
+        return result.strip() if result else None
+
+    @_cached
+    def recipients(self):
+        '''The pairs of ``(name, address)`` of all recipients.
+
+        This includes the 'Delivered-To' header.
+
+        '''
+        return self.get_recipients(also=['Delivered-To'])
+
+    @_cached
+    def recipient_addresses(self):
+        '''The lower-cased addresses of the `recipients`:attr: (no dups).'''
+        return _unique(
+            address.strip().lower() for _, address in self.recipients
+        )
+
+    @_cached
+    def recipient_domains(self):
+        '''The domains of the `recipient_addresses`:attr: (no dups).'''
+        return _unique(
+            address.rpartition('@')[-1] for address in self.recipient_addresses
+        )
+
+    @_cached
+    def automatic_response_type(self):
+        '''The result of `utils.get_automatic_response_type`:func:.'''
+        from .utils import get_automatic_response_type
+        return get_automatic_response_type(self.message)
+
+    @property
+    def is_automatic_response(self):
+        return bool(self.automatic_response_type)
+
+    def __repr__(self):
+        return '<ParsedMessage %s>' % (self.message_id or '<>')
+
+
+def _unique(items):
+    '''Return a tuple of the non-empty `items` without duplicates.'''
+    seen = set()
+    result = []
+    for item in items:
+        if item and item not in seen:
+            seen.add(item)
+            result.append(item)
+    return tuple(result)
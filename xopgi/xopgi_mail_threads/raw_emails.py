@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+'''A compressed, content-addressed store for raw emails.
+
+Raw emails are big and rarely read, so storing them (base64-encoded) in the
+rows of ``mail_message`` makes that table huge.  The `RawEmailStore`:class:
+keeps them compressed in files inside the DB's filestore instead::
+
+   <filestore>/xopgi_raw_emails/<h[:2]>/<h>.<codec>
+
+where ``h`` is the SHA-256 of the raw email.  Equal emails are stored once.
+The row keeps only the reference returned by `RawEmailStore.put`:meth:,
+i.e ``'<codec>:<h>'``.
+
+The codec 'gzip' is always available.  The codec 'zstd' requires the
+`zstandard` package.
+
+.. note:: Files are not removed when the transaction that stored them is
+   rolled back or the message is deleted.  Since files are shared by equal
+   emails, removing them requires a full scan of the references.
+
+'''
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import os
+import hashlib
+import tempfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+#: The folder inside the DB's filestore.
+FOLDER = 'xopgi_raw_emails'
+
+#: The default codec.
+DEFAULT_CODEC = 'gzip'
+
+#: The size of the chunks when streaming.
+CHUNK_SIZE = 64 * 1024
+
+
+def _gzip_writer(fileobj):
+    import gzip
+    return gzip.GzipFile(fileobj=fileobj, mode='wb')
+
+
+def _gzip_reader(path):
+    import gzip
+    return gzip.open(path, 'rb')
+
+
+def _zstd_writer(fileobj):
+    return zstandard.ZstdCompressor().stream_writer(fileobj)
+
+
+def _zstd_reader(path):
+    fh = open(path, 'rb')
+    return _ClosingStream(
+        zstandard.ZstdDecompressor().stream_reader(fh),
+        fh
+    )
+
+
+class _ClosingStream(object):
+    # Close the file with the stream; not all versions of `zstandard` do it.
+    def __init__(self, stream, fh):
+        self.stream = stream
+        self.fh = fh
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def close(self):
+        self.stream.close()
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+CODECS = {
+    'gzip': (_gzip_writer, _gzip_reader),
+}
+
+if zstandard is not None:
+    CODECS['zstd'] = (_zstd_writer, _zstd_reader)
+
+
+class RawEmailStore(object):
+    '''The store of raw emails of a DB.
+
+    :param dbname: The name of the DB.
+
+    :param codec: The codec used to compress new emails.  Emails stored with
+                  other codecs are still readable.
+
+    '''
+    def __init__(self, dbname, codec=DEFAULT_CODEC):
+        if codec not in CODECS:
+            raise ValueError('Unknown codec %r' % codec)
+        self.dbname = dbname
+        self.codec = codec
+
+    @property
+    def root(self):
+        from xoeuf.odoo.tools import config
+        return os.path.join(config.filestore(self.dbname), FOLDER)
+
+    def _get_path(self, ref):
+        codec, _, digest = ref.partition(':')
+        if codec not in CODECS or not digest.isalnum():
+            raise ValueError('Invalid reference %r' % ref)
+        return os.path.join(self.root, digest[:2],
+                            '%s.%s' % (digest, codec))
+
+    def put(self, data):
+        '''Store a raw email and return its reference.
+
+        `data` may be bytes or a file-like object open in binary mode; in the
+        later case it's read and compressed in chunks.
+
+        '''
+        if isinstance(data, bytes):
+            from io import BytesIO
+            data = BytesIO(data)
+        root = self.root
+        if not os.path.isdir(root):
+            try:
+                os.makedirs(root)
+            except OSError:
+                if not os.path.isdir(root):
+                    raise
+        writer, _ = CODECS[self.codec]
+        digest = hashlib.sha256()
+        fd, tmp = tempfile.mkstemp(dir=root, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                compressed = writer(fh)
+                chunk = data.read(CHUNK_SIZE)
+                while chunk:
+                    digest.update(chunk)
+                    compressed.write(chunk)
+                    chunk = data.read(CHUNK_SIZE)
+                compressed.close()
+            ref = '%s:%s' % (self.codec, digest.hexdigest())
+            path = self._get_path(ref)
+            if os.path.exists(path):
+                os.unlink(tmp)   # already stored
+            else:
+                folder = os.path.dirname(path)
+                if not os.path.isdir(folder):
+                    try:
+                        os.makedirs(folder)
+                    except OSError:
+                        if not os.path.isdir(folder):
+                            raise
+                os.rename(tmp, path)
+        except Exception:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        return ref
+
+    def open(self, ref):
+        '''Return a file-like object to read the raw email `ref`.
+
+        The caller must close it.
+
+        '''
+        path = self._get_path(ref)
+        _, reader = CODECS[ref.partition(':')[0]]
+        return reader(path)
+
+    def get(self, ref):
+        '''Return the raw email `ref` as bytes.'''
+        stream = self.open(ref)
+        try:
+            chunks = []
+            chunk = stream.read(CHUNK_SIZE)
+            while chunk:
+                chunks.append(chunk)
+                chunk = stream.read(CHUNK_SIZE)
+            return b''.join(chunks)
+        finally:
+            stream.close()
+
+    def exists(self, ref):
+        return os.path.exists(self._get_path(ref))
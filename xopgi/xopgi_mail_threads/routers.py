@@ -11,8 +11,10 @@ from __future__ import (division as _py3_division,
                         print_function as _py3_print,
                         absolute_import as _py3_abs_import)
 
+import re
+
 from xoutil.eight.meta import metaclass
-from .utils import RegisteredType
+from .utils import RegisteredType, get_message_ids
 
 
 class MailRouter(metaclass(RegisteredType)):
@@ -35,8 +37,10 @@ class MailRouter(metaclass(RegisteredType)):
     integrate well with other systems.
 
     Mail routers are allowed to change the routes previously detected by
-    OpenERP and other routers.  They way mail routers are chained is
-    undefined.  So, mail routers are encouraged to implement op-out features.
+    OpenERP and other routers.  Mail routers are chained by their `priority`
+    (lower first; ties are broken by name).  Once a `final` router has been
+    applied no other router is queried.  Mail routers are encouraged to
+    implement op-out features.
 
     .. warning::
 
@@ -44,7 +48,61 @@ class MailRouter(metaclass(RegisteredType)):
        hybrid methods, this is, they are exposed as class methods as well as
        instance methods.
 
+    Routers may declare cheap criteria a message must meet before calling
+    `query`:meth:.  Criteria not declared (None) impose no restriction.  The
+    criteria about recipients are satisfied if any recipient (including
+    'Delivered-To') matches any of them; the other criteria must all be met.
+
+    .. attribute:: match_recipient_domains
+
+       An iterable of domains (e.g ``'example.com'``).
+
+    .. attribute:: match_recipient_addresses
+
+       An iterable of full addresses (e.g ``'support@example.com'``).
+
+    .. attribute:: match_recipient_local_parts
+
+       An iterable of local parts of addresses (e.g ``'support'``).
+
+    .. attribute:: match_recipient_patterns
+
+       An iterable of regular expressions (strings or compiled) matched
+       against the lower-cased addresses.  These cannot be indexed, so prefer
+       the other criteria.
+
+    .. attribute:: match_automatic_responses
+
+       An iterable of the values of
+       `~xopgi.xopgi_mail_threads.utils.get_automatic_response_type`:func:.
+       Include ``NOT_AUTOMATIC_RESPONSE`` to also accept normal messages.
+
+    .. attribute:: match_headers
+
+       An iterable of headers that must be present in the message.
+
+    If `headers_only` is True, the router only looks at the headers of the
+    message.  Such routers may be given a message without body (see
+    `~xopgi.xopgi_mail_threads.parsing.parse_headers`:func:) when routing
+    automatic responses with the action 'routers' (see
+    ``mail.thread._pre_route``); if they return ignore or bounce routes the
+    message is never fully parsed.  They must return those routes regardless
+    of the routes found by Odoo.
+
+    .. versionadded:: 7.0 The ``match_*`` criteria, and the attributes
+       `priority`, `final` and `headers_only`.
+
     '''
+    priority = 10
+    final = False
+    headers_only = False
+
+    match_recipient_domains = None
+    match_recipient_addresses = None
+    match_recipient_local_parts = None
+    match_recipient_patterns = None
+    match_automatic_responses = None
+    match_headers = None
 
     @classmethod
     def query(cls, obj, message):
@@ -59,6 +117,10 @@ class MailRouter(metaclass(RegisteredType)):
         :param message: The email to be routed inside OpenERP.
         :type message: :class:`email.message.Message`.
 
+        Use `~xopgi.xopgi_mail_threads.parsing.parse_message`:func: to get
+        the decoded headers, recipients and automatic-response type of the
+        message; they are computed once and shared by all routers.
+
         :returns: A tuple of ``(valid, data)``.  `valid` must be True is the
                   router can process the message.  `data` is anything that
                   will be passed as the `data` keyword argument to the `apply`
@@ -76,6 +138,8 @@ class MailRouter(metaclass(RegisteredType)):
 
         .. versionchanged:: 4.0 No more old API signature.
 
+        .. versionchanged:: 7.0 The `message` carries a parsed message.
+
         '''
         if cls is MailRouter:  # avoid failing when super()
             raise NotImplementedError()
@@ -86,7 +150,7 @@ class MailRouter(metaclass(RegisteredType)):
 
         :param routes: The routes as previously left by OpenERP and possible
                        other routers.
-        :type routes: list
+        :type routes: `RouteSet`:class:
 
         Each route must have the form::
 
@@ -99,13 +163,321 @@ class MailRouter(metaclass(RegisteredType)):
             raise NotImplementedError()
 
     @classmethod
-    def find_route(cls, routes, pred=None):
+    def find_route(cls, routes, pred=None, model=None, thread_id=None):
         '''Yields pairs of `(position, route)` of routes that match the
         predicated `pred`.
 
+        If `model` is given, only routes to that model are considered; if
+        `thread_id` is also given, only routes to that thread.  These
+        lookups use the index of `RouteSet`:class: instead of scanning all
+        the routes.
+
+        .. versionchanged:: 7.0 Added the `model` and `thread_id` arguments.
+
         '''
-        return ((i, route) for i, route in enumerate(routes)
-                if not pred or pred(route))
+        if model is None:
+            positions = range(len(routes))
+        elif isinstance(routes, RouteSet):
+            positions = routes.find(model, thread_id=thread_id)
+        else:
+            positions = [
+                i for i, route in enumerate(routes)
+                if route[0] == model
+                if thread_id is None or route[1] == thread_id
+            ]
+        return ((i, routes[i]) for i in positions
+                if not pred or pred(routes[i]))
+
+    @classmethod
+    def find_thread(cls, obj, message):
+        '''Return the thread the `message` replies to.
+
+        The thread is a pair ``(model, res_id)`` of the first message found
+        in the 'In-Reply-To' and the 'References' (from the last one) of
+        `message`; or None if none is found.
+
+        Threads are cached by Message-Id, so routers may call this for every
+        reply without querying the DB each time (see
+        `~xopgi.xopgi_mail_threads.utils.ThreadCache`:class:).  The record of
+        the thread may not exist anymore.
+
+        .. versionadded:: 7.0
+
+        '''
+        references = get_message_ids(message.get('In-Reply-To'))
+        references.extend(
+            ref
+            for ref in reversed(get_message_ids(message.get('References')))
+            if ref not in references
+        )
+        if not references:
+            return None
+        threads = obj.env['mail.message']._find_threads(references)
+        return next(
+            (threads[ref] for ref in references if ref in threads),
+            None
+        )
+
+    @classmethod
+    def get_candidates(cls, obj, message):
+        '''Return the installed routers whose criteria `message` meets.
+
+        The routers are returned in the same order as
+        `get_installed_objects`:meth:.
+
+        .. versionadded:: 7.0
+
+        '''
+        installed = MailRouter.get_installed_objects(obj)
+        index = _INDEXES.get(installed)
+        if index is None:
+            if len(_INDEXES) > MAX_INDEXES:
+                _INDEXES.clear()
+            index = _INDEXES[installed] = RouterIndex(installed)
+        return index.select(message)
+
+
+class RouteSet(list):
+    '''The list of routes passed to `MailRouter.apply`:meth:.
+
+    This is a list that records how it's changed so that the changes made by
+    a failing router can be undone, without copying the routes before each
+    router.  Call `begin`:meth: before the router is applied, and then either
+    `commit`:meth: or `rollback`:meth:.
+
+    It also keeps an index of the routes by model and thread id; see
+    `find`:meth:.
+
+    '''
+    def __init__(self, routes=()):
+        super(RouteSet, self).__init__(routes)
+        self._journal = None
+        self._index = None
+
+    def begin(self):
+        '''Start recording the changes to the routes.'''
+        self._journal = []
+
+    def commit(self):
+        '''Keep the changes since `begin`:meth: and stop recording.'''
+        self._journal = None
+
+    def rollback(self):
+        '''Undo the changes since `begin`:meth: and stop recording.'''
+        journal, self._journal = self._journal, None
+        while journal:
+            undo = journal.pop()
+            undo()
+        self._index = None
+
+    def find(self, model, thread_id=None):
+        '''Return the positions of the routes to `model`.
+
+        If `thread_id` is not None, return only the positions of the routes
+        to that thread.
+
+        '''
+        index = self._index
+        if index is None:
+            index = self._index = {}
+            for i, route in enumerate(self):
+                model_, thread_id_ = route[:2]
+                index.setdefault((model_, None), []).append(i)
+                if thread_id_ is not None:
+                    index.setdefault((model_, thread_id_), []).append(i)
+        return tuple(index.get((model, thread_id), ()))
+
+    def _changed(self, undo):
+        self._index = None
+        if self._journal is not None:
+            self._journal.append(undo)
+
+    def _snapshot(self):
+        # Fallback for changes that are hard to undo; it copies the routes.
+        old = list(self)
+        return lambda: list.__setitem__(self, slice(None), old)
+
+    def _normalize(self, i, insertion=False):
+        size = len(self)
+        if i < 0:
+            i += size
+        if insertion:
+            return min(max(i, 0), size)
+        if not 0 <= i < size:
+            raise IndexError('list index out of range')
+        return i
+
+    def append(self, route):
+        list.append(self, route)
+        self._changed(lambda: list.pop(self))
+
+    def extend(self, routes):
+        size = len(self)
+        list.extend(self, routes)
+        self._changed(lambda: list.__delitem__(self, slice(size, None)))
+
+    def __iadd__(self, routes):
+        self.extend(routes)
+        return self
+
+    def insert(self, i, route):
+        i = self._normalize(i, insertion=True)
+        list.insert(self, i, route)
+        self._changed(lambda: list.__delitem__(self, i))
+
+    def pop(self, i=-1):
+        i = self._normalize(i)
+        route = list.pop(self, i)
+        self._changed(lambda: list.insert(self, i, route))
+        return route
+
+    def remove(self, route):
+        del self[self.index(route)]
+
+    def __setitem__(self, key, value):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            old = list.__getitem__(self, key)
+            if step == 1:
+                value = list(value)
+                span = slice(start, start + len(value))
+                undo = lambda: list.__setitem__(self, span, old)
+            else:
+                undo = self._snapshot()
+        else:
+            key = self._normalize(key)
+            old = list.__getitem__(self, key)
+            undo = lambda: list.__setitem__(self, key, old)
+        list.__setitem__(self, key, value)
+        self._changed(undo)
+
+    def __delitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            old = list.__getitem__(self, key)
+            if step == 1:
+                undo = lambda: list.__setitem__(self, slice(start, start),
+                                                old)
+            else:
+                undo = self._snapshot()
+        else:
+            key = self._normalize(key)
+            old = list.__getitem__(self, key)
+            undo = lambda: list.insert(self, key, old)
+        list.__delitem__(self, key)
+        self._changed(undo)
+
+    if hasattr(list, '__setslice__'):  # Python 2
+        def __setslice__(self, i, j, value):
+            self.__setitem__(slice(i, j), value)
+
+        def __delslice__(self, i, j):
+            self.__delitem__(slice(i, j))
+
+    def _replace_all(method):
+        def replace_all(self, *args, **kwargs):
+            undo = self._snapshot()
+            result = method(self, *args, **kwargs)
+            self._changed(undo)
+            return result
+        replace_all.__name__ = method.__name__
+        return replace_all
+
+    sort = _replace_all(list.sort)
+    reverse = _replace_all(list.reverse)
+    __imul__ = _replace_all(list.__imul__)
+    if hasattr(list, 'clear'):  # Python 3
+        clear = _replace_all(list.clear)
+    del _replace_all
+
+
+class RouterIndex(object):
+    '''An index of routers by their ``match_*`` criteria.
+
+    `select`:meth: looks up the routers by the recipients' addresses, local
+    parts and domains in hash tables, so its cost depends on the number of
+    recipients and not on the number of routers.  Only routers with
+    recipient patterns and routers without recipient criteria are always
+    tested.
+
+    '''
+    def __init__(self, routers):
+        self.routers = routers = tuple(routers)
+        self.position = {router: i for i, router in enumerate(routers)}
+        self.by_domain = {}
+        self.by_address = {}
+        self.by_local_part = {}
+        self.patterns = []
+        self.unfiltered = []
+        for router in routers:
+            indexed = False
+            for attr, table in (('match_recipient_domains', self.by_domain),
+                                ('match_recipient_addresses', self.by_address),
+                                ('match_recipient_local_parts',
+                                 self.by_local_part)):
+                values = getattr(router, attr, None)
+                if values is not None:
+                    indexed = True
+                    for value in values:
+                        table.setdefault(value.lower(), set()).add(router)
+            patterns = getattr(router, 'match_recipient_patterns', None)
+            if patterns is not None:
+                indexed = True
+                self.patterns.append((
+                    router,
+                    [_compile(pattern) for pattern in patterns]
+                ))
+            if not indexed:
+                self.unfiltered.append(router)
+
+    def select(self, message):
+        '''Return the routers whose criteria `message` meets.'''
+        from .parsing import parse_message
+        parsed = parse_message(message)
+        candidates = set(self.unfiltered)
+        addresses = parsed.recipient_addresses
+        for address in addresses:
+            candidates.update(self.by_address.get(address, ()))
+            local_part, _, domain = address.rpartition('@')
+            candidates.update(self.by_local_part.get(local_part, ()))
+            candidates.update(self.by_domain.get(domain, ()))
+        for router, patterns in self.patterns:
+            if router not in candidates:
+                if any(pattern.search(address)
+                       for pattern in patterns
+                       for address in addresses):
+                    candidates.add(router)
+        return tuple(
+            router
+            for router in sorted(candidates, key=self.position.get)
+            if self._meets_other_criteria(router, parsed)
+        )
+
+    def _meets_other_criteria(self, router, parsed):
+        automatic_responses = getattr(router, 'match_automatic_responses',
+                                      None)
+        if automatic_responses is not None:
+            if parsed.automatic_response_type not in automatic_responses:
+                return False
+        headers = getattr(router, 'match_headers', None)
+        if headers is not None:
+            message = parsed.message
+            if not all(header in message for header in headers):
+                return False
+        return True
+
+
+def _compile(pattern):
+    # Compiled patterns are used as they are (with their own flags).
+    if hasattr(pattern, 'search'):
+        return pattern
+    return re.compile(pattern, re.I)
+
+
+# Indexes are built once per set of installed routers.  There are few
+# distinct sets (usually one per DB), but keep the memory bounded anyway.
+_INDEXES = {}
+MAX_INDEXES = 32
 
 
 del metaclass
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+'''A pool of SMTP connections.
+
+Odoo opens, authenticates and closes a new SMTP connection for each message.
+Transports may opt into reusing connections (see
+`MailTransportRouter.pool_connections`:attr:).  In that case, the connections
+made by ``ir.mail_server.connect`` are taken from a `SMTPConnectionPool`:class:
+and the ``quit()`` at the end of ``send_email`` gives the connection back to
+the pool.
+
+The pool is shared by all the threads of the process.  A connection is used
+by a single thread at a time.
+
+'''
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import time
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+del logging
+
+
+class SMTPConnectionPool(object):
+    '''A pool of SMTP connections keyed by their connection parameters.
+
+    :param idle_timeout: Seconds an idle connection is kept open.
+
+    :param max_messages: The number of messages sent through a connection
+                         before closing it.
+
+    :param max_idle: The maximum number of idle connections per key.
+
+    :param check_after: A connection idle for more than these seconds is
+                        checked with a NOOP before reusing it.
+
+    '''
+    def __init__(self, idle_timeout=60, max_messages=100, max_idle=4,
+                 check_after=5):
+        self.idle_timeout = idle_timeout
+        self.max_messages = max_messages
+        self.max_idle = max_idle
+        self.check_after = check_after
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.opened = self.reused = 0
+
+    def acquire(self, key, connect):
+        '''Return a connection for `key`.
+
+        Reuse an idle connection if there's a healthy one; otherwise call
+        `connect` to get a new ``smtplib.SMTP`` object.
+
+        '''
+        self._reap()
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                connection = idle.pop() if idle else None
+            if connection is None:
+                break
+            if connection.is_healthy(self.check_after):
+                self.reused += 1
+                return connection
+            connection.close()
+        self.opened += 1
+        return PooledConnection(self, key, connect())
+
+    def release(self, connection):
+        '''Give back the `connection` to the pool.
+
+        The connection is closed if it failed, if it's sent
+        `max_messages`, or if there are `max_idle` connections already.
+
+        '''
+        if connection.broken or connection.messages >= self.max_messages:
+            connection.close()
+            return
+        connection.released_at = time.time()
+        with self._lock:
+            idle = self._idle.setdefault(connection.key, [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                connection = None
+        if connection is not None:
+            connection.close()
+
+    def close_all(self):
+        '''Close all the idle connections.'''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _reap(self):
+        limit = time.time() - self.idle_timeout
+        expired = []
+        with self._lock:
+            for key, idle in list(self._idle.items()):
+                expired.extend(c for c in idle if c.released_at < limit)
+                idle[:] = [c for c in idle if c.released_at >= limit]
+                if not idle:
+                    del self._idle[key]
+        for connection in expired:
+            connection.close()
+
+    def stats(self):
+        '''Return a dict with the number of `opened`, `reused` and `idle`
+        connections.'''
+        with self._lock:
+            idle = sum(len(connections) for connections in self._idle.values())
+        return dict(opened=self.opened, reused=self.reused, idle=idle)
+
+
+class PooledConnection(object):
+    '''A ``smtplib.SMTP`` connection that goes back to the pool on `quit`.
+
+    All other attributes are those of the ``smtplib.SMTP`` object.
+
+    '''
+    def __init__(self, pool, key, smtp):
+        self.pool = pool
+        self.key = key
+        self.smtp = smtp
+        self.messages = 0
+        self.broken = False
+        self.released_at = time.time()
+
+    def __getattr__(self, attr):
+        return getattr(self.smtp, attr)
+
+    def _send(self, method, *args, **kwargs):
+        try:
+            result = method(*args, **kwargs)
+        except Exception:
+            # We don't know the state of the session; don't reuse it.
+            self.broken = True
+            raise
+        self.messages += 1
+        return result
+
+    def sendmail(self, *args, **kwargs):
+        return self._send(self.smtp.sendmail, *args, **kwargs)
+
+    def send_message(self, *args, **kwargs):
+        return self._send(self.smtp.send_message, *args, **kwargs)
+
+    def quit(self):
+        self.pool.release(self)
+
+    def is_healthy(self, check_after=0):
+        if time.time() - self.released_at < check_after:
+            return True
+        try:
+            code, _ = self.smtp.noop()
+        except Exception:
+            return False
+        return code == 250
+
+    def close(self):
+        try:
+            self.smtp.quit()
+        except Exception:
+            try:
+                self.smtp.close()
+            except Exception:
+                logger.debug('Error closing SMTP connection', exc_info=True)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+#: The options in Odoo's configuration file for the pool.
+POOL_OPTIONS = {
+    'idle_timeout': 'xopgi_mail_threads_smtp_idle_timeout',
+    'max_messages': 'xopgi_mail_threads_smtp_max_messages',
+    'max_idle': 'xopgi_mail_threads_smtp_max_idle',
+}
+
+
+def get_smtp_pool():
+    '''Return the pool of SMTP connections of this process.'''
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                from xoeuf.odoo.tools import config
+                options = {
+                    arg: int(config[option])
+                    for arg, option in POOL_OPTIONS.items()
+                    if config.get(option)
+                }
+                _pool = SMTPConnectionPool(**options)
+    return _pool
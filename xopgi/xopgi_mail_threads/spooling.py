@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ---------------------------------------------------------------------
+# Copyright (c) Merchise Autrement [~º/~] and Contributors
+# All rights reserved.
+#
+# This is free software; you can do what the LICENCE file allows you to.
+#
+'''Parse huge emails without holding them in memory.
+
+`parse_stream`:func: reads a raw email from a file, line by line, and builds
+the `email.message.Message`:class: tree.  The payload of an attachment is
+kept in memory until it reaches the spool threshold (see
+`get_spool_threshold`:func:); then it's decoded into a temporary file (a
+`SpooledPart`:class:) and the part gets a placeholder payload (the `token` of
+the spooled part) instead.  The raw email is copied to a temporary file as
+well, so that it can be stored (see `RawEmailStore.put`) without reading it
+again.
+
+The spooled parts of a message are found with `get_spooled_parts`:func:.
+Their tokens show up as the content of the attachments returned by
+``message_parse``; ``mail.thread`` replaces them with the spooled parts and
+creates the attachments from the files.
+
+Text bodies are always kept in memory, since Odoo needs them as strings.
+
+'''
+from __future__ import (division as _py3_division,
+                        print_function as _py3_print,
+                        absolute_import as _py3_abs_import)
+
+import uuid
+import binascii
+import tempfile
+
+from .parsing import _message_from_raw, _headers_from_raw
+
+
+#: The option in Odoo's configuration file with the size (in bytes) from
+#: which attachments are spooled to temporary files.
+SPOOL_THRESHOLD_OPTION = 'xopgi_mail_threads_spool_threshold'
+DEFAULT_SPOOL_THRESHOLD = 1024 * 1024
+
+#: The size of the chunks read and written.
+CHUNK_SIZE = 64 * 1024
+
+#: The attribute of the message with the spooled parts.
+SPOOLED_PARTS_ATTR = '_xopgi_spooled_parts'
+
+TOKEN_PREFIX = 'xopgi-spooled-part:'
+
+
+def get_spool_threshold():
+    from xoeuf.odoo.tools import config
+    try:
+        threshold = config.get(SPOOL_THRESHOLD_OPTION)
+        return int(threshold) if threshold else DEFAULT_SPOOL_THRESHOLD
+    except ValueError:
+        return DEFAULT_SPOOL_THRESHOLD
+
+
+class SpooledPart(object):
+    '''The decoded payload of a part, in a temporary file.
+
+    .. attribute:: filename
+
+       The file name of the part, if any.
+
+    .. attribute:: content_type
+
+       The content type of the part.
+
+    .. attribute:: size
+
+       The size of the decoded payload.
+
+    .. attribute:: token
+
+       The placeholder payload of the part.
+
+    '''
+    def __init__(self, filename=None, content_type=None, file=None):
+        self.filename = filename
+        self.content_type = content_type
+        self.file = file if file is not None else tempfile.TemporaryFile()
+        self.size = 0
+        self.token = TOKEN_PREFIX + uuid.uuid4().hex
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def open(self):
+        '''Return the file positioned at the start.'''
+        self.file.seek(0)
+        return self.file
+
+    def iter_chunks(self, size=CHUNK_SIZE):
+        stream = self.open()
+        chunk = stream.read(size)
+        while chunk:
+            yield chunk
+            chunk = stream.read(size)
+
+    def read(self):
+        '''Return the whole payload.  This defeats the purpose; avoid it.'''
+        return self.open().read()
+
+    def close(self):
+        self.file.close()
+
+    def __repr__(self):
+        return '<SpooledPart %s (%d bytes)>' % (
+            self.filename or self.content_type, self.size
+        )
+
+
+def get_spooled_parts(message):
+    '''Return a dict from token to `SpooledPart`:class: of `message`.'''
+    return getattr(message, SPOOLED_PARTS_ATTR, None) or {}
+
+
+def get_spooled_part(parts, content):
+    '''Return the spooled part whose token is `content` or None.'''
+    if not parts or not content or len(content) > 100:
+        return None
+    if not isinstance(content, str):
+        try:
+            content = content.decode('ascii')
+        except (AttributeError, UnicodeError):
+            return None
+    return parts.get(content.strip())
+
+
+def close_spooled_parts(message):
+    for part in get_spooled_parts(message).values():
+        part.close()
+
+
+def parse_stream(fileobj, threshold=None):
+    '''Parse the raw email read from `fileobj` (open in binary mode).
+
+    Return a pair ``(message, raw)``, where `raw` is a file with a copy of
+    the raw email (positioned at the start).  Attachments bigger than
+    `threshold` (see `get_spool_threshold`:func:) are spooled.
+
+    The caller must close `raw` and the spooled parts (see
+    `close_spooled_parts`:func:).
+
+    '''
+    if threshold is None:
+        threshold = get_spool_threshold()
+    raw = tempfile.SpooledTemporaryFile(max_size=threshold)
+    parts = {}
+    lines = _tee(fileobj, raw)
+    message, _ = _parse_part(lines, [], threshold, parts)
+    for _ in lines:
+        pass   # copy the rest to `raw`
+    setattr(message, SPOOLED_PARTS_ATTR, parts)
+    raw.seek(0)
+    return message, raw
+
+
+def _tee(fileobj, raw):
+    # Lines are at most CHUNK_SIZE long, so binary payloads without line
+    # breaks are read in chunks.  Only full lines can be delimiters.
+    line = fileobj.readline(CHUNK_SIZE)
+    while line:
+        raw.write(line)
+        yield line
+        line = fileobj.readline(CHUNK_SIZE)
+
+
+def _parse_part(lines, delimiters, threshold, parts):
+    '''Parse a part up to one of the `delimiters` of the enclosing parts.
+
+    Return the part and the delimiter line found (None at the end).
+
+    '''
+    header = []
+    for line in lines:
+        if _is_delimiter(line, delimiters):
+            return _headers_from_raw(b''.join(header)), line
+        header.append(line)
+        if not line.strip():
+            break
+    header = b''.join(header)
+    message = _headers_from_raw(header)
+    boundary = message.get_boundary() \
+        if message.get_content_maintype() == 'multipart' else None
+    if boundary:
+        return _parse_multipart(message, boundary, lines, delimiters,
+                                threshold, parts)
+    else:
+        return _parse_leaf(message, header, lines, delimiters, threshold,
+                           parts)
+
+
+def _parse_multipart(message, boundary, lines, delimiters, threshold,
+                     parts):
+    delimiter = b'--' + boundary.encode('ascii', 'replace')
+    inner = [delimiter] + delimiters
+    message.set_payload([])
+    preamble, line = _read_text(lines, inner, threshold)
+    if preamble:
+        message.preamble = preamble
+    while line is not None and line.rstrip() == delimiter:
+        part, line = _parse_part(lines, inner, threshold, parts)
+        message.attach(part)
+    if line is not None and line.rstrip() == delimiter + b'--':
+        epilogue, line = _read_text(lines, delimiters, threshold)
+        if epilogue:
+            message.epilogue = epilogue
+    return message, line
+
+
+def _read_text(lines, delimiters, limit):
+    # Read the preamble or epilogue of a multipart (only `limit` bytes are
+    # kept).
+    result, size = [], 0
+    for line in lines:
+        if _is_delimiter(line, delimiters):
+            break
+        size += len(line)
+        if size <= limit:
+            result.append(line)
+    else:
+        line = None
+    text = b''.join(result)
+    if text and not isinstance(text, str):
+        text = text.decode('ascii', 'surrogateescape')
+    return text, line
+
+
+def _parse_leaf(message, header, lines, delimiters, threshold, parts):
+    # Inline parts (with a Content-ID) are kept in memory, since Odoo
+    # replaces their references in the body.
+    if 'Content-ID' in message:
+        spoolable = False
+    elif message.get_filename():
+        spoolable = True
+    else:
+        maintype = message.get_content_maintype()
+        spoolable = maintype not in ('text', 'multipart', 'message')
+    body, size = [], 0
+    decoder = None
+    previous = None
+    line = None
+    for line in lines:
+        if _is_delimiter(line, delimiters):
+            break
+        if previous is not None:
+            if decoder is not None:
+                decoder.feed(previous)
+            else:
+                body.append(previous)
+        previous = line
+        size += len(line)
+        if decoder is None and spoolable and size > threshold:
+            decoder = _Decoder(message)
+            for item in body:
+                decoder.feed(item)
+            body = []
+    else:
+        line = None
+    if previous is not None:
+        # The line break before the delimiter belongs to the delimiter.
+        if line is not None:
+            previous = _strip_eol(previous)
+        if decoder is not None:
+            decoder.feed(previous)
+        else:
+            body.append(previous)
+    if decoder is None:
+        return _message_from_raw(header + b''.join(body)), line
+    part = decoder.close()
+    parts[part.token] = part
+    del message['Content-Transfer-Encoding']
+    message['Content-Transfer-Encoding'] = '7bit'
+    message.set_payload(part.token)
+    return message, line
+
+
+def _is_delimiter(line, delimiters):
+    if not delimiters or not line.startswith(b'--'):
+        return False
+    line = line.rstrip()
+    return any(line == d or line == d + b'--' for d in delimiters)
+
+
+def _strip_eol(line):
+    if line.endswith(b'\r\n'):
+        return line[:-2]
+    elif line.endswith(b'\n'):
+        return line[:-1]
+    else:
+        return line
+
+
+class _Decoder(object):
+    '''Decode the lines of a payload into a `SpooledPart`:class:.'''
+    def __init__(self, message):
+        self.part = SpooledPart(message.get_filename(),
+                                message.get_content_type())
+        self.encoding = (message.get('Content-Transfer-Encoding') or '')\
+            .strip().lower()
+        self.pending = b''
+
+    def feed(self, line):
+        if self.encoding == 'base64':
+            data = self.pending + b''.join(line.split())
+            cut = len(data) - len(data) % 4
+            self.pending = data[cut:]
+            if cut:
+                self.part.write(_b64decode(data[:cut]))
+        elif self.encoding == 'quoted-printable':
+            self.part.write(binascii.a2b_qp(line))
+        else:
+            self.part.write(line)
+
+    def close(self):
+        if self.pending:
+            padding = b'=' * (-len(self.pending) % 4)
+            self.part.write(_b64decode(self.pending + padding))
+        self.part.file.flush()
+        return self.part
+
+
+def _b64decode(data):
+    try:
+        return binascii.a2b_base64(data)
+    except binascii.Error:
+        return b''
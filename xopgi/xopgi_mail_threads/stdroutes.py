@@ -59,6 +59,20 @@ class SendBounce(_Base, models.TransientModel):
         The original message (`email.Message`:class:) must be passed in the
         'original_message' of `custom_values`.
 
+        .. note:: ``mail.thread.message_route_process`` doesn't call this
+           method (see `process_std_route`:func:); it's kept for callers that
+           need a record.
+
+        '''
+        self.send_bounce(msg_dict, custom_values)
+        return self.create({}).id
+
+    @api.model
+    def send_bounce(self, msg_dict, custom_values=None):
+        '''Send the bounce to the sender of the original message.
+
+        .. versionadded:: 7.0
+
         '''
         from xoutil.future.codecs import safe_encode
         custom_values = custom_values or {}
@@ -85,7 +99,6 @@ class SendBounce(_Base, models.TransientModel):
             bounce_body_html,
             message,
         )
-        return self.create({}).id
 
 
 class Ignore(_Base, models.TransientModel):
@@ -95,5 +108,27 @@ class Ignore(_Base, models.TransientModel):
     def message_new(self, msg_dict, custom_values=None):
         '''Ignore the message.
 
+        .. note:: ``mail.thread.message_route_process`` doesn't call this
+           method (see `process_std_route`:func:); it's kept for callers that
+           need a record.
+
         '''
         return self.create({}).id
+
+
+def is_std_route(route):
+    '''Return True if `route` is an ignore or bounce route.'''
+    return route[0] in (BOUNCE_ROUTE_MODEL, IGNORE_MESSAGE_ROUTE_MODEL)
+
+
+def process_std_route(obj, route, msg_dict):
+    '''Process an ignore or bounce `route` without touching the DB.
+
+    Odoo's ``message_route_process`` would call ``message_new`` which must
+    return the id of a new record.  Processing the route here avoids
+    creating a transient record for each message.
+
+    '''
+    model, _, custom_values, _, _ = route
+    if model == BOUNCE_ROUTE_MODEL:
+        obj.env[BOUNCE_ROUTE_MODEL].send_bounce(msg_dict, custom_values)
@@ -24,7 +24,12 @@ from xoutil.future.collections import namedtuple
 from xoutil.eight.meta import metaclass
 from xoutil.objects import classproperty
 
-from .utils import RegisteredType
+from .utils import RegisteredType, get_message_ids
+from .diagnostics import log_message_failure
+from .instrumentation import timed, TRANSPORT
+
+import time
+import threading
 
 import logging
 _logger = logging.getLogger(__name__)
@@ -45,7 +50,40 @@ class MailTransportRouter(metaclass(RegisteredType)):
     When OpenERP needs to send an email, registered transport router are
     consulted to find a transport router that can deliver the message.
 
+    Transports are consulted by their `priority` (lower first; ties are
+    broken by name).  Put cheap catch-all transports first.
+
+    While a `final` transport delivers a message, no other transport is
+    selected for the nested calls to ``send_email``; i.e the `final`
+    transport ends the pipeline.
+
+    If `parallel_query` is True, `query`:meth: may be called in another
+    thread (see `select`:meth:).  Such transports must not use the cursor of
+    the `obj` passed to `query`; they are meant for transports that look for
+    answers outside the DB (e.g DNS).
+
+    If `pool_connections` is True, the default `deliver`:meth: reuses SMTP
+    connections with the same parameters (see
+    `~xopgi.xopgi_mail_threads.smtp_pool`:mod:).
+
+    If `memoize_query` is True, the answer of `query`:meth: depends only on
+    the routing signature of the message (see `get_routing_signature`:meth:)
+    and it's cached (see `QueryCache`:class:).  The `signature_headers` are
+    the names of the headers that take part in the signature besides the
+    sender and recipients.  The data returned by `query` is shared by all
+    the messages with the same signature, so it must not be modified.
+
+    .. versionadded:: 7.0 The attributes `priority`, `final`,
+       `parallel_query`, `pool_connections`, `memoize_query` and
+       `signature_headers`.
+
     '''
+    priority = 10
+    final = False
+    parallel_query = False
+    pool_connections = False
+    memoize_query = False
+    signature_headers = ()
 
     def __new__(cls, *args, **kwargs):
         res = getattr(cls, '__singleton__', None)
@@ -58,49 +96,143 @@ class MailTransportRouter(metaclass(RegisteredType)):
     def select(cls, obj, message):
         '''Select a registered transport that can deliver the message.
 
-        No order is warranted about how to select any transport that can
-        deliver a message.
+        Transports are consulted in order of `priority`.  If a `final`
+        transport is delivering the message, no transport is selected.
 
         Return a tuple of ``(transport, query_data)`` where `transport` if an
         instance of the selected transport and `query_data` is data returned
         by the `query` method of the transport selected or None.
 
+        By default transports are queried one after the other.  If the system
+        parameter ``xopgi_mail_threads.transport_select_mode`` is
+        'parallel', the transports with `parallel_query` set are queried at
+        once in a pool of threads, each with a timeout (see
+        `get_query_timeout`:func:).  The selected transport is still the
+        first (by priority) that can deliver the message.
+
+        .. versionchanged:: 7.0 Added the parallel mode.
+
         '''
         from xoutil.context import Context
-        candidates = (
+        installed = MailTransportRouter.get_installed_objects(obj)
+        if any(t.final and t.context_name in Context for t in installed):
+            return None, None
+        candidates = [
             transport
-            for transport in MailTransportRouter.get_installed_objects(obj)
+            for transport in installed
             if transport.context_name not in Context
-        )
-        found, transport, data = False, None, None
-        candidate = next(candidates, None)
-        while not found and candidate:
-            try:
-                res = candidate.query(obj, message)
-            except Exception:
-                _logger.exception(
-                    'Candidate transport %s failed. Proceeding with another',
-                    candidate,
-                    extra=dict(
-                        message_to=message['To'],
-                        message_from=message['From'],
-                        message_delivered_to=message['Delivered-To'],
-                        message_subject=message['Subject'],
-                        message_return_path=message['Return-Path'],
-                        message_as_string=message.as_string()
-                    )
-                )
-                res = False
-            if isinstance(res, tuple):
-                found, data = res
-            else:
-                found, data = res, None
-            if found:
-                transport = candidate
-            else:
-                candidate = next(candidates, None)
+        ]
+        if get_select_mode(obj) == PARALLEL_MODE:
+            transport, data = cls._select_parallel(
+                obj, message, candidates, get_query_timeout(obj)
+            )
+        else:
+            transport, data = cls._select_sequential(obj, message, candidates)
         return (transport(), data) if transport else (None, None)
 
+    @classmethod
+    def _select_sequential(cls, obj, message, candidates):
+        for candidate in candidates:
+            found, data = candidate._query(obj, message)
+            if found:
+                return candidate, data
+        return None, None
+
+    @classmethod
+    def _select_parallel(cls, obj, message, candidates, timeout):
+        executor = _get_query_executor()
+        if executor is None:
+            return cls._select_sequential(obj, message, candidates)
+        from concurrent.futures import TimeoutError
+        deadline = time.time() + timeout
+        futures = {
+            candidate: executor.submit(candidate._query, obj, message)
+            for candidate in candidates
+            if candidate.parallel_query
+        }
+        try:
+            for candidate in candidates:
+                future = futures.get(candidate)
+                if future is None:
+                    found, data = candidate._query(obj, message)
+                else:
+                    try:
+                        found, data = future.result(
+                            timeout=max(0, deadline - time.time())
+                        )
+                    except TimeoutError:
+                        _logger.warning(
+                            'Candidate transport %s timed out after %.3fs. '
+                            'Proceeding with another',
+                            candidate, timeout
+                        )
+                        found, data = False, None
+                if found:
+                    return candidate, data
+            return None, None
+        finally:
+            # We don't need the answers of the transports we didn't reach;
+            # those already running cannot be stopped, though.
+            for future in futures.values():
+                future.cancel()
+
+    @classmethod
+    def _query(cls, obj, message):
+        '''Call `query`:meth: and return a pair ``(found, data)``.
+
+        Log the time taken.  If `query` fails, log the error and return
+        ``(False, None)``.
+
+        If `memoize_query` is set, look for the answer in the `QueryCache`
+        first; failures are not cached.
+
+        '''
+        if cls.memoize_query:
+            cache = get_query_cache()
+            key = (cls, cls.get_routing_signature(obj, message))
+            res = cache.get(obj, key)
+            if res is not None:
+                return res
+        start = time.time()
+        try:
+            res = timed(obj.env.cr.dbname, TRANSPORT, cls, 'query',
+                        obj, message)
+        except Exception:
+            log_message_failure(
+                _logger, message,
+                'Candidate transport %s failed. Proceeding with another',
+                cls
+            )
+            return False, None
+        _logger.debug('Transport %s answered %r in %.3fs',
+                      cls, res, time.time() - start)
+        if not isinstance(res, tuple):
+            res = res, None
+        if cls.memoize_query:
+            cache.set(obj, key, res)
+        return res
+
+    @classmethod
+    def get_routing_signature(cls, obj, message):
+        '''Return the routing signature of `message`.
+
+        The signature is a tuple with the domain of the sender, the set of
+        the domains of the recipients and the values of the
+        `signature_headers`.  Only used if `memoize_query` is set.
+
+        .. versionadded:: 7.0
+
+        '''
+        from email.utils import parseaddr
+        from .utils import get_recipients
+        sender = parseaddr(message.get('From', ''))[1]
+        return (
+            _get_domain(sender),
+            frozenset(_get_domain(address)
+                      for _, address in get_recipients(message)),
+            tuple(message.get(header) for header in cls.signature_headers),
+        )
+
     @classproperty
     def context_name(cls):
         from xoutil.names import nameof
@@ -156,8 +288,8 @@ class MailTransportRouter(metaclass(RegisteredType)):
         magic as a pipeline.  Notice this may, however, slow the delivery.
 
         Transports are not meant for the unwary users, but for system
-        designers.  Furthermore, the order in which they will be elected is
-        not defined.
+        designers.  The order in which they will be elected is given by their
+        `priority`.
 
         '''
         try:
@@ -168,7 +300,13 @@ class MailTransportRouter(metaclass(RegisteredType)):
 
         kwargs.update(dict(data or {}))
         try:
-            return server.send_email(message, **kwargs)
+            if self.pool_connections:
+                from xoutil.context import context
+                from .mail_server import POOLED_SMTP_CONTEXT
+                with context(POOLED_SMTP_CONTEXT):
+                    return server.send_email(message, **kwargs)
+            else:
+                return server.send_email(message, **kwargs)
         except AssertionError as error:
             if error.message == IrMailServer.NO_VALID_RECIPIENT:
                 _logger.info(
@@ -198,6 +336,46 @@ class MailTransportRouter(metaclass(RegisteredType)):
         '''
         return TransportRouteData(message, {})
 
+    def prepare_messages(self, obj, items):
+        '''Prepare several messages to be delivered.
+
+        `items` is a list of pairs ``(message, data)`` where `data` is the
+        second component of the result of `query`:meth: for the message.
+
+        Return a list with a `TransportRouteData` per item.  The default
+        implementation calls `prepare_message`:meth: for each item.
+
+        .. versionadded:: 7.0
+
+        '''
+        return [self.prepare_message(obj, message, data=data)
+                for message, data in items]
+
+    def deliver_many(self, server, messages, data, **kwargs):
+        '''Deliver several messages with the same connection `data`.
+
+        Return a list with the result of `deliver`:meth: for each message,
+        or the exception it raised.
+
+        The default implementation calls `deliver`:meth: for each message,
+        and all messages are sent through the same SMTP connection (see
+        `~xopgi.xopgi_mail_threads.smtp_pool`:mod:).
+
+        .. versionadded:: 7.0
+
+        '''
+        from xoutil.context import context
+        from .mail_server import POOLED_SMTP_CONTEXT
+        results = []
+        with context(POOLED_SMTP_CONTEXT):
+            for message in messages:
+                try:
+                    results.append(self.deliver(server, message, data,
+                                                **kwargs))
+                except Exception as error:
+                    results.append(error)
+        return results
+
     @classmethod
     def get_message_objects(cls, obj, message):
         '''Get the mail.message browse record for the `message` .
@@ -209,21 +387,182 @@ class MailTransportRouter(metaclass(RegisteredType)):
         If the message's Message-Id is not found `msg` is set to None.  If any
         of references is not found it won't be included the `refs` list.
 
+        The references are separated by whitespace as in RFC 5322 (see
+        `~xopgi.xopgi_mail_threads.utils.get_message_ids`:func:).  The
+        message and its references are found with a single query, and cached
+        for the rest of the transaction.
+
+        .. versionchanged:: 7.0 Use a single query and a cache.  Fixed the
+           parsing of the 'References' header.
+
         '''
-        message_id = message['Message-Id']
-        references = tuple(
-            ref.strip()
-            for ref in message.get('References', '').split(',')
-        )
         Messages = obj.env['mail.message']
-        msg = Messages.search([('message_id', '=', message_id)])
+        message_id = (message['Message-Id'] or '').strip()
+        references = get_message_ids(message.get('References'))
+        found = Messages._find_by_message_ids(
+            ([message_id] if message_id else []) + references
+        )
+        msg = Messages.browse(found.get(message_id, ()))
         if not msg:
             msg = None  # convert the null-record to None
-        if references:
-            refs = Messages.search([('message_id', 'in', references)])
-        else:
-            refs = Messages  # the empty recordset
+        refs = Messages.browse(
+            [id for ref in references for id in found[ref]]
+        )
         return msg, refs
 
 
+def _get_domain(address):
+    return address.rpartition('@')[-1].strip().lower()
+
+
+class QueryCache(object):
+    '''A cache of the answers of the transports' `query`.
+
+    There's an `~xopgi.xopgi_mail_threads.utils.LRUCache`:class: of at most
+    `maxsize` entries for each DB; entries expire after `ttl` seconds.  The
+    entries of a DB are dropped when its registry changes (see
+    `~xopgi.xopgi_mail_threads.utils.get_registry_signature`:func:) or when
+    `invalidate`:meth: is called (e.g after installing or uninstalling an
+    addon).
+
+    '''
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._caches = {}
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def _get_cache(self, obj):
+        from .utils import LRUCache, get_registry_signature
+        dbname = obj.env.cr.dbname
+        signature = get_registry_signature(obj)
+        entry = self._caches.get(dbname)
+        if entry is None or entry[0] != signature:
+            entry = self._caches[dbname] = (signature,
+                                            LRUCache(self.maxsize))
+        return entry[1]
+
+    def get(self, obj, key):
+        '''Return the answer cached for `key` or None.'''
+        with self._lock:
+            cache = self._get_cache(obj)
+            entry = cache.get(key)
+            if entry is not None and entry[0] < time.time():
+                cache.pop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def set(self, obj, key, value):
+        with self._lock:
+            self._get_cache(obj)[key] = (time.time() + self.ttl, value)
+
+    def invalidate(self, dbname=None):
+        '''Forget the entries of `dbname` (or all if None).'''
+        with self._lock:
+            if dbname is None:
+                self._caches.clear()
+            else:
+                self._caches.pop(dbname, None)
+
+    def stats(self):
+        '''Return a dict with the `hits`, `misses`, `hit_rate` and `size`.'''
+        with self._lock:
+            size = sum(len(cache) for _, cache in self._caches.values())
+        hits, misses = self.hits, self.misses
+        return dict(hits=hits, misses=misses,
+                    hit_rate=hits / (hits + misses) if hits + misses else 0.0,
+                    size=size)
+
+
+#: The options in Odoo's configuration file with the size of the
+#: `QueryCache` (entries per DB) and the seconds its entries live.
+QUERY_CACHE_SIZE_OPTION = 'xopgi_mail_threads_transport_cache_size'
+QUERY_CACHE_TTL_OPTION = 'xopgi_mail_threads_transport_cache_ttl'
+
+_query_cache = None
+_query_cache_lock = threading.Lock()
+
+
+def get_query_cache():
+    '''Return the `QueryCache`:class: of this process.'''
+    global _query_cache
+    if _query_cache is None:
+        with _query_cache_lock:
+            if _query_cache is None:
+                from xoeuf.odoo.tools import config
+                kwargs = {}
+                size = config.get(QUERY_CACHE_SIZE_OPTION)
+                if size:
+                    kwargs['maxsize'] = int(size)
+                ttl = config.get(QUERY_CACHE_TTL_OPTION)
+                if ttl:
+                    kwargs['ttl'] = float(ttl)
+                _query_cache = QueryCache(**kwargs)
+    return _query_cache
+
+
+#: The system parameter with the mode of `MailTransportRouter.select`.
+SELECT_MODE_PARAM = 'xopgi_mail_threads.transport_select_mode'
+SEQUENTIAL_MODE = 'sequential'
+PARALLEL_MODE = 'parallel'
+
+#: The system parameter with the timeout (in seconds) of the queries in the
+#: parallel mode.
+QUERY_TIMEOUT_PARAM = 'xopgi_mail_threads.transport_query_timeout'
+DEFAULT_QUERY_TIMEOUT = 5.0
+
+#: The option in Odoo's configuration file with the number of threads to
+#: query transports in parallel.
+QUERY_WORKERS_OPTION = 'xopgi_mail_threads_query_workers'
+DEFAULT_QUERY_WORKERS = 4
+
+
+def get_select_mode(obj):
+    get_param = obj.env['ir.config_parameter'].sudo().get_param
+    return get_param(SELECT_MODE_PARAM, SEQUENTIAL_MODE)
+
+
+def get_query_timeout(obj):
+    get_param = obj.env['ir.config_parameter'].sudo().get_param
+    try:
+        return float(get_param(QUERY_TIMEOUT_PARAM, DEFAULT_QUERY_TIMEOUT))
+    except ValueError:
+        return DEFAULT_QUERY_TIMEOUT
+
+
+_query_executor = None
+_query_executor_lock = threading.Lock()
+
+
+def _get_query_executor():
+    '''Return the pool of threads to query transports.
+
+    Return None if `concurrent.futures` is not available (in Python 2 it
+    requires the `futures` package).
+
+    '''
+    global _query_executor
+    if _query_executor is None:
+        with _query_executor_lock:
+            if _query_executor is None:
+                try:
+                    from concurrent.futures import ThreadPoolExecutor
+                except ImportError:
+                    _logger.warning(
+                        'Cannot query transports in parallel: '
+                        'concurrent.futures is not available'
+                    )
+                    return None
+                from xoeuf.odoo.tools import config
+                workers = int(config.get(QUERY_WORKERS_OPTION,
+                                         DEFAULT_QUERY_WORKERS))
+                _query_executor = ThreadPoolExecutor(max_workers=workers)
+    return _query_executor
+
+
 del metaclass, classproperty, RegisteredType, namedtuple
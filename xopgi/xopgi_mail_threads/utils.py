@@ -11,6 +11,9 @@ from __future__ import (division as _py3_division,
                         print_function as _py3_print,
                         absolute_import as _py3_abs_import)
 
+import time
+import threading
+
 from xoeuf import SUPERUSER_ID
 
 from email.utils import getaddresses, formataddr
@@ -64,8 +67,13 @@ class RegisteredType(type):
         registry = getattr(root, 'registry', None)
         if registry is not None:
             registry.add(res)
+            # A new class may belong to an installed addon, so whatever we
+            # have cached is no longer complete.
+            root.installed_cache.invalidate()
         else:
             root.registry = set()
+            root.installed_cache = InstalledObjectsCache()
+            _REGISTERED_ROOTS.append(root)
         return res
 
     def get_installed_objects(self, model):
@@ -74,15 +82,112 @@ class RegisteredType(type):
 
         Return a iterable (not necessarily a list).
 
+        .. versionchanged:: 7.0 The result is cached per database and
+           registry signature.  See `InstalledObjectsCache`:class:.
+
+        .. versionchanged:: 7.0 Return a tuple sorted by priority.  See
+           `sort_by_priority`:func:.
+
         '''
+        return self.installed_cache.get(model, self._find_installed_objects)
+
+    def _find_installed_objects(self, model):
         from xoeuf.modules import is_object_installed
-        return (
+        return sort_by_priority(
             obj
             for obj in self.registry
             if is_object_installed(model, obj)
         )
 
 
+def sort_by_priority(objects):
+    '''Return a tuple with `objects` sorted by their `priority` attribute.
+
+    Lower priorities come first.  Ties are broken by the full name of the
+    object, so that the order is the same in every process.
+
+    '''
+    return tuple(sorted(
+        objects,
+        key=lambda obj: (getattr(obj, 'priority', 0),
+                         '%s.%s' % (obj.__module__, obj.__name__))
+    ))
+
+
+class InstalledObjectsCache(object):
+    '''A per-database cache of the installed objects of a registered type.
+
+    Entries are keyed by the DB name and tagged with the signature of the Odoo
+    registry they were computed with (see `get_registry_signature`:func:).
+    When the registry is reloaded (e.g after installing, upgrading or
+    uninstalling an addon in this or another worker) the signature changes
+    and the entry is recomputed.
+
+    The attributes `hits` and `misses` count how the cache was used.
+
+    '''
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, model, compute):
+        '''Return the cached value for the DB of `model`.
+
+        If there's no valid entry, call ``compute(model)`` and store its
+        result.
+
+        '''
+        dbname = model.env.cr.dbname
+        signature = get_registry_signature(model)
+        entry = self._entries.get(dbname)
+        if entry is not None and entry[0] == signature:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        result = compute(model)
+        with self._lock:
+            self._entries[dbname] = (signature, result)
+        return result
+
+    def invalidate(self, dbname=None):
+        '''Forget the cached entry for `dbname` (or all if None).'''
+        with self._lock:
+            if dbname is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(dbname, None)
+
+    def stats(self):
+        '''Return a dict with the `hits`, `misses` and `size` of the cache.'''
+        return dict(hits=self.hits, misses=self.misses,
+                    size=len(self._entries))
+
+
+def get_registry_signature(model):
+    '''Return a value that changes whenever the registry of `model` changes.
+
+    Odoo creates a new registry each time addons are installed, upgraded or
+    uninstalled; other workers notice the change via the registry sequence.
+
+    '''
+    pool = model.pool
+    return (id(pool), getattr(pool, 'registry_sequence', None))
+
+
+def invalidate_installed_objects(dbname=None):
+    '''Invalidate the installed objects of all registered types.
+
+    Call this when the state of addons changes in `dbname`.
+
+    '''
+    for root in _REGISTERED_ROOTS:
+        root.installed_cache.invalidate(dbname)
+
+
+_REGISTERED_ROOTS = []
+
+
 # TODO: Move these to xoutil.  For that I need first to port the
 # `decode_header` from future email.
 def set_message_address_header(message, header, value, address_only=False):
@@ -166,6 +271,188 @@ def get_recipients(message, also=None):
     return get_addresses_headers(message, headers)
 
 
+def get_message_ids(value):
+    '''Return the list of message ids in `value`.
+
+    `value` is the value of a header like 'References' or 'In-Reply-To'.
+    RFC 5322 separates the ids with whitespace (and comments), but some
+    agents use commas; both are accepted.  Tokens without angle brackets are
+    kept as they are.  Duplicates are removed.
+
+    '''
+    import re
+    value = re.sub(r'\([^()]*\)', ' ', value or '')   # drop comments
+    result = []
+    for token in re.findall(r'<[^<>]*>|[^\s,<>]+', value):
+        if token not in result:
+            result.append(token)
+    return result
+
+
+class LRUCache(object):
+    '''A mapping that keeps the `maxsize` items used most recently.
+
+    The attributes `hits` and `misses` count the lookups with `get`:meth:.
+
+    '''
+    def __init__(self, maxsize=1024):
+        from collections import OrderedDict
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key, default=None):
+        data = self._data
+        try:
+            value = data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        data[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        data = self._data
+        data.pop(key, None)
+        data[key] = value
+        while len(data) > self.maxsize:
+            data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+
+def get_transaction_cache(cr, name, maxsize=1024):
+    '''Return the `LRUCache`:class: `name` of the current transaction of `cr`.
+
+    The cache is dropped when the transaction is committed or rolled back.
+    Rolling back to a savepoint doesn't drop it.
+
+    '''
+    caches = cr.__dict__.get(_TRANSACTION_CACHES_ATTR)
+    if caches is None:
+        caches = {}
+        setattr(cr, _TRANSACTION_CACHES_ATTR, caches)
+        after = getattr(cr, 'after', None)
+        if after is not None:
+            drop = lambda: cr.__dict__.pop(_TRANSACTION_CACHES_ATTR, None)
+            after('commit', drop)
+            after('rollback', drop)
+    result = caches.get(name)
+    if result is None:
+        result = caches[name] = LRUCache(maxsize)
+    return result
+
+
+_TRANSACTION_CACHES_ATTR = '_xopgi_transaction_caches'
+
+
+class ThreadCache(object):
+    '''A cache from Message-Id to the thread ``(model, res_id)``.
+
+    There's an `LRUCache`:class: of at most `maxsize` entries for each DB.
+    The cache is shared by all the threads of the process.
+
+    Entries expire after `ttl` seconds.  Messages moved to another thread
+    (or deleted) are discarded only from the cache of the process that
+    changed them; other processes (e.g the other Odoo workers) see the change
+    once the entry expires.
+
+    '''
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._caches = {}
+        self._lock = threading.Lock()
+
+    def _get_cache(self, dbname):
+        cache = self._caches.get(dbname)
+        if cache is None:
+            cache = self._caches.setdefault(dbname, LRUCache(self.maxsize))
+        return cache
+
+    def get(self, dbname, message_id):
+        with self._lock:
+            cache = self._get_cache(dbname)
+            entry = cache.get(message_id)
+            if entry is None:
+                return None
+            elif entry[0] < time.time():
+                cache.pop(message_id)
+                cache.hits -= 1   # an expired entry is a miss
+                cache.misses += 1
+                return None
+            else:
+                return entry[1]
+
+    def update(self, dbname, threads):
+        '''Remember the `threads`, a dict from Message-Id to thread.'''
+        expires = time.time() + self.ttl
+        with self._lock:
+            cache = self._get_cache(dbname)
+            for message_id, thread in threads.items():
+                cache[message_id] = (expires, thread)
+
+    def discard(self, dbname, message_ids):
+        with self._lock:
+            cache = self._get_cache(dbname)
+            for message_id in message_ids:
+                cache.pop(message_id)
+
+    def invalidate(self, dbname=None):
+        '''Forget the entries of `dbname` (or all if None).'''
+        with self._lock:
+            if dbname is None:
+                self._caches.clear()
+            else:
+                self._caches.pop(dbname, None)
+
+    def stats(self):
+        '''Return a dict with the `hits`, `misses` and `size` of the cache.'''
+        with self._lock:
+            caches = list(self._caches.values())
+        return dict(hits=sum(c.hits for c in caches),
+                    misses=sum(c.misses for c in caches),
+                    size=sum(len(c) for c in caches))
+
+
+_thread_cache = None
+_thread_cache_lock = threading.Lock()
+
+#: The options of Odoo's configuration with the size of the thread cache
+#: and the seconds its entries live.
+THREAD_CACHE_SIZE_OPTION = 'xopgi_mail_threads_thread_cache_size'
+THREAD_CACHE_TTL_OPTION = 'xopgi_mail_threads_thread_cache_ttl'
+
+
+def get_thread_cache():
+    '''Return the `ThreadCache`:class: of this process.'''
+    global _thread_cache
+    if _thread_cache is None:
+        with _thread_cache_lock:
+            if _thread_cache is None:
+                from xoeuf.odoo.tools import config
+                kwargs = {}
+                size = config.get(THREAD_CACHE_SIZE_OPTION)
+                if size:
+                    kwargs['maxsize'] = int(size)
+                ttl = config.get(THREAD_CACHE_TTL_OPTION)
+                if ttl:
+                    kwargs['ttl'] = float(ttl)
+                _thread_cache = ThreadCache(**kwargs)
+    return _thread_cache
+
+
 def create_bounce_route(original_message, **custom_values):
     '''Return the standard bounce route.
 
@@ -256,7 +543,6 @@ def get_automatic_response_type(message):
 
     '''
     how = message.get('Auto-Submitted', '').lower()
-    content_type = message.get('Content-Type', '')
     if how.startswith('auto-replied'):
         return AUTO_REPLIED
     elif how.startswith('auto-generated'):
@@ -265,10 +551,13 @@ def get_automatic_response_type(message):
         # Some MTAs also include this, but I will refuse them unless an
         # In-Reply-To is provided.
         return AUTO_REPLIED
-    elif content_type.startswith('message/report'):
-        if 'report-type=delivery-status' in content_type:
+    elif message.get_content_type() in ('multipart/report', 'message/report'):
+        # Use `get_param` since the parameter may be quoted (e.g with the
+        # SMTP policy of Python 3).
+        report_type = (message.get_param('report-type') or '').lower()
+        if report_type == 'delivery-status':
             return DELIVERY_STATUS_NOTIFICATION
-        elif 'report-type=disposition-notification' in content_type:
+        elif report_type == 'disposition-notification':
             return DISPOSITION_NOTIFICATION
     return NOT_AUTOMATIC_RESPONSE
 